@@ -0,0 +1,170 @@
+'''
+Micro-benchmark comparing the incremental extractors in extract.py with the
+full BeautifulSoup parsing they replaced. Every page is first checked to give
+the same results both ways, then the parse time and the peak memory allocated
+while parsing it are reported. Runs on the small synthetic pages in
+benchmarks/pages by default, which follow the markup the extractors look for
+but are not copies of the NTU site, or on fresh copies of the real pages.
+Only the real pages show that the extractors agree on the actual markup. Needs
+beautifulsoup4 installed for the comparison.
+
+Usage:
+    python benchmarks/bench_extract.py                          # run on the committed pages
+    python benchmarks/bench_extract.py --fetch --pages PATH     # save copies of the real pages into PATH and run on them
+'''
+
+from bs4 import BeautifulSoup
+from urllib import request
+
+import os
+import sys
+import timeit
+import argparse
+import tracemalloc
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), ".."))
+
+import extract
+
+PAGES_DIR = os.path.join(os.path.dirname(os.path.abspath(__file__)), "pages")
+NEWS_PAGE = "news.html"
+SHUTTLE_PAGE = "shuttle.html"
+SHUTTLE_INFO_PAGE = "shuttle_info.html"
+NEWS_COUNT = 5 # as bot.NEWS_COUNT
+NTU_WEBSITE = "http://www.ntu.edu.sg/"
+SHUTTLE_BUS_URL = "has/Transportation/Pages/GettingAroundNTU.aspx"
+NEWS_HUB_URL = "http://news.ntu.edu.sg/Pages/NewsSummary.aspx?Category=news+releases"
+REPEAT = 5
+
+def legacy_news(page, count):
+
+    '''
+    The news scraping as it was done with BeautifulSoup.
+    '''
+
+    items = []
+    next_news = BeautifulSoup(page, "html.parser").find_all("div", {"class": "ntu_news_summary_title_first"})[0]
+    for i in range(count):
+        items.append((next_news.next_sibling.string, next_news.a.string.strip().title(), next_news.a['href']))
+        next_news = next_news.find_next_sibling("div", {"class": "ntu_news_summary_title"})
+    return items
+
+def legacy_shuttle_services(page):
+
+    '''
+    The shuttle bus page scraping as it was done with BeautifulSoup.
+    '''
+
+    services = []
+    for service in BeautifulSoup(page, "html.parser").find_all("span", {"class": "route_label"}):
+        sub_routes = service.parent.find_all("strong")
+        if len(service.parent.find_all("span")) == 2: del sub_routes[-1]
+        parse_bus_stops = lambda element: [bus_stop.string for bus_stop in element.find_next("ul").find_all("li")]
+        routes = [(sub_route.string, parse_bus_stops(sub_route)) for sub_route in sub_routes] or [(None, parse_bus_stops(service))]
+        services.append((service.string.strip(), service.find_next_sibling("a")['href'], routes))
+    return services
+
+def legacy_shuttle_image(page):
+
+    '''
+    The shuttle bus info page scraping as it was done with BeautifulSoup.
+    '''
+
+    return BeautifulSoup(page, "html.parser").find("div", {"class": "img-caption"}).img['src']
+
+def current_news(page, count):
+    return [tuple(item) for item in extract.parse_news(page, count)]
+
+def current_shuttle_services(page):
+    return [
+        (service.name, service.info_link, [(route.name, route.stops) for route in service.routes])
+        for service in extract.parse_shuttle_services(page)
+    ]
+
+def fetch(directory):
+
+    '''
+    Saves copies of the pages the bot scrapes into directory.
+
+    @param directory: directory to save the pages into
+    '''
+
+    os.makedirs(directory, exist_ok = True)
+    load = lambda url: request.urlopen(url).read().decode("utf-8", "replace")
+
+    shuttle_page = load(NTU_WEBSITE + SHUTTLE_BUS_URL)
+    info_link = extract.parse_shuttle_services(shuttle_page)[0].info_link
+    for name, page in [
+        (NEWS_PAGE, load(NEWS_HUB_URL)),
+        (SHUTTLE_PAGE, shuttle_page),
+        (SHUTTLE_INFO_PAGE, load(NTU_WEBSITE + info_link))
+    ]:
+        with open(os.path.join(directory, name), 'w', encoding = "utf-8") as page_file:
+            page_file.write(page)
+        print("saved", name, "(%d KB)" % (len(page) // 1024))
+
+def measure(function, *args):
+
+    '''
+    Returns the best time per call in milliseconds and the peak memory
+    allocated during one call in kilobytes.
+    '''
+
+    timer = timeit.Timer(lambda: function(*args))
+    number, _ = timer.autorange()
+    best = min(timer.repeat(repeat = REPEAT, number = number)) / number
+
+    tracemalloc.start()
+    function(*args)
+    _, peak = tracemalloc.get_traced_memory()
+    tracemalloc.stop()
+
+    return best * 1000, peak / 1024
+
+def main(directory):
+
+    '''
+    Checks that every extractor gives the same results as the code it
+    replaced, then runs every benchmark and prints a comparison table. Exits
+    with an error if any results differ.
+
+    @param directory: directory holding the pages
+    '''
+
+    pages = {}
+    for name in [NEWS_PAGE, SHUTTLE_PAGE, SHUTTLE_INFO_PAGE]:
+        with open(os.path.join(directory, name), encoding = "utf-8") as page_file:
+            pages[name] = page_file.read()
+
+    benchmarks = [
+        ("news", legacy_news, current_news, (pages[NEWS_PAGE], NEWS_COUNT)),
+        ("shuttle services", legacy_shuttle_services, current_shuttle_services, (pages[SHUTTLE_PAGE],)),
+        ("shuttle image", legacy_shuttle_image, extract.parse_shuttle_image, (pages[SHUTTLE_INFO_PAGE],))
+    ]
+
+    mismatches = [name for name, legacy, current, args in benchmarks if legacy(*args) != current(*args)]
+    for name, legacy, current, args in benchmarks:
+        if name not in mismatches: continue
+        print(name + " results differ:\n  bs4:     " + repr(legacy(*args)) + "\n  extract: " + repr(current(*args)))
+    if mismatches: sys.exit(1)
+    print("results match on every page\n")
+
+    print("%-18s %12s %12s %8s %14s %14s %8s" % ("page", "bs4 ms", "extract ms", "speedup", "bs4 peak KB", "extract KB", "ratio"))
+    for name, legacy, current, args in benchmarks:
+        legacy_time, legacy_peak = measure(legacy, *args)
+        current_time, current_peak = measure(current, *args)
+        print("%-18s %12.2f %12.2f %7.1fx %14.0f %14.0f %7.1fx" % (
+            name, legacy_time, current_time, legacy_time / current_time, legacy_peak, current_peak, legacy_peak / current_peak
+        ))
+
+if __name__ == '__main__':
+
+    parser = argparse.ArgumentParser(description = "Check and compare extract.py with BeautifulSoup on saved NTU pages.")
+    parser.add_argument("--fetch", action = "store_true", help = "save fresh copies of the real pages into --pages first")
+    parser.add_argument("--pages", default = PAGES_DIR, help = "directory of the pages to run on")
+    arguments = parser.parse_args()
+
+    if arguments.fetch:
+        if os.path.abspath(arguments.pages) == PAGES_DIR: parser.error("--fetch needs --pages, to keep the committed pages")
+        fetch(arguments.pages)
+    main(arguments.pages)
@@ -0,0 +1,418 @@
+'''
+End-to-end load test of the whole bot. Starts local fakes of the Telegram Bot
+API, the NTU webcams, the NTU website and news hub, and Twitter (see fakes.py),
+runs main.py against them in a scratch directory, and drives it with synthetic
+users sending /peek, /news, /shuttle, /subscribe and /unsubscribe and clicking
+the keyboards they get back, while tweets are fanned out to the subscribers.
+Reports the p50/p99 latency of every command, from the update being queued to
+the reply reaching the fake Bot API, the messages sent per second, and the peak
+memory of the bot. Every random choice is drawn from --seed, so runs can be
+compared with --save and --compare.
+
+The fake website serves the synthetic NTU pages committed in benchmarks/pages,
+so runs on the same checkout see the same pages. Needs the
+openssl command line tool (the fake Twitter has to speak https) and Linux (for
+the memory figures).
+
+Usage:
+    python benchmarks/bench_load.py --save before.json
+    python benchmarks/bench_load.py --compare before.json
+'''
+
+from urllib.parse import urlsplit
+
+import os
+import re
+import sys
+import json
+import math
+import time
+import random
+import shutil
+import signal
+import asyncio
+import argparse
+import tempfile
+
+BENCHMARKS_DIR = os.path.dirname(os.path.abspath(__file__))
+sys.path.insert(0, os.path.join(BENCHMARKS_DIR, ".."))
+
+import bot
+import fakes
+import subscribers
+
+MAIN_SCRIPT = os.path.join(BENCHMARKS_DIR, "..", "main.py")
+PROFILE_DIR = os.path.join(BENCHMARKS_DIR, "..", "profiles")
+ADMIN_ID = 1
+FIRST_USER_ID = 100
+FIRST_SUBSCRIBER_ID = 1000000
+ACTIONS = [("/peek", 4), ("/news", 3), ("/shuttle", 3), ("/subscribe", 1), ("/unsubscribe", 1)] # command and how often users send it
+TWEET_TEXT = "load test tweet %d"
+TWEET_PATTERN = re.compile(r"load test tweet (\d+)")
+REPLY_TIMEOUT = 30 # seconds a user waits for a reply before counting a timeout
+READY_TIMEOUT = 120 # seconds the bot may take to start
+QUIET_PERIOD = 5 # seconds without a fan-out message before the fan-outs are considered done
+DRAIN_TIMEOUT = 300 # seconds to wait at most for the fan-outs after the users stop
+MEMORY_INTERVAL = 0.5 # seconds between memory samples
+PAGES_DIR = os.path.join(BENCHMARKS_DIR, "pages") # committed synthetic NTU pages, shared with bench_extract.py
+NEWS_PAGE = "news.html"
+SHUTTLE_PAGE = "shuttle.html"
+SHUTTLE_INFO_PAGE = "shuttle_info.html"
+LOG_FILE_NAME = "bot.log"
+
+class LoadTest():
+
+    def __init__(self, arguments):
+
+        '''
+        Sets up the fakes and the scratch directory the bot runs in.
+
+        @param arguments: parsed command line arguments
+        '''
+
+        self.arguments = arguments
+        self.directory = tempfile.mkdtemp(prefix = "bench_load.")
+        self.bot_api = fakes.FakeBotApi(arguments.latency / 1000, arguments.rate_limit, arguments.seed)
+        self.camera = fakes.FakeCamera(PROFILE_DIR, arguments.seed)
+        self.twitter = fakes.FakeTwitter(bot.TWITTER_ACCOUNTS)
+
+        pages = {}
+        for name in [NEWS_PAGE, SHUTTLE_PAGE, SHUTTLE_INFO_PAGE]:
+            with open(os.path.join(arguments.pages, name), encoding = "utf-8") as page_file:
+                pages[name] = page_file.read()
+        self.website = fakes.FakeWebsite({
+            urlsplit(bot.NEWS_HUB_URL).path: pages[NEWS_PAGE],
+            "/" + bot.SHUTTLE_BUS_URL: pages[SHUTTLE_PAGE]
+        }, pages[SHUTTLE_INFO_PAGE])
+
+        self.users = {}
+        self.latencies = {} # command or callback to the latencies of its replies
+        self.timeouts = {}
+        self.sent = 0
+        self.tweets = [] # time sent, time of the last delivery and deliveries per chat id of every tweet
+        self.last_fanout = 0
+        self.peak_rss = {} # pid to peak resident memory in kilobytes
+        self.process = None
+        self.sampler = None
+        self.bot_api.listeners.append(self._on_send)
+
+    def _seed_subscribers(self):
+
+        '''
+        Fills the subscriber database the bot will open with the subscribers of
+        the default account.
+        '''
+
+        repository = subscribers.SQLiteSubscriberRepository(os.path.join(self.directory, subscribers.SUBSCRIBERS_DB_NAME))
+        repository.subscribe_many((
+            (FIRST_SUBSCRIBER_ID + index, "Subscriber " + str(index)) for index in range(self.arguments.subscribers)
+        ), bot.TWITTER_ACCOUNTS[0])
+        repository.close()
+
+        with open(os.path.join(self.directory, "save_data.json"), 'w') as save_file:
+            json.dump({"status": "", "stats": {}, "admins": [], "subscribers": {}}, save_file)
+        os.symlink(os.path.abspath(PROFILE_DIR), os.path.join(self.directory, "profiles"))
+
+    def _on_send(self, method, params, received):
+
+        '''
+        Called by the fake Bot API with every message accepted. Hands replies
+        to the user waiting for them and counts fan-out messages.
+        '''
+
+        self.sent += 1
+        chat_id = int(params["chat_id"])
+        match = TWEET_PATTERN.search(params.get("text", ""))
+        if match:
+            tweet = self.tweets[int(match.group(1))]
+            tweet["deliveries"][chat_id] = tweet["deliveries"].get(chat_id, 0) + 1
+            tweet["last"] = self.last_fanout = received
+        elif method == "sendMessage" and chat_id in self.users:
+            self.users[chat_id].replies.put_nowait((params, received))
+
+    async def _sample_memory(self):
+
+        '''
+        Async method which keeps the peak resident memory of the bot and every
+        process it started, e.g. workers and the density pool.
+        '''
+
+        while True:
+            pids = [self.process.pid]
+            for pid in pids:
+                try:
+                    for task in os.listdir("/proc/%d/task" % pid):
+                        with open("/proc/%d/task/%s/children" % (pid, task)) as children:
+                            pids.extend(int(child) for child in children.read().split())
+                    with open("/proc/%d/status" % pid) as status:
+                        for line in status:
+                            if line.startswith("VmHWM:"):
+                                self.peak_rss[pid] = max(self.peak_rss.get(pid, 0), int(line.split()[1]))
+                except (OSError, ValueError):
+                    pass # exited in the meantime
+            await asyncio.sleep(MEMORY_INTERVAL)
+
+    async def _start_bot(self, cert_file):
+
+        '''
+        Async method which starts main.py against the fakes and waits until it
+        polls for updates and follows the tweet stream.
+        '''
+
+        news_url = urlsplit(bot.NEWS_HUB_URL)
+        env = dict(os.environ,
+            BOT_TOKEN = "load-test",
+            TWITTER_CONSUMER_KEY = "load-test", TWITTER_CONSUMER_SECRET = "load-test",
+            TWITTER_ACCESS_TOKEN = "load-test", TWITTER_ACCESS_TOKEN_SECRET = "load-test",
+            ADMINISTRATORS = str(ADMIN_ID),
+            BOT_API_URL = self.bot_api.url,
+            CAMERA_URL = self.camera.base_url,
+            NTU_WEBSITE_URL = self.website.url + "/",
+            NEWS_URL = self.website.url + news_url.path + "?" + news_url.query,
+            TWITTER_API_HOST = "%s:%d" % (fakes.HOST, self.twitter.port),
+            TWITTER_STREAM_HOST = "%s:%d" % (fakes.HOST, self.twitter.port),
+            REQUESTS_CA_BUNDLE = cert_file,
+            WORKERS = str(self.arguments.workers),
+            PYTHONUNBUFFERED = "1"
+        )
+        for setting in ["WEBHOOK_URL", "CAMERA_POLL_INTERVAL", "TWITTER_ACCOUNTS"]:
+            env.pop(setting, None)
+
+        self.log_file = open(os.path.join(self.directory, LOG_FILE_NAME), 'w')
+        self.process = await asyncio.create_subprocess_exec(
+            sys.executable, os.path.abspath(MAIN_SCRIPT), cwd = self.directory, env = env, stdout = self.log_file, stderr = self.log_file
+        )
+        self.sampler = asyncio.ensure_future(self._sample_memory())
+
+        ready = asyncio.ensure_future(asyncio.gather(self.bot_api.polled.wait(), self.twitter.connected.wait()))
+        exited = asyncio.ensure_future(self.process.wait())
+        await asyncio.wait([ready, exited], timeout = READY_TIMEOUT, return_when = asyncio.FIRST_COMPLETED)
+        if not ready.done():
+            ready.cancel()
+            raise RuntimeError("bot did not start, see " + os.path.join(self.directory, LOG_FILE_NAME))
+        exited.cancel()
+
+    async def _stop_bot(self):
+        if self.process is None: return
+        if self.process.returncode is None:
+            self.process.send_signal(signal.SIGTERM)
+            await self.process.wait()
+        self.sampler.cancel()
+        self.log_file.close()
+
+    async def _tweet(self, delay, number):
+        await asyncio.sleep(delay)
+        self.tweets.append({"sent": time.monotonic(), "last": time.monotonic(), "deliveries": {}})
+        await self.twitter.tweet(bot.TWITTER_ACCOUNTS[0], TWEET_TEXT % number)
+
+    async def _drain(self):
+
+        '''
+        Async method which waits until the fan-outs have reached every seeded
+        subscriber and gone quiet, or for DRAIN_TIMEOUT at most.
+        '''
+
+        deadline = time.monotonic() + DRAIN_TIMEOUT
+        while time.monotonic() < deadline:
+            reached = all(len(tweet["deliveries"]) >= self.arguments.subscribers for tweet in self.tweets)
+            if reached and time.monotonic() - self.last_fanout > QUIET_PERIOD: break
+            await asyncio.sleep(1)
+
+    async def run(self):
+
+        '''
+        Async method which runs the whole load test and returns the results.
+        '''
+
+        ssl_context, cert_file = fakes.self_signed_context(self.directory)
+        await self.bot_api.start()
+        await self.camera.start()
+        await self.website.start()
+        await self.twitter.start(ssl_context = ssl_context)
+        self._seed_subscribers()
+        try:
+            await self._start_bot(cert_file)
+            print("bot ready, running %d users for %ds" % (self.arguments.users, self.arguments.duration))
+
+            started = time.monotonic()
+            deadline = started + self.arguments.duration
+            for index in range(self.arguments.users):
+                user = User(self, index)
+                self.users[user.chat["id"]] = user
+            tweets = [
+                self._tweet(self.arguments.duration * (number + 1) / (self.arguments.tweets + 1), number)
+                for number in range(self.arguments.tweets)
+            ]
+            await asyncio.gather(*[user.run(deadline) for user in self.users.values()], *tweets)
+            await self._drain()
+            elapsed = time.monotonic() - started
+        finally:
+            await self._stop_bot()
+            for fake in [self.bot_api, self.camera, self.website, self.twitter]:
+                await fake.stop()
+
+        shutil.rmtree(self.directory)
+        return self._results(elapsed)
+
+    def _results(self, elapsed):
+
+        '''
+        Summarizes the measurements into a dictionary which can be saved as
+        json.
+        '''
+
+        commands = {}
+        for name in sorted(set(self.latencies) | set(self.timeouts)):
+            latencies = sorted(self.latencies.get(name, []))
+            commands[name] = {
+                "count": len(latencies), "timeouts": self.timeouts.get(name, 0),
+                "p50_ms": percentile(latencies, 50) * 1000, "p99_ms": percentile(latencies, 99) * 1000
+            }
+
+        fanouts = [{
+            "recipients": len(tweet["deliveries"]), "duplicates": sum(tweet["deliveries"].values()) - len(tweet["deliveries"]),
+            "seconds": tweet["last"] - tweet["sent"]
+        } for tweet in self.tweets]
+
+        return {
+            "settings": {name: value for name, value in vars(self.arguments).items() if name not in ["save", "compare", "pages"]},
+            "commands": commands,
+            "fanouts": fanouts,
+            "messages": self.sent,
+            "messages_per_second": self.sent / elapsed,
+            "rate_limited": self.bot_api.rate_limited,
+            "peak_rss_mb": self.peak_rss.get(self.process.pid, 0) / 1024,
+            "peak_rss_total_mb": sum(self.peak_rss.values()) / 1024
+        }
+
+class User():
+
+    def __init__(self, test, index):
+
+        '''
+        Sets up a synthetic user with its own private chat and random
+        generator, so that it makes the same choices on every run.
+
+        @param test: the LoadTest the user belongs to
+        @param index: number of the user
+        '''
+
+        self.test = test
+        self.chat = {"id": FIRST_USER_ID + index, "type": "private", "first_name": "User" + str(index)}
+        self.random = random.Random("%d:%d" % (test.arguments.seed, index))
+        self.replies = asyncio.Queue()
+
+    async def _request(self, name, queue):
+
+        '''
+        Async method which queues an update and records how long the bot takes
+        to reply. Returns the parameters of the reply, or None on timeout.
+
+        @param name: name to record the latency under
+        @param queue: function which queues the update and returns the time
+        '''
+
+        while not self.replies.empty():
+            self.replies.get_nowait() # late replies to earlier requests
+        queued = queue()
+        try:
+            params, received = await asyncio.wait_for(self.replies.get(), REPLY_TIMEOUT)
+        except asyncio.TimeoutError:
+            self.test.timeouts[name] = self.test.timeouts.get(name, 0) + 1
+            return None
+        self.test.latencies.setdefault(name, []).append(received - queued)
+        return params
+
+    async def run(self, deadline):
+
+        '''
+        Async method which keeps sending commands, pausing a random think time
+        before each, until the deadline.
+
+        @param deadline: time.monotonic() at which to stop
+        '''
+
+        commands, weights = zip(*ACTIONS)
+        while True:
+            await asyncio.sleep(self.random.expovariate(1 / self.test.arguments.think))
+            if time.monotonic() >= deadline: return
+
+            command = self.random.choices(commands, weights)[0]
+            reply = await self._request(command, lambda: self.test.bot_api.send_text(self.chat, command))
+            buttons = [
+                button["callback_data"] for row in json.loads(reply["reply_markup"])["inline_keyboard"] for button in row
+            ] if reply and "reply_markup" in reply else []
+            if buttons:
+                data = self.random.choice(buttons)
+                await self._request(data.split(":")[0], lambda: self.test.bot_api.click(self.chat, data))
+
+def percentile(values, percent):
+
+    '''
+    Returns the nearest-rank percentile of sorted values, or 0 if empty.
+    '''
+
+    if not values: return 0
+    return values[max(0, math.ceil(percent / 100 * len(values)) - 1)]
+
+def report(results, previous = None):
+
+    '''
+    Prints the results, next to those of a previous run if given.
+    '''
+
+    change = lambda value, old: "" if old is None else "  (was %.1f, %+.0f%%)" % (old, (value - old) / old * 100 if old else 0)
+    old = lambda *keys: _lookup(previous, keys)
+
+    if previous and previous["settings"] != results["settings"]:
+        print("warning: settings differ from the previous run", previous["settings"])
+
+    print("%-14s %7s %9s %10s %10s" % ("command", "count", "timeouts", "p50 ms", "p99 ms"))
+    for name, command in results["commands"].items():
+        print("%-14s %7d %9d %10.1f %10.1f%s%s" % (
+            name, command["count"], command["timeouts"], command["p50_ms"], command["p99_ms"],
+            change(command["p50_ms"], old("commands", name, "p50_ms")), change(command["p99_ms"], old("commands", name, "p99_ms"))
+        ))
+    for number, fanout in enumerate(results["fanouts"]):
+        print("tweet %d: %d recipients in %.1fs, %d duplicates" % (number, fanout["recipients"], fanout["seconds"], fanout["duplicates"]))
+    print("messages sent: %d (%.1f/s)%s, 429s injected: %d" % (
+        results["messages"], results["messages_per_second"], change(results["messages_per_second"], old("messages_per_second")),
+        results["rate_limited"]
+    ))
+    print("peak rss: %.0f MB%s, with child processes %.0f MB%s" % (
+        results["peak_rss_mb"], change(results["peak_rss_mb"], old("peak_rss_mb")),
+        results["peak_rss_total_mb"], change(results["peak_rss_total_mb"], old("peak_rss_total_mb"))
+    ))
+
+def _lookup(results, keys):
+    for key in keys:
+        if not isinstance(results, dict) or key not in results: return None
+        results = results[key]
+    return results
+
+if __name__ == '__main__':
+
+    parser = argparse.ArgumentParser(description = "Load test the bot end to end against local fake servers.")
+    parser.add_argument("--users", type = int, default = 50, help = "number of synthetic users")
+    parser.add_argument("--think", type = float, default = 2, help = "mean seconds a user waits between commands")
+    parser.add_argument("--duration", type = int, default = 60, help = "seconds the users keep sending commands")
+    parser.add_argument("--subscribers", type = int, default = 1000, help = "subscribers every tweet is fanned out to")
+    parser.add_argument("--tweets", type = int, default = 2, help = "tweets sent during the run")
+    parser.add_argument("--latency", type = float, default = 50, help = "mean milliseconds the fake bot api takes to answer")
+    parser.add_argument("--rate-limit", type = float, default = 0.01, help = "fraction of messages refused with a 429")
+    parser.add_argument("--workers", type = int, default = 0, help = "WORKERS setting of the bot")
+    parser.add_argument("--seed", type = int, default = 1, help = "seed of every random choice")
+    parser.add_argument("--pages", default = PAGES_DIR, help = "directory of the NTU pages to serve instead of the committed ones")
+    parser.add_argument("--save", help = "write the results as json to this file")
+    parser.add_argument("--compare", help = "compare with the results saved by a previous run")
+    arguments = parser.parse_args()
+
+    results = asyncio.get_event_loop().run_until_complete(LoadTest(arguments).run())
+    previous = None
+    if arguments.compare:
+        with open(arguments.compare) as previous_file:
+            previous = json.load(previous_file)
+    report(results, previous)
+    if arguments.save:
+        with open(arguments.save, 'w') as results_file:
+            json.dump(results, results_file, indent = 2)
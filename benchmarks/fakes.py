@@ -0,0 +1,343 @@
+'''
+Local fake servers for the end-to-end load test in bench_load.py: the Telegram
+Bot API, the NTU webcams, the NTU website and news hub (serving the pages in a
+directory), and the Twitter REST and streaming APIs. Each fake counts the
+requests it gets, and the fake Bot API hands every message the bot sends to
+its listeners so the load test can tell when a command was answered. Latency
+and rate limiting of the fake Bot API are drawn from a seeded random generator,
+so a run can be repeated.
+'''
+
+from aiohttp import web
+from collections import Counter
+
+import os
+import ssl
+import json
+import time
+import random
+import asyncio
+import itertools
+import subprocess
+
+SEND_METHODS = ["sendMessage", "sendPhoto", "sendDocument"] # methods which can be rate limited
+LONG_POLL = 1 # seconds a getUpdates call waits for new updates at most
+UPDATES_LIMIT = 100 # updates returned by one getUpdates call
+RETRY_AFTER = 1 # seconds the bot is asked to wait when rate limited
+CAMERA_PATH = "/upload/slider/"
+KEEP_ALIVE_INTERVAL = 5 # seconds between keep-alive newlines on the tweet stream
+STREAM_PADDING = b"\r\n" * 256 # keep-alive newlines after every tweet; tweepy reads the stream in blocks of 512 bytes
+HOST = "127.0.0.1"
+
+class FakeServer():
+
+    def __init__(self):
+
+        '''
+        Sets up an empty aiohttp application. Nothing is served until start().
+        '''
+
+        self.app = web.Application()
+        self.requests = Counter() # requests received per path or method
+        self.runner = None
+        self.port = None
+        self.url = None
+
+    async def start(self, port = 0, ssl_context = None):
+
+        '''
+        Async method which starts serving on the given port, or any free one.
+        Returns the base url of the server.
+
+        @param port: port to listen on; 0 for any free port
+        @param ssl_context: optional ssl.SSLContext to serve https with
+        '''
+
+        self.runner = web.AppRunner(self.app)
+        await self.runner.setup()
+        await web.TCPSite(self.runner, HOST, port, ssl_context = ssl_context).start()
+        self.port = self.runner.addresses[0][1]
+        self.url = "%s://%s:%d" % ("https" if ssl_context else "http", HOST, self.port)
+        return self.url
+
+    async def stop(self):
+        if self.runner is not None:
+            await self.runner.cleanup()
+
+class FakeBotApi(FakeServer):
+
+    def __init__(self, latency = 0, rate_limit = 0, seed = 0):
+
+        '''
+        Sets up a fake Bot API which serves queued updates through getUpdates
+        and accepts everything the bot sends.
+
+        @param latency: mean seconds taken to answer every method other than
+            getUpdates; each answer takes between half and one and a half times
+            as long
+        @param rate_limit: fraction of the messages sent which are refused with
+            a 429 error
+        @param seed: seed of the random generator drawing latencies and 429s
+        '''
+
+        super(FakeBotApi, self).__init__()
+        self.latency = latency
+        self.rate_limit = rate_limit
+        self.random = random.Random(seed)
+        self.listeners = [] # functions called with the method, parameters and arrival time of every message accepted
+        self.rate_limited = 0
+        self.polled = asyncio.Event() # set once the bot asks for updates
+        self._updates = []
+        self._new_updates = asyncio.Event()
+        self._update_ids = itertools.count(1)
+        self._message_ids = itertools.count(1)
+        self.app.router.add_route("*", "/bot{token}/{method}", self._handle)
+
+    def _add_update(self, kind, payload):
+
+        '''
+        Queues an update for the next getUpdates. Returns the time it was
+        queued.
+        '''
+
+        self._updates.append({"update_id": next(self._update_ids), kind: payload})
+        self._new_updates.set()
+        return time.monotonic()
+
+    def send_text(self, chat, text):
+
+        '''
+        Queues a message from a user. Returns the time it was queued.
+
+        @param chat: dictionary of the private chat of the user, with "id" and
+            "first_name"
+        @param text: text of the message, e.g. a command
+        '''
+
+        command_length = len(text.split(" ")[0]) if text.startswith("/") else 0
+        return self._add_update("message", {
+            "message_id": next(self._message_ids), "date": int(time.time()), "chat": chat,
+            "from": dict(chat, is_bot = False), "text": text,
+            "entities": [{"type": "bot_command", "offset": 0, "length": command_length}] if command_length else []
+        })
+
+    def click(self, chat, data):
+
+        '''
+        Queues a click of an inline keyboard button. Returns the time it was
+        queued.
+
+        @param chat: dictionary of the private chat of the user
+        @param data: callback data of the button
+        '''
+
+        return self._add_update("callback_query", {
+            "id": str(next(self._message_ids)), "from": dict(chat, is_bot = False), "chat_instance": str(chat["id"]),
+            "message": {"message_id": next(self._message_ids), "date": int(time.time()), "chat": chat, "text": ""},
+            "data": data
+        })
+
+    def _chat(self, chat_id):
+        if chat_id < 0:
+            return {"id": chat_id, "type": "group", "title": "Group " + str(-chat_id)}
+        return {"id": chat_id, "type": "private", "first_name": "User " + str(chat_id)}
+
+    async def _get_updates(self, offset, timeout):
+
+        '''
+        Async method which returns the updates from offset on, waiting a while
+        for new ones if there are none yet.
+        '''
+
+        self.polled.set()
+        self._updates = [update for update in self._updates if update["update_id"] >= offset]
+        if not self._updates and timeout > 0:
+            self._new_updates.clear()
+            try:
+                await asyncio.wait_for(self._new_updates.wait(), min(timeout, LONG_POLL))
+            except asyncio.TimeoutError:
+                pass
+        return self._updates[:UPDATES_LIMIT]
+
+    async def _handle(self, request):
+
+        '''
+        Async method which answers a Bot API call.
+        '''
+
+        method = request.match_info["method"]
+        params = dict(await request.post())
+        params.update(request.query)
+        self.requests[method] += 1
+
+        if method == "getUpdates":
+            result = await self._get_updates(int(params.get("offset", 0)), float(params.get("timeout", 0)))
+            return web.json_response({"ok": True, "result": result})
+
+        received = time.monotonic()
+        await asyncio.sleep(self.latency * self.random.uniform(0.5, 1.5))
+        if method in SEND_METHODS and self.random.random() < self.rate_limit:
+            self.rate_limited += 1
+            return web.json_response({
+                "ok": False, "error_code": 429, "description": "Too Many Requests: retry after " + str(RETRY_AFTER),
+                "parameters": {"retry_after": RETRY_AFTER}
+            }, status = 429)
+
+        result = True
+        if method in SEND_METHODS:
+            for listener in self.listeners:
+                listener(method, params, received)
+            message_id = next(self._message_ids)
+            result = {"message_id": message_id, "date": int(time.time()), "chat": self._chat(int(params["chat_id"]))}
+            if method == "sendMessage":
+                result["text"] = params.get("text", "")
+            elif method == "sendPhoto":
+                result["photo"] = [{"file_id": "photo-" + str(message_id), "file_unique_id": str(message_id), "width": 640, "height": 480}]
+            else:
+                result["document"] = {"file_id": "document-" + str(message_id), "file_unique_id": str(message_id)}
+        elif method == "getChat":
+            result = self._chat(int(params["chat_id"]))
+        elif method == "getMe":
+            result = {"id": 1, "is_bot": True, "first_name": "NTU_CampusBot", "username": "NTU_CampusBot"}
+        return web.json_response({"ok": True, "result": result})
+
+class FakeCamera(FakeServer):
+
+    def __init__(self, profile_dir, seed = 0):
+
+        '''
+        Sets up a fake webcam server which answers every location with one of
+        the profile images of that location, or of any location if it has none.
+
+        @param profile_dir: directory of the location profile images
+        @param seed: seed of the random generator picking the images
+        '''
+
+        super(FakeCamera, self).__init__()
+        self.random = random.Random(seed)
+        self.images = {}
+        for file_name in sorted(os.listdir(profile_dir)):
+            if not file_name.endswith(".jpg"): continue
+            with open(os.path.join(profile_dir, file_name), 'rb') as image_file:
+                self.images.setdefault(file_name.rsplit("_", 1)[0], []).append(image_file.read())
+        self.app.router.add_get(CAMERA_PATH + "{location}.jpg", self._handle)
+
+    @property
+    def base_url(self):
+        return self.url + CAMERA_PATH
+
+    async def _handle(self, request):
+        location = request.match_info["location"]
+        self.requests[location] += 1
+        images = self.images.get(location) or [image for images in self.images.values() for image in images]
+        return web.Response(body = self.random.choice(images), content_type = "image/jpeg")
+
+class FakeWebsite(FakeServer):
+
+    def __init__(self, pages, default_page):
+
+        '''
+        Sets up a fake website serving saved pages.
+
+        @param pages: dictionary of path to the html served there
+        @param default_page: html served at every other path
+        '''
+
+        super(FakeWebsite, self).__init__()
+        self.pages = pages
+        self.default_page = default_page
+        self.app.router.add_get("/{path:.*}", self._handle)
+
+    async def _handle(self, request):
+        self.requests[request.path] += 1
+        return web.Response(text = self.pages.get(request.path, self.default_page), content_type = "text/html")
+
+class FakeTwitter(FakeServer):
+
+    def __init__(self, accounts):
+
+        '''
+        Sets up a fake Twitter serving user lookups and the filter stream. Needs
+        to be served over https, as tweepy only speaks https.
+
+        @param accounts: screen names of the accounts that can tweet
+        '''
+
+        super(FakeTwitter, self).__init__()
+        self.users = {account.lower(): {"id": index + 1, "id_str": str(index + 1), "screen_name": account, "name": account}
+            for index, account in enumerate(accounts)}
+        self.connected = asyncio.Event() # set once the bot opens a stream
+        self._streams = []
+        self._tweet_ids = itertools.count(1)
+        self.app.router.add_route("*", "/1.1/users/lookup.json", self._lookup)
+        self.app.router.add_post("/1.1/statuses/filter.json", self._filter)
+
+    async def _lookup(self, request):
+        self.requests["lookup"] += 1
+        names = dict(await request.post()).get("screen_name") or request.query.get("screen_name", "")
+        return web.json_response([self.users[name.lower()] for name in names.split(",") if name.lower() in self.users])
+
+    async def _filter(self, request):
+
+        '''
+        Async method which keeps a stream open, sending keep-alive newlines
+        until the bot disconnects.
+        '''
+
+        self.requests["filter"] += 1
+        response = web.StreamResponse(headers = {"Content-Type": "application/json"})
+        response.enable_chunked_encoding()
+        await response.prepare(request)
+        self._streams.append(response)
+        self.connected.set()
+        try:
+            while True:
+                await response.write(b"\r\n")
+                await asyncio.sleep(KEEP_ALIVE_INTERVAL)
+        except ConnectionError:
+            pass
+        finally:
+            self._streams.remove(response)
+        return response
+
+    async def tweet(self, account, text):
+
+        '''
+        Async method which sends a new tweet down every open stream, length
+        delimited as tweepy expects and followed by enough keep-alive newlines
+        for tweepy to read it right away. Returns the number of streams it was
+        sent to.
+
+        @param account: screen name of the account tweeting
+        @param text: text of the tweet
+        '''
+
+        tweet_id = next(self._tweet_ids)
+        tweet = {
+            "id": tweet_id, "id_str": str(tweet_id), "text": text, "retweeted": False,
+            "created_at": time.strftime("%a %b %d %H:%M:%S +0000 %Y", time.gmtime()), "user": self.users[account.lower()]
+        }
+        data = (json.dumps(tweet) + "\r\n").encode("utf-8")
+        for stream in list(self._streams):
+            await stream.write(str(len(data)).encode("utf-8") + b"\r\n" + data + STREAM_PADDING)
+        return len(self._streams)
+
+def self_signed_context(directory):
+
+    '''
+    Creates a self-signed certificate for HOST with the openssl command line
+    tool. Returns an ssl.SSLContext serving it, and the path of the certificate
+    for clients to trust.
+
+    @param directory: directory to write the certificate and its key into
+    '''
+
+    cert_file = os.path.join(directory, "cert.pem")
+    key_file = os.path.join(directory, "key.pem")
+    subprocess.run([
+        "openssl", "req", "-x509", "-newkey", "rsa:2048", "-nodes", "-days", "1", "-subj", "/CN=" + HOST,
+        "-addext", "subjectAltName=IP:" + HOST, "-keyout", key_file, "-out", cert_file
+    ], check = True, stdout = subprocess.DEVNULL, stderr = subprocess.DEVNULL)
+    context = ssl.create_default_context(ssl.Purpose.CLIENT_AUTH)
+    context.load_cert_chain(cert_file, key_file)
+    return context, cert_file
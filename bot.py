@@ -4,20 +4,28 @@ to be sent. Other configurable parameters are written as constants which can
 easily be changed without affecting the logic of the bot.
 '''
 
-from bs4 import BeautifulSoup
+from telepot.aio.delegate import per_chat_id, create_open, pave_event_space, include_callback_query_chat_id
 from telepot.namedtuple import InlineKeyboardMarkup, InlineKeyboardButton
 from io import BytesIO
-from scipy import misc
-from urllib import request
-from skimage import measure
 
 import telepot
+import math
 import time
-import aiohttp
 import random
 import asyncio
+import camera
+import chats
 import commons
-import functools
+import counters
+import density
+import history
+import media
+import metrics
+import news
+import outbox
+import profiler
+import shuttle
+import subscribers
 
 VERSION = "1.2.0"
 AUTHORS = ['Clarence', 'Beiyi', 'Yuxin', 'Joel', 'Qixuan']
@@ -29,15 +37,18 @@ NTU_WEBSITE = "http://www.ntu.edu.sg/"
 SHUTTLE_BUS_URL = "has/Transportation/Pages/GettingAroundNTU.aspx"
 NEWS_HUB_URL = "http://news.ntu.edu.sg/Pages/NewsSummary.aspx?Category=news+releases"
 NEWS_COUNT = 5
+BUS_SERVICES_RETRY_DELAY = 5 * 60 # seconds
+PROFILE_DIR = "./profiles"
 
 HELP_MESSAGE = '''
 You can control this bot by sending these commands:
 
 /peek - get current screenshot of a location
 /news - get latest news from NTU News Hub
-/subscribe - subscribe to NTU's official twitter account feed
-/unsubscribe - unsubscribe from NTU's official twitter account feed
+/subscribe <account> - subscribe to an NTU twitter account feed
+/unsubscribe <account> - unsubscribe from an NTU twitter account feed
 /shuttle - get info about NTU internal shuttle bus routes
+/trend <location> - see how busy a location usually is
 /about - get info about this bot
 '''
 
@@ -72,16 +83,21 @@ Made with %s by:
 
 PEEK_MESSAGE = "Which location should I peek for you?"
 SHUTTLE_MESSAGE = "Get info about which shuttle bus service?"
+SHUTTLE_LOADING_MESSAGE = "Still loading shuttle bus services. Try again in a bit!"
 NEWS_WAIT_MESSAGE = "Fetching latest news. Please wait."
 INVALID_COMMAND_MESSAGE = "Say again? I didn't quite catch that."
-ALREADY_SUBSCRIBED_MESSAGE = "You are already subscribed to receive the latest tweets from NTU's official Twitter account! Wanna unsub? /unsubscribe"
-NOT_SUBSCRIBED_MESSAGE = "You are not subscribed to receive the latest tweets from NTU's official Twitter account! Wanna sub? /subscribe"
-SUCCESSFULLY_SUBSCRIBED = "Successfully subscribed to NTU's official Twitter account! Wanna unsub? /unsubscribe"
-SUCCESSFULLY_UNSUBSCRIBED = "Successfully unsubscribed from NTU's official Twitter account! Wanna sub back? /subscribe"
+ALREADY_SUBSCRIBED_MESSAGE = "You are already subscribed to receive the latest tweets from @%s! Wanna unsub? /unsubscribe %s"
+NOT_SUBSCRIBED_MESSAGE = "You are not subscribed to receive the latest tweets from %s! Wanna sub? /subscribe"
+SUCCESSFULLY_SUBSCRIBED = "Successfully subscribed to @%s! Wanna unsub? /unsubscribe %s"
+SUCCESSFULLY_UNSUBSCRIBED = "Successfully unsubscribed from %s! Wanna sub back? /subscribe"
+UNKNOWN_ACCOUNT_MESSAGE = "I can't follow that account. Try /subscribe followed by one of:\n%s"
+TREND_USAGE_MESSAGE = "Which location? Try /trend followed by one of:\n%s"
+TREND_NO_DATA_MESSAGE = "I haven't seen enough of %s yet. Try again later!"
 MAINTENANCE_MODE_MESSAGE = "NTU_CampusBot is currently under maintenance! We apologise for any inconvenience caused. Try again later? %s" % (u'\U0001F605')
 
 BUS_SERVICES = {}
-LOCATION_PROFILES = {}
+DENSITY_POOL = None
+TWITTER_ACCOUNTS = ["NTUsg"] # twitter accounts users can subscribe to; the first is the default
 LOCATIONS = {
     "Fastfood Level, Admin Cluster": "fastfood",
     "School of Art, Design and Media": "adm",
@@ -97,17 +113,19 @@ CALLBACK_COMMAND_BUS = "bus"
 LOCATIONS_KEYBOARD = None
 BUS_SERVICES_KEYBOARD = None
 
-def init():
+def init(read_only = False):
 
     '''
     Initializes locations and shuttle bus services keyboards. Also prepares
     profiles to be used for image comparison given the available profiles
     inside /profiles.
+
+    @param read_only: True in a process which must not write shared files,
+        e.g. a worker; the density history is then only read
     '''
 
-    global LOCATION_PROFILES
+    global DENSITY_POOL
     global LOCATIONS_KEYBOARD
-    global BUS_SERVICES_KEYBOARD
 
     # create keyboard for locations available
     LOCATIONS_KEYBOARD = InlineKeyboardMarkup(inline_keyboard = [
@@ -116,85 +134,140 @@ def init():
     ])
     commons.log(LOG_TAG, "locations keyboard ready")
 
-    # fetch bus services from URL
-    shuttle_bus_page = request.urlopen(NTU_WEBSITE + SHUTTLE_BUS_URL).read()
-    for service in BeautifulSoup(shuttle_bus_page, "html.parser").find_all("span", {"class": "route_label"}):
+    # start with the shuttle bus services from the last run; refreshed once the bot is serving
+    BUS_SERVICES.update(shuttle.load_cache() or {})
+    _build_bus_services_keyboard()
 
-        service_name = service.string.strip()
-        shuttle_bus_info_page = request.urlopen(NTU_WEBSITE + service.find_next_sibling("a")['href']).read()
-        shuttle_bus_route = ""
-        sub_routes = service.parent.find_all("strong")
+    # route images are sent by file id once telegram has them; drop the ones for images that changed
+    media.init()
+    if BUS_SERVICES: media.cache.retain(_bus_image_urls())
+    commons.log(LOG_TAG, "bus services keyboard ready (" + str(len(BUS_SERVICES)) + " cached)")
+
+    # start the density classifier workers, which load the profiles inside /profiles
+    DENSITY_POOL = density.DensityPool(PROFILE_DIR, LOCATIONS.values())
+    commons.log(LOG_TAG, "location profiles ready")
 
-        # workaround for inconsistent route layouting for campus rider service
-        if len(service.parent.find_all("span")) == 2: del sub_routes[-1]
+    # set up the news cache, which is warmed once the loop is running
+    news.init(NEWS_HUB_URL, NEWS_COUNT)
 
-        # function to get list of bus stops given a header
-        parse_bus_stops = lambda element: "\n".join([str(index + 1) + ". " + bus_stop.string for index, bus_stop in enumerate(element.find_next("ul").find_all("li"))])
+    # time every bot api call, by method
+    metrics.instrument_bot_api()
 
-        if len(sub_routes):
-            # combine all sub routes (as combination of the sub route header with its list) with other sub routes
-            shuttle_bus_route = "".join(["\n<b>" + sub_route.string + "</b>\n" + parse_bus_stops(sub_route) for sub_route in sub_routes])
-        else :
-            # just a list of bus stops without any sub route header
-            shuttle_bus_route = parse_bus_stops(service)
+    # set up the shared camera snapshot fetcher, recording every density result
+    history.init(read_only = read_only)
+    camera.init(CAM_BASE_IMAGE_URL, classify = DENSITY_POOL.classify, on_publish = history.record_snapshot)
+    commons.log(LOG_TAG, "camera fetcher ready")
 
-        BUS_SERVICES[service_name] = {
-            # scrape bus service image url
-            "image_url": BeautifulSoup(shuttle_bus_info_page, "html.parser").find("div", {"class": "img-caption"}).img['src'],
-            # bus route information
-            "info": "<b>%s</b>\n\n<b>ROUTE</b>\n%s" % (service_name.upper(), shuttle_bus_route)
-        }
+def _build_bus_services_keyboard():
+
+    '''
+    Creates the keyboard for the shuttle bus services currently available.
+    '''
 
-    # create keyboard for shuttle bus services available
+    global BUS_SERVICES_KEYBOARD
     BUS_SERVICES_KEYBOARD = InlineKeyboardMarkup(inline_keyboard = [
         [InlineKeyboardButton(text = key, callback_data = CALLBACK_COMMAND_BUS + ":" + key)] for key in BUS_SERVICES.keys()
     ])
-    commons.log(LOG_TAG, "bus services keyboard ready")
 
-    # profile all available locations
-    for location in LOCATIONS.values():
+def _bus_image_urls():
 
-        img_file_name = "./profiles/" + location + "_%s.jpg"
-        try:
+    '''
+    Returns the full urls of the route images of the current bus services.
+    '''
+
+    return [NTU_WEBSITE + service["image_url"] for service in BUS_SERVICES.values() if service["image_url"]]
+
+async def refresh_bus_services():
 
-            # transforms the images to arrays to be processed by scikit
-            LOCATION_PROFILES[location] = {
-                "full": misc.imread(img_file_name % ("full")),
-                "average": misc.imread(img_file_name % ("average")),
-                "empty": misc.imread(img_file_name % ("empty"))
-            }
+    '''
+    Async method which scrapes the shuttle bus services from the NTU website,
+    concurrently, and swaps them in along with a new keyboard. Keeps retrying
+    if the website cannot be reached. Returns the new services.
+    '''
+
+    while True:
+        try:
+            services = await shuttle.refresh(NTU_WEBSITE, SHUTTLE_BUS_URL)
+            break
         except Exception as e:
-            commons.log(LOG_TAG, "no profile found for " + location)
-    commons.log(LOG_TAG, "location profiles ready")
+            commons.log(LOG_TAG, "failed to refresh bus services (" + repr(e) + "), retrying in " + str(BUS_SERVICES_RETRY_DELAY) + "s")
+            await asyncio.sleep(BUS_SERVICES_RETRY_DELAY)
+
+    set_bus_services(services)
+    return services
 
-def _new_subscriber(id, name):
+def set_bus_services(services):
 
     '''
-    Performs the write operation for adding a subscriber.
+    Swaps in new shuttle bus services along with a new keyboard.
+
+    @param services: dictionary of service name to service details, as
+        returned by shuttle.refresh
+    '''
+
+    BUS_SERVICES.clear()
+    BUS_SERVICES.update(services)
+    _build_bus_services_keyboard()
+    media.cache.retain(_bus_image_urls())
+    commons.log(LOG_TAG, "bus services keyboard refreshed")
+
+async def warm_up():
+
+    '''
+    Async method which loads the dependencies deferred at startup, to be run
+    once the bot is already serving so that the first /peek or /trend does not
+    pay for them.
+    '''
+
+    # lazy modules must be loaded on the loop thread; see commons.lazy_import
+    commons.load_now("numpy")
+    await DENSITY_POOL.warm_up()
+    commons.log(LOG_TAG, "warmed up")
+
+def _find_account(name):
+
+    '''
+    Returns the account in TWITTER_ACCOUNTS matching name, ignoring case and a
+    leading @, or None if there is none.
+
+    @param name: twitter username as typed by the user
+    '''
+
+    name = name.strip().lstrip("@").lower()
+    return next((account for account in TWITTER_ACCOUNTS if account.lower() == name), None)
+
+def _new_subscriber(id, name, account):
+
+    '''
+    Performs the write operation for subscribing a chat to an account.
+    Returns False if the chat was already subscribed to it. Waits on the
+    storage (or on the ingress in a worker), so is run in the default executor.
 
     @param id: stringified unique user id as provided by telegram
     @param name: string to identify the user; can be first name, username or
         group chat name
+    @param account: twitter username from TWITTER_ACCOUNTS
     '''
 
-    subscribers = commons.get_data("subscribers")
-    subscribers[id] = name
-    commons.set_data("subscribers", subscribers)
-    commons.log(LOG_TAG, "new subscriber: " + name + "[" + id + "]")
+    if not subscribers.repository.subscribe(id, name, account): return False
+    commons.log(LOG_TAG, "new subscriber of " + account + ": " + name + "[" + id + "]")
+    return True
 
-def _remove_subscriber(id):
+def _remove_subscriber(id, account = None):
 
     '''
-    Performs the write operation for removing a subscriber.
-    TODO: add error handling for when user is not in the list of subscribers
+    Performs the write operation for unsubscribing a chat from an account, or
+    from every account. Returns False if the chat was not subscribed. Run in
+    the default executor, like _new_subscriber.
 
     @param id: stringified unique user id as provided by telegram
+    @param account: optional twitter username from TWITTER_ACCOUNTS
     '''
 
-    subscribers = commons.get_data("subscribers")
-    commons.log(LOG_TAG, "removing subscriber: " + subscribers[id] + "[" + id + "]")
-    del subscribers[id]
-    commons.set_data("subscribers", subscribers)
+    name = subscribers.repository.get_name(id)
+    if name is None or not subscribers.repository.unsubscribe(id, account): return False
+    commons.log(LOG_TAG, "removing subscriber of " + (account or "all accounts") + ": " + name + "[" + id + "]")
+    return True
 
 class NTUCampusBot(telepot.aio.helper.ChatHandler):
 
@@ -206,57 +279,33 @@ class NTUCampusBot(telepot.aio.helper.ChatHandler):
 
         super(NTUCampusBot, self).__init__(*args, **kwargs)
 
-    def _send_news(self, chat, future):
+    async def _get_chat(self):
 
         '''
-        Retrieve news from NTU News Hub and send to user.
-
-        @param chat: dictionary containing information about the chat between
-            bot and the user/group; see https://core.telegram.org/bots/api#chat
-            for more information
-        @param future: object containing results of async call to retrieve
-            the page source
+        Async method which returns the chat of this handler. Comes from the
+        chat cache, which is filled from incoming updates, so Telegram is only
+        asked when the chat is unknown or stale.
         '''
 
-        soup = BeautifulSoup(future.result(), "html.parser")
-        next_news = soup.find_all("div", {"class": "ntu_news_summary_title_first"})[0]
-        for i in range(NEWS_COUNT):
-            news_title = next_news.a.string.strip().title()
-            news_link = next_news.a['href']
-            news_date = next_news.next_sibling.string
-
-            news_message = "<b>%s</b>\n<a href='%s'>%s</a>" % (news_date, news_link, news_title)
-            asyncio.ensure_future(self.sender.sendMessage(news_message, parse_mode = 'HTML'))
-
-            next_news = next_news.find_next_sibling("div", {"class": "ntu_news_summary_title"})
+        return await chats.resolve(self.chat_id, self.administrator.getChat)
 
-        future.remove_done_callback(self._send_news)
-        self._log("sent " + str(NEWS_COUNT) + " news items", chat)
-
-    def _log(self, message, chat):
+    def _log(self, message, chat, event, level = commons.INFO, **fields):
 
         '''
-        Formatted logging to include chat context.
+        Formatted logging to include chat context. The chat is only put into
+        the message if the record is written.
 
         @param message: the message to be logged
         @param chat: dictionary containing information about the chat between
             bot and the user/group; see https://core.telegram.org/bots/api#chat
             for more information
+        @param event: what happened, e.g. "chat" or "callback"
+        @param level: level of the record
+        @param fields: further structured fields of the record, e.g. duration
         '''
 
-        sender = chat['title' if 'title' in chat else ('username' if 'username' in chat else 'first_name')]
-        commons.log(LOG_TAG, "[" + sender + ":" + str(chat['id']) + "] " + message)
-
-    async def _load_url(self, url):
-
-        '''
-        Async method to load a url as text.
-
-        @param url: string url to load
-        '''
-
-        response = await aiohttp.get(url)
-        return (await response.text())
+        commons.log(LOG_TAG, lambda: "[" + chats.display_name(chat) + ":" + str(chat['id']) + "] " + message,
+            level, chat_id = chat['id'], event = event, **fields)
 
     async def _start(self, is_admin, payload = None):
 
@@ -302,21 +351,24 @@ class NTUCampusBot(telepot.aio.helper.ChatHandler):
     async def _news(self, is_admin, payload = None):
 
         '''
-        Async method to handle /news calls. Asynchronously retrieves the news
-        page source and sends a configured number of most recent articles to
-        the user.
+        Async method to handle /news calls. Sends a configured number of most
+        recent articles to the user from the news cache. The user is only asked
+        to wait if the news has not been fetched even once yet.
 
         @param is_admin: boolean to determine if user is admin
         @param payload: optional string that follows the user's command
         '''
 
-        await self.sender.sendMessage(NEWS_WAIT_MESSAGE)
-        chat = await self.administrator.getChat()
+        if not news.cache.is_warm():
+            await self.sender.sendMessage(NEWS_WAIT_MESSAGE)
+        chat = await self._get_chat()
+
+        news_items = await news.cache.get()
+        for news_item in news_items:
+            news_message = "<b>%s</b>\n<a href='%s'>%s</a>" % (news_item.date, news_item.link, news_item.title)
+            await self.sender.sendMessage(news_message, parse_mode = 'HTML')
 
-        # async fetch the page source so user won't be blocked while this is in progress
-        future = asyncio.ensure_future(self._load_url(NEWS_HUB_URL))
-        # set this as callback once the page is ready
-        future.add_done_callback(functools.partial(self._send_news, chat))
+        self._log("sent " + str(len(news_items)) + " news items", chat, "news")
 
     async def _about(self, is_admin, payload = None):
 
@@ -336,94 +388,218 @@ class NTUCampusBot(telepot.aio.helper.ChatHandler):
     async def _subscribe(self, is_admin, payload = None):
 
         '''
-        Async method to handle /subscribe calls. Adds user to list of
-        subscribers. Returns a success message if user successfully registers
-        and an error message if user fails to subscribe, that is, when user is
-        already subscribed.
+        Async method to handle /subscribe calls. Subscribes user to the tweets
+        of the account named in the payload, or of the default account if none
+        is given. Returns a success message if user successfully registers and
+        an error message if user fails to subscribe, that is, when user is
+        already subscribed or the account is not one that can be followed.
 
         @param is_admin: boolean to determine if user is admin
-        @param payload: optional string that follows the user's command
+        @param payload: optional twitter username that follows the user's command
         '''
 
-        chat = await self.administrator.getChat()
+        account = _find_account(payload) if payload else TWITTER_ACCOUNTS[0]
+        if account is None:
+            await self.sender.sendMessage(UNKNOWN_ACCOUNT_MESSAGE % "\n".join("@" + account for account in TWITTER_ACCOUNTS))
+            return
+
+        chat = await self._get_chat()
         chat_id = str(chat['id'])
 
-        if chat_id not in commons.get_data("subscribers"):
-            sender = chat['title' if 'title' in chat else ('username' if 'username' in chat else 'first_name')]
-            _new_subscriber(chat_id, sender)
-            await self.sender.sendMessage(SUCCESSFULLY_SUBSCRIBED)
+        subscribed = await asyncio.get_event_loop().run_in_executor(None, _new_subscriber, chat_id, chats.display_name(chat), account)
+        if subscribed:
+            await self.sender.sendMessage(SUCCESSFULLY_SUBSCRIBED % (account, account))
         else:
-            await self.sender.sendMessage(ALREADY_SUBSCRIBED_MESSAGE)
+            await self.sender.sendMessage(ALREADY_SUBSCRIBED_MESSAGE % (account, account))
 
     async def _unsubscribe(self, is_admin, payload = None):
 
         '''
-        Async method to handle /unsubscribe calls. Removes user from list of
-        subscribers. Returns a success message if user successfully unregisters
-        and an error message if user fails to unsubscribe, that is, when user is
-        not even subscribed.
+        Async method to handle /unsubscribe calls. Unsubscribes user from the
+        account named in the payload, or from every account if none is given.
+        Returns a success message if user successfully unregisters and an error
+        message if user fails to unsubscribe, that is, when user is not even
+        subscribed.
 
         @param is_admin: boolean to determine if user is admin
-        @param payload: optional string that follows the user's command
+        @param payload: optional twitter username that follows the user's command
         '''
 
-        chat = await self.administrator.getChat()
+        account = _find_account(payload) if payload else None
+        if payload and account is None:
+            await self.sender.sendMessage(UNKNOWN_ACCOUNT_MESSAGE % "\n".join("@" + account for account in TWITTER_ACCOUNTS))
+            return
+
+        chat = await self._get_chat()
         chat_id = str(chat['id'])
 
-        if chat_id in commons.get_data("subscribers"):
-            _remove_subscriber(chat_id)
-            await self.sender.sendMessage(SUCCESSFULLY_UNSUBSCRIBED)
+        unsubscribed = await asyncio.get_event_loop().run_in_executor(None, _remove_subscriber, chat_id, account)
+        if unsubscribed:
+            await self.sender.sendMessage(SUCCESSFULLY_UNSUBSCRIBED % ("@" + account if account else "all accounts"))
         else:
-            await self.sender.sendMessage(NOT_SUBSCRIBED_MESSAGE)
+            await self.sender.sendMessage(NOT_SUBSCRIBED_MESSAGE % ("@" + account if account else "any account"))
 
     async def _shuttle(self, is_admin, payload = None):
 
         '''
         Async method to handle /shuttle calls. Sends the shuttle bus information
-        keyboard for user to select bus service.
+        keyboard for user to select bus service, unless the services have not
+        been loaded yet.
 
         @param is_admin: boolean to determine if user is admin
         @param payload: optional string that follows the user's command
         '''
 
         global BUS_SERVICES_KEYBOARD
+        if not BUS_SERVICES:
+            await self.sender.sendMessage(SHUTTLE_LOADING_MESSAGE)
+            return
         await self.sender.sendMessage(SHUTTLE_MESSAGE, reply_markup = BUS_SERVICES_KEYBOARD)
 
+    async def _trend(self, is_admin, payload = None):
+
+        '''
+        Async method to handle /trend calls. Sends how busy a location usually
+        is by hour of day and by day of week, based on the recorded density
+        history. Sends the list of locations if payload does not name one.
+
+        @param is_admin: boolean to determine if user is admin
+        @param payload: name of the location; may be partial and in any case
+        '''
+
+        profiled = [name for name, location in LOCATIONS.items() if location in DENSITY_POOL.locations]
+        matches = [name for name in profiled if payload and payload.strip().lower() in name.lower()]
+        if not matches:
+            await self.sender.sendMessage(TREND_USAGE_MESSAGE % "\n".join(profiled))
+            return
+
+        name = matches[0]
+        by_hour, by_day, samples = history.store.aggregate(LOCATIONS[name])
+        if not samples:
+            await self.sender.sendMessage(TREND_NO_DATA_MESSAGE % name)
+            return
+
+        # one bar per hour/day that has data, ten blocks for a full crowd
+        bar = lambda value: ("\u2588" * int(round(value * 10))).ljust(10) + " %3d%%" % round(value * 100)
+        message = "<b>%s</b>\n<i>based on %d snapshots</i>\n\n<b>BY HOUR</b>\n" % (name, samples)
+        message += "\n".join(["<code>%02d:00 %s</code>" % (hour, bar(value)) for hour, value in enumerate(by_hour) if not math.isnan(value)])
+        message += "\n\n<b>BY DAY</b>\n"
+        message += "\n".join(["<code>%s   %s</code>" % (history.DAYS[day], bar(value)) for day, value in enumerate(by_day) if not math.isnan(value)])
+        await self.sender.sendMessage(message, parse_mode = 'HTML')
+
     async def _broadcast(self, is_admin, payload):
 
         '''
         Async method to handle /broadcast calls from administrators. Sends a
-        broadcasted message to all subscribers.
+        broadcasted message to all subscribers in the background and reports
+        back to the administrator once delivery is complete.
 
         @param is_admin: boolean to determine if user is admin
         @param payload: required string that follows the user's command
         '''
 
         if payload and is_admin:
-            for subscriber_id in commons.get_data("subscribers").keys():
-                await self.bot.sendMessage(int(subscriber_id), payload)
+            await self.sender.sendMessage("Broadcasting to " + str(subscribers.repository.count()) + " subscribers.")
+            asyncio.ensure_future(self._deliver_broadcast(payload))
         else:
             raise ValueError("unauthorised")
 
+    async def _deliver_broadcast(self, payload):
+
+        '''
+        Async method which fans the broadcast out to all subscribers and sends
+        the delivery report to the administrator who requested it.
+
+        @param payload: the message to be broadcasted
+        '''
+
+        report = await outbox.send(payload, name = "broadcast")
+        await self.bot.sendMessage(self.chat_id, "Broadcast complete. " + str(report))
+
     async def _stats(self, is_admin, payload = None):
 
         '''
         Async method to handle /stats calls from administrators. Sends a
         statistical count of the number of times commands were called and the
-        number of times tweets were sent.
+        number of times tweets were sent, along with the counts for the last
+        hour and the last day.
 
         @param is_admin: boolean to determine if user is admin
         @param payload: optional string that follows the user's command
         '''
 
         if is_admin:
-            statistics = commons.get_data("stats")
+            statistics = counters.totals()
             message = "NTU_CampusBot Statistics:\n" + ("=" * 25) + "\n\n"
-            message += "\n".join([key + ": " + str(statistics[key]) for key in statistics.keys()])
+            message += "\n".join([
+                key + ": " + str(statistics[key]) + " (" + ", ".join([
+                    window + ": " + str(counters.windowed(key, seconds)) for window, seconds in counters.WINDOWS
+                ]) + ")"
+                for key in statistics.keys()
+            ])
+            jobs = outbox.status()
+            if jobs:
+                message += "\n\nOutbox:\n" + "\n".join(jobs)
             await self.sender.sendMessage(message)
         else:
             raise ValueError("unauthorised")
 
+    async def _metrics(self, is_admin, payload = None):
+
+        '''
+        Async method to handle /metrics calls from administrators. Sends the
+        number of calls, mean and estimated p50/p99 latency of every command,
+        of every phase of handling one, and of every Bot API method, along
+        with the event loop lag.
+
+        @param is_admin: boolean to determine if user is admin
+        @param payload: optional string that follows the user's command
+        '''
+
+        if is_admin:
+            message = "NTU_CampusBot Metrics:\n" + ("=" * 25) + "\n(calls, mean, p50, p99)\n\n"
+            await self.sender.sendMessage(message + (metrics.summary() or "Nothing measured yet."))
+        else:
+            raise ValueError("unauthorised")
+
+    async def _profile(self, is_admin, payload = None):
+
+        '''
+        Async method to handle /profile calls from administrators. Samples the
+        stacks of every thread in this process for the given number of seconds
+        and sends them as a collapsed stack document for a flame graph. Sends
+        the stacks recorded by the event loop watchdog instead if the payload is
+        'stalls'.
+
+        @param is_admin: boolean to determine if user is admin
+        @param payload: optional number of seconds, or 'stalls'
+        '''
+
+        if is_admin:
+            stalls = profiler.stalls()
+            if payload == "stalls":
+                if not stalls:
+                    await self.sender.sendMessage("No stalls recorded.")
+                    return
+                document = "\n".join(
+                    time.strftime("%d %b %H:%M:%S", time.localtime(timestamp)) + " - held up for over " + str(round(blocked, 2)) + "s\n" + stack
+                    for timestamp, blocked, stack in stalls
+                )
+                await self.sender.sendDocument(("stalls.txt", BytesIO(document.encode("utf-8"))))
+                return
+
+            seconds = float(payload) if payload else profiler.DEFAULT_SECONDS
+            if not math.isfinite(seconds) or seconds <= 0: raise ValueError("invalid duration")
+            seconds = min(seconds, profiler.MAX_SECONDS)
+            await self.sender.sendMessage("Profiling for " + str(seconds) + "s...")
+            sampler = await profiler.profile(seconds)
+            await self.sender.sendDocument(
+                ("profile-" + time.strftime("%Y%m%d-%H%M%S") + ".txt", BytesIO(sampler.collapsed().encode("utf-8"))),
+                caption = str(sampler.samples) + " samples over " + str(seconds) + "s. " + str(len(stalls)) + " recent stalls, see /profile stalls"
+            )
+        else:
+            raise ValueError("unauthorised")
+
     async def _subscribers(self, is_admin, payload = None):
 
         '''
@@ -436,9 +612,8 @@ class NTUCampusBot(telepot.aio.helper.ChatHandler):
         '''
 
         if is_admin:
-            subscribers = commons.get_data("subscribers")
             message = "NTU_CampusBot Subscribers:\n" + ("=" * 25) + "\n\n"
-            message += "\n".join(subscribers.values())
+            message += "\n".join(subscribers.repository.iter_names())
             await self.sender.sendMessage(message)
         else:
             raise ValueError("unauthorised")
@@ -483,8 +658,10 @@ class NTUCampusBot(telepot.aio.helper.ChatHandler):
         command, _, payload = message['text'][1:].partition(" ")
         command = command.split("@")[0]
 
-        chat = await self.administrator.getChat()
-        self._log("chat: " + message['text'], chat)
+        chats.remember_update(message)
+        with metrics.timer("phase_seconds", phase = "get_chat"):
+            chat = await self._get_chat()
+        self._log("chat: " + message['text'], chat, "chat")
         is_admin = chat['id'] in commons.get_data("admins")
 
         maintenance_mode = commons.get_data("status") == "maintenance"
@@ -494,15 +671,15 @@ class NTUCampusBot(telepot.aio.helper.ChatHandler):
 
             try:
                 command_call = getattr(self, "_" + command)
-                await command_call(is_admin, payload)
+                with metrics.timer("command_seconds", command = command) as timer:
+                    await command_call(is_admin, payload)
+                self._log("handled /" + command, chat, "command", commons.DEBUG, duration = timer.seconds)
 
                 # increment command stats count
-                stats = commons.get_data("stats")
-                stats[command] = (0 if command not in stats else int(stats[command])) + 1
-                commons.set_data("stats", stats)
+                counters.increment(command)
 
             except Exception as e:
-                print(e)
+                self._log("failed to handle /" + command + " (" + repr(e) + ")", chat, "command", commons.WARNING)
                 await self.sender.sendMessage(INVALID_COMMAND_MESSAGE)
 
     async def on_callback_query(self, message):
@@ -520,43 +697,45 @@ class NTUCampusBot(telepot.aio.helper.ChatHandler):
         command = message_payload[0]
         parameter = message_payload[1]
 
-        chat = await self.administrator.getChat()
-        self._log("callback - " + message['data'], chat)
+        started = time.perf_counter()
+        chats.remember_update(message)
+        with metrics.timer("phase_seconds", phase = "get_chat"):
+            chat = await self._get_chat()
+        self._log("callback - " + message['data'], chat, "callback")
 
         await self.bot.answerCallbackQuery(callback_id, text = 'Fetching data. Please wait.')
-        image_url = ""
+        photo = None
         response_message = ""
 
         # if callback was called as a result of user clicking on bus shuttle services keyboard
         if (command == CALLBACK_COMMAND_BUS):
-            image_url = NTU_WEBSITE + BUS_SERVICES[parameter]["image_url"]
+            # some services have no route image; their info is sent on its own
+            image_url = BUS_SERVICES[parameter]["image_url"]
+            photo = NTU_WEBSITE + image_url if image_url else None
             response_message = BUS_SERVICES[parameter]["info"]
         else: # if callback was called as a result of user clicking on locations keyboard
             location = LOCATIONS[parameter]
-            image_url = CAM_BASE_IMAGE_URL + location + ".jpg?rand=" + str(time.time())
-            response_message = time.strftime("%a, %d %b %y") + " - <b>" + parameter + "</b>"
-
-            # if location has a profile (because not all may have a profile)
-            if location in LOCATION_PROFILES:
-
-                # read the current screenshot from the URL as a file
-                image_file = BytesIO(request.urlopen(image_url).read())
-                image = misc.imread(image_file)
 
-                # set default profile to average
-                matching_profile = ("average", measure.compare_mse(image, LOCATION_PROFILES[location]["average"]))
-                profiles = [key for key in LOCATION_PROFILES[location].keys()]
-                if "average" in profiles: profiles.remove("average") # remove this from profiles to be compared with as it is already the default
-                for profile in profiles:
-                    # calculate the mse between the profile and the current image
-                    mse = measure.compare_mse(image, LOCATION_PROFILES[location][profile])
-                    # set this as the profile with most resemblance if the mse is lower than the current set
-                    if mse < matching_profile[1]: matching_profile = (profile, mse)
+            # served by the background poller if running, otherwise shared with
+            # any other user peeking at the same location right now
+            snapshot = await camera.fetcher.snapshot(location)
+            response_message = time.strftime("%a, %d %b %y", time.localtime(snapshot.timestamp)) + " - <b>" + parameter + "</b>"
+            if snapshot.density:
+                response_message += "\nApproximated crowd density: <b>" + snapshot.density.upper() + "</b>"
 
-                response_message += "\nApproximated crowd density: <b>" + matching_profile[0].upper() + "</b>"
+            # upload the bytes we already have instead of making telegram fetch the camera again
+            photo = (location + ".jpg", BytesIO(snapshot.image))
 
         await self.sender.sendMessage(response_message, parse_mode='HTML')
-        asyncio.ensure_future(self.sender.sendPhoto(image_url))
+        seconds = time.perf_counter() - started
+        metrics.observe("command_seconds", seconds, command = CALLBACK_COMMAND_BUS if command == CALLBACK_COMMAND_BUS else CALLBACK_COMMAND_LOCATION)
+        self._log("answered callback - " + message['data'], chat, "callback", commons.DEBUG, duration = seconds)
+        if (command == CALLBACK_COMMAND_BUS):
+            # telegram only downloads each route image once; after that it is sent by file id
+            if photo is not None:
+                asyncio.ensure_future(media.cache.send_photo(self.sender, photo))
+        else:
+            asyncio.ensure_future(self.sender.sendPhoto(photo))
 
     async def on__idle(self, event):
 
@@ -566,6 +745,20 @@ class NTUCampusBot(telepot.aio.helper.ChatHandler):
         @param event: string information about the event.
         '''
 
-        chat = await self.administrator.getChat()
-        self._log("session expired", chat)
+        chat = await self._get_chat()
+        self._log("session expired", chat, "session_expired")
         self.close()
+
+def create_delegator(token):
+
+    '''
+    Returns a DelegatorBot which hands every chat to its own NTUCampusBot.
+
+    @param token: telegram bot token
+    '''
+
+    return telepot.aio.DelegatorBot(token, [
+        include_callback_query_chat_id(pave_event_space()) (
+            per_chat_id(), create_open, NTUCampusBot, timeout = 10
+        )
+    ])
@@ -0,0 +1,156 @@
+'''
+This file contains the camera snapshot fetcher used by /peek. Snapshots are
+downloaded asynchronously through http_client and kept for a short
+time per location, together with their crowd density, so that users tapping the
+same location at the same time share one download and one density computation.
+Need to call init() before use.
+'''
+
+from collections import namedtuple
+
+import time
+import asyncio
+import commons
+import metrics
+import http_client
+
+SNAPSHOT_TTL = 15 # seconds a snapshot is reused before fetching a new one
+FETCH_TIMEOUT = 10 # seconds
+MAX_IMAGE_SIZE = 2 * 1024 * 1024 # bytes
+LOG_TAG = "camera"
+
+Snapshot = namedtuple("Snapshot", ["location", "image", "density", "scores", "timestamp"])
+
+fetcher = None
+
+class CameraFetcher():
+
+    def __init__(self, base_url, classify = None, ttl = SNAPSHOT_TTL, on_publish = None):
+
+        '''
+        Sets up a fetcher for the cameras under base_url.
+
+        @param base_url: url prefix of the camera images
+        @param classify: optional coroutine function taking (location, image
+            bytes) and returning (density label, scores), or None if the
+            location has no profile
+        @param ttl: number of seconds a snapshot is reused for
+        @param on_publish: optional function called with every new snapshot
+        '''
+
+        self.base_url = base_url
+        self.classify = classify
+        self.ttl = ttl
+        self.on_publish = on_publish
+        self._snapshots = {}
+        self._inflight = {}
+
+    async def download(self, location):
+
+        '''
+        Async method which downloads the current image of a location.
+
+        @param location: camera name as found in bot.LOCATIONS
+        '''
+
+        url = self.base_url + location + ".jpg?rand=" + str(time.time())
+        response = await http_client.get(url, timeout = FETCH_TIMEOUT, max_size = MAX_IMAGE_SIZE)
+        return response.body
+
+    def publish(self, location, image, result, timestamp = None):
+
+        '''
+        Stores a classified image as the latest snapshot of a location.
+
+        @param location: camera name as found in bot.LOCATIONS
+        @param image: bytes of the image
+        @param result: (density label, scores), or None if not classified
+        @param timestamp: optional time the image was taken; defaults to now
+        '''
+
+        density, scores = result if result else (None, None)
+        snapshot = Snapshot(location, image, density, scores, timestamp if timestamp else time.time())
+        self._snapshots[location] = snapshot
+        if self.on_publish: self.on_publish(snapshot)
+        return snapshot
+
+    def adopt(self, snapshot):
+
+        '''
+        Stores a snapshot published by another process as the latest of its
+        location, without passing it to on_publish again.
+
+        @param snapshot: Snapshot as published by the other process
+        '''
+
+        self._snapshots[snapshot.location] = snapshot
+
+    async def _fetch(self, location):
+
+        '''
+        Async method which downloads the current image of a location and
+        computes its crowd density.
+
+        @param location: camera name as found in bot.LOCATIONS
+        '''
+
+        timestamp = time.time()
+        with metrics.timer("phase_seconds", phase = "camera_fetch"):
+            image = await self.download(location)
+        with metrics.timer("phase_seconds", phase = "classify"):
+            result = (await self.classify(location, image)) if self.classify else None
+        return self.publish(location, image, result, timestamp)
+
+    def cached(self, location, max_age = None):
+
+        '''
+        Returns the latest snapshot of a location if it is younger than max_age
+        seconds, otherwise None.
+
+        @param location: camera name as found in bot.LOCATIONS
+        @param max_age: optional maximum age; defaults to the fetcher's ttl
+        '''
+
+        snapshot = self._snapshots.get(location)
+        if snapshot and time.time() - snapshot.timestamp <= (self.ttl if max_age is None else max_age):
+            return snapshot
+        return None
+
+    async def snapshot(self, location, max_age = None):
+
+        '''
+        Async method which returns a recent snapshot of a location. Concurrent
+        calls for a location without a fresh snapshot wait on the same fetch.
+
+        @param location: camera name as found in bot.LOCATIONS
+        @param max_age: optional maximum age of a cached snapshot; defaults to
+            the fetcher's ttl
+        '''
+
+        snapshot = self.cached(location, max_age)
+        if snapshot: return snapshot
+
+        future = self._inflight.get(location)
+        if future is None:
+            future = asyncio.ensure_future(self._fetch(location))
+            self._inflight[location] = future
+            future.add_done_callback(lambda done: self._inflight.pop(location, None))
+
+        # shielded so that one impatient caller cannot cancel everyone's fetch
+        return await asyncio.shield(future)
+
+def init(base_url, classify = None, ttl = SNAPSHOT_TTL, on_publish = None):
+
+    '''
+    Creates the shared camera fetcher.
+
+    @param base_url: url prefix of the camera images
+    @param classify: optional coroutine function taking (location, image
+        bytes) and returning (density label, scores)
+    @param ttl: number of seconds a snapshot is reused for
+    @param on_publish: optional function called with every new snapshot
+    '''
+
+    global fetcher
+    fetcher = CameraFetcher(base_url, classify, ttl, on_publish)
+    return fetcher
@@ -0,0 +1,124 @@
+'''
+This file contains the chat metadata cache. Every update Telegram sends already
+carries the chat it belongs to, so handlers read the chat from here instead of
+asking Telegram with getChat; the API is only called for a chat which has not
+been seen in an update yet, is missing its name, or has not been refreshed for
+a long time.
+'''
+
+from collections import OrderedDict
+
+import time
+
+STALE_AFTER = 24 * 60 * 60 # seconds before a chat not seen in any update is fetched again
+MAX_CHATS = 10000 # least recently seen chats are dropped beyond this
+NAME_FIELDS = ["title", "username", "first_name"] # in order of preference
+
+def display_name(chat):
+
+    '''
+    Returns the name used to identify a chat: its title for groups, otherwise
+    the username or first name of the user.
+
+    @param chat: dictionary containing information about the chat; see
+        https://core.telegram.org/bots/api#chat for more information
+    '''
+
+    return next((chat[field] for field in NAME_FIELDS if field in chat), str(chat.get('id')))
+
+class ChatCache():
+
+    def __init__(self, stale_after = STALE_AFTER, max_chats = MAX_CHATS):
+
+        '''
+        Sets up an empty cache.
+
+        @param stale_after: number of seconds a cached chat is trusted for
+        @param max_chats: maximum number of chats kept
+        '''
+
+        self.stale_after = stale_after
+        self.max_chats = max_chats
+        self._chats = OrderedDict() # chat id to (chat, time it was seen)
+
+    def remember(self, chat):
+
+        '''
+        Stores the latest known state of a chat.
+
+        @param chat: chat dictionary from an update or from getChat
+        '''
+
+        self._chats[chat['id']] = (chat, time.time())
+        self._chats.move_to_end(chat['id'])
+        while len(self._chats) > self.max_chats:
+            self._chats.popitem(last = False)
+
+    def remember_update(self, message):
+
+        '''
+        Stores the chat carried by an incoming message or callback query.
+
+        @param message: message or callback query dictionary as received
+        '''
+
+        if 'chat' in message:
+            self.remember(message['chat'])
+        elif 'chat' in message.get('message', {}):
+            self.remember(message['message']['chat'])
+
+    def get(self, chat_id):
+
+        '''
+        Returns the cached chat, or None if it is unknown, has no name, or is
+        stale.
+
+        @param chat_id: unique chat id as provided by telegram
+        '''
+
+        entry = self._chats.get(chat_id)
+        if entry is None: return None
+        chat, seen = entry
+        if time.time() - seen > self.stale_after or not any(field in chat for field in NAME_FIELDS):
+            return None
+        return chat
+
+    async def resolve(self, chat_id, fetch):
+
+        '''
+        Async method which returns the chat from the cache, or fetches and
+        caches it if the cache cannot answer.
+
+        @param chat_id: unique chat id as provided by telegram
+        @param fetch: coroutine function returning the chat, e.g. getChat
+        '''
+
+        chat = self.get(chat_id)
+        if chat is None:
+            chat = await fetch()
+            self.remember(chat)
+        return chat
+
+_cache = ChatCache()
+
+def remember_update(message):
+
+    '''
+    Stores the chat carried by an incoming message or callback query.
+
+    @param message: message or callback query dictionary as received
+    '''
+
+    _cache.remember_update(message)
+
+async def resolve(chat_id, fetch):
+
+    '''
+    Async method which returns the chat, calling fetch only if the cache
+    cannot answer.
+
+    @param chat_id: unique chat id as provided by telegram
+    @param fetch: coroutine function returning the chat, e.g. getChat
+    '''
+
+    return await _cache.resolve(chat_id, fetch)
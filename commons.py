@@ -1,28 +1,182 @@
 '''
 This file contains the common methods shared between all other components. Uses
 standard setter/getter to access shared data storage.
+
+The save file is only read once; after that, every get_data/set_data call is
+served from memory. Changed keys are marked dirty and written back in batches by
+a background flusher, either every FLUSH_INTERVAL seconds or on shutdown. The
+file is always replaced atomically (write to temp file, then rename) so a crash
+mid-write can never leave a truncated save file behind.
+
+A process which must not write the save file (such as a worker process, see
+workers.py) can make the store read-only: changes are then kept in memory only.
+
+Logging only queues a record, which is written in the background; see logs.py.
 '''
 
+import atexit
 import json
 import os
+import sys
+import tempfile
+import threading
+import importlib.util
+import logs
 
 SAVE_FILE_NAME = "save_data.json"
+FLUSH_INTERVAL = 5 # seconds between write-behind flushes
 LOG_TAG = "commons"
+DEBUG, INFO, WARNING, ERROR = logs.DEBUG, logs.INFO, logs.WARNING, logs.ERROR
+
+class StateStore():
+
+    def __init__(self, file_name, flush_interval = FLUSH_INTERVAL):
+
+        '''
+        Sets up an in-memory view of a JSON save file with write-behind
+        persistence.
+
+        @param file_name: path to the JSON save file
+        @param flush_interval: number of seconds between background flushes
+        '''
+
+        self.file_name = file_name
+        self.flush_interval = flush_interval
+        self._data = None
+        self._dirty = set()
+        self._lock = threading.RLock()
+        self._flush_lock = threading.Lock()
+        self._stopping = threading.Event()
+        self._flusher = None
+        self.read_only = False
+        self.listeners = []
+
+    def _load(self):
+
+        '''
+        Reads the save file into memory. Called once, on first access.
+        '''
+
+        if self._data is None:
+            with open(self.file_name, 'r') as save_file:
+                self._data = json.load(save_file)
+
+    def get(self, key = None):
+
+        '''
+        Returns the entire document, or only the value stored under key. The
+        returned objects are the live in-memory values and may be serialized by
+        the flusher at any time, so treat them as read-only and pass a new value
+        to set() instead of changing them in place.
+
+        @param key: optional key to extract a specific value
+        '''
+
+        with self._lock:
+            self._load()
+            return (self._data if not key else self._data[key])
+
+    def set(self, key, value):
+
+        '''
+        Stores value under key in memory and marks the key dirty so that the
+        next flush writes it out.
+
+        @param key: unique key to store the value with
+        @param value: the value you want to store in the storage
+        '''
+
+        with self._lock:
+            self._load()
+            self._data[key] = value
+            if not self.read_only: self._dirty.add(key)
+        for listener in self.listeners:
+            listener(key, value)
+        self.start()
+
+    def flush(self):
+
+        '''
+        Writes the document to disk if any key has changed since the last
+        flush. The new contents are written to a temp file in the same directory
+        and renamed over the save file, so readers either see the old or the
+        new document, never a partial one.
+        '''
+
+        with self._flush_lock:
+
+            with self._lock:
+                if not self._dirty: return
+                dirty = self._dirty
+                self._dirty = set()
+
+            temp_name = None
+            try:
+                with self._lock:
+                    serialized = json.dumps(self._data)
+                directory = os.path.dirname(os.path.abspath(self.file_name))
+                file_descriptor, temp_name = tempfile.mkstemp(dir = directory, prefix = ".save_data.", suffix = ".tmp")
+                with os.fdopen(file_descriptor, 'w') as temp_file:
+                    temp_file.write(serialized)
+                    temp_file.flush()
+                    os.fsync(temp_file.fileno())
+                os.replace(temp_name, self.file_name)
+            except Exception as e:
+                # keys stay dirty so the next flush retries them
+                with self._lock:
+                    self._dirty |= dirty
+                if temp_name is not None and os.path.exists(temp_name): os.remove(temp_name)
+                log(LOG_TAG, "failed to flush " + self.file_name + ": " + repr(e), ERROR)
+
+    def _run(self):
+
+        '''
+        Body of the background flusher thread. Keeps running whatever a flush
+        raises, so later changes are still written.
+        '''
+
+        while not self._stopping.wait(self.flush_interval):
+            try:
+                self.flush()
+            except Exception as e:
+                log(LOG_TAG, "flusher failed: " + repr(e), ERROR)
+
+    def start(self):
+
+        '''
+        Starts the background flusher thread if it is not already running.
+        '''
+
+        if self._flusher is None and not self._stopping.is_set() and not self.read_only:
+            with self._lock:
+                if self._flusher is None:
+                    self._flusher = threading.Thread(target = self._run, name = "state-flusher", daemon = True)
+                    self._flusher.start()
+
+    def stop(self):
+
+        '''
+        Stops the background flusher and writes out any pending changes.
+        '''
+
+        self._stopping.set()
+        self.flush()
+
+_store = StateStore(SAVE_FILE_NAME)
+atexit.register(_store.stop)
 
 def set_data(key, value):
 
     '''
     Adds specified key to the save file with the given value, or update that
-    key's value if it already exists.
+    key's value if it already exists. The change is kept in memory and written
+    to disk by the next flush.
 
     @param key: unique key to store the value with
     @param value: the value you want to store in the storage
     '''
 
-    save_data = get_data()
-    with open(SAVE_FILE_NAME, 'w') as save_file:
-        save_data[key] = value
-        json.dump(save_data, save_file)
+    _store.set(key, value)
 
 def get_data(key = None):
 
@@ -33,17 +187,81 @@ def get_data(key = None):
     @param key: optional key to extract a specific value
     '''
 
-    with open(SAVE_FILE_NAME, 'r') as save_file:
-        save_data = json.load(save_file)
-        return (save_data if not key else save_data[key])
+    return _store.get(key)
+
+def flush_data():
+
+    '''
+    Forces pending changes to be written to the save file immediately.
+    '''
+
+    _store.flush()
+
+def watch(listener):
+
+    '''
+    Calls listener with the key and the new value every time set_data is
+    called, on the thread that called it.
+
+    @param listener: function taking (key, value)
+    '''
+
+    _store.listeners.append(listener)
+
+def set_read_only():
+
+    '''
+    Stops this process from ever writing the save file. Later changes are only
+    kept in memory.
+    '''
+
+    with _store._lock:
+        _store.read_only = True
+        _store._dirty = set()
+
+def lazy_import(name):
+
+    '''
+    Returns a module which is only actually imported the first time one of its
+    attributes is used. Lazy modules are not safe to load from two threads at
+    once, so use load_now on the loop thread to load one ahead of time.
+
+    @param name: full name of the module, e.g. "numpy"
+    '''
+
+    if name in sys.modules: return sys.modules[name]
+    spec = importlib.util.find_spec(name)
+    loader = importlib.util.LazyLoader(spec.loader)
+    spec.loader = loader
+    module = importlib.util.module_from_spec(spec)
+    sys.modules[name] = module
+    loader.exec_module(module)
+    return module
+
+def load_now(name):
+
+    '''
+    Finishes importing a module returned by lazy_import.
+
+    @param name: full name of the module
+    '''
+
+    module = lazy_import(name)
+    getattr(module, "__name__") # any attribute access runs the deferred import
+    return module
 
-def log(tag, message):
+def log(tag, message, level = INFO, **fields):
 
     '''
-    Standardised logging including tags.
+    Standardised logging including tags. Returns right away; the record is
+    written by a background thread, and not at all if below the log level.
 
     @param tag: tag which describes the scope of where the log is called
-    @param message: the message to be logged
+    @param message: the message to be logged, or a function returning it,
+        which is only called if the record is written
+    @param level: level of the record, e.g. commons.DEBUG
+    @param fields: structured fields of the record, e.g. chat_id, event or
+        duration; only written in the json log format
     '''
 
-    print("<" + tag.upper() + ">", message)
+    logs.log(level, tag, message, fields)
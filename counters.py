@@ -0,0 +1,180 @@
+'''
+This file contains the in-process counters behind /stats. Counting a command or
+a tweet only touches memory; the accumulated increments are added onto the
+totals in the shared data storage by a periodic flush. Recent activity is kept
+in per-minute buckets so that /stats can also show hourly and daily rates.
+
+Counters are meant to be incremented from the event loop thread only, which is
+what keeps the hot path free of locks.
+'''
+
+from collections import deque
+
+import time
+import atexit
+import asyncio
+import commons
+
+STATS_KEY = "stats"
+FLUSH_INTERVAL = 30 # seconds between flushes to the shared data storage
+BUCKET_SECONDS = 60
+HISTORY_SECONDS = 24 * 60 * 60
+WINDOWS = [("last hour", 60 * 60), ("last day", 24 * 60 * 60)]
+LOG_TAG = "counters"
+
+class Counters():
+
+    def __init__(self, bucket_seconds = BUCKET_SECONDS, history_seconds = HISTORY_SECONDS):
+
+        '''
+        Sets up an empty set of counters.
+
+        @param bucket_seconds: width of each bucket used for windowed counts
+        @param history_seconds: how far back windowed counts can look
+        '''
+
+        self.bucket_seconds = bucket_seconds
+        self.history_buckets = history_seconds // bucket_seconds
+        self._pending = {}
+        self._buckets = {}
+
+    def increment(self, name, amount = 1):
+
+        '''
+        Adds amount to the named counter.
+
+        @param name: name of the counter, e.g. the command name
+        @param amount: number to add; must not be negative
+        '''
+
+        self._pending[name] = self._pending.get(name, 0) + amount
+
+        bucket = int(time.time()) // self.bucket_seconds
+        buckets = self._buckets.get(name)
+        if buckets is None:
+            buckets = self._buckets[name] = deque(maxlen = self.history_buckets)
+        if buckets and buckets[-1][0] == bucket:
+            buckets[-1][1] += amount
+        else:
+            buckets.append([bucket, amount])
+
+    def windowed(self, name, seconds):
+
+        '''
+        Returns the number of increments to the named counter within the last
+        given number of seconds, rounded to whole buckets.
+
+        @param name: name of the counter
+        @param seconds: size of the window
+        '''
+
+        oldest = int(time.time()) // self.bucket_seconds - seconds // self.bucket_seconds + 1
+        return sum(count for bucket, count in self._buckets.get(name, ()) if bucket >= oldest)
+
+    def totals(self):
+
+        '''
+        Returns the lifetime totals, including increments not yet flushed.
+        '''
+
+        totals = {name: int(count) for name, count in commons.get_data(STATS_KEY).items()}
+        for name, count in self._pending.items():
+            totals[name] = totals.get(name, 0) + count
+        return totals
+
+    def flush(self):
+
+        '''
+        Adds the increments accumulated since the last flush onto the stored
+        totals. Only ever adds, so stored totals can never go backwards.
+        '''
+
+        pending, self._pending = self._pending, {}
+        if not pending: return
+
+        stats = dict(commons.get_data(STATS_KEY))
+        for name, count in pending.items():
+            stats[name] = int(stats.get(name, 0)) + count
+        commons.set_data(STATS_KEY, stats)
+
+    async def run(self, interval = FLUSH_INTERVAL):
+
+        '''
+        Async method that flushes the counters every interval seconds.
+
+        @param interval: number of seconds between flushes
+        '''
+
+        while True:
+            await asyncio.sleep(interval)
+            self.flush()
+
+_counters = Counters()
+_forward = None
+atexit.register(_counters.flush)
+
+def increment(name, amount = 1):
+
+    '''
+    Adds amount to the named counter.
+
+    @param name: name of the counter, e.g. the command name
+    @param amount: number to add; must not be negative
+    '''
+
+    if _forward is not None:
+        _forward(name, amount)
+    else:
+        _counters.increment(name, amount)
+
+def forward(send):
+
+    '''
+    Hands every later increment to send instead of counting it here, e.g. to
+    count in the process that owns the totals.
+
+    @param send: function taking (name, amount)
+    '''
+
+    global _forward
+    _forward = send
+
+def windowed(name, seconds):
+
+    '''
+    Returns the number of increments to the named counter within the last
+    given number of seconds.
+
+    @param name: name of the counter
+    @param seconds: size of the window
+    '''
+
+    return _counters.windowed(name, seconds)
+
+def totals():
+
+    '''
+    Returns the lifetime totals of all counters as a dictionary.
+    '''
+
+    return _counters.totals()
+
+def flush():
+
+    '''
+    Writes pending increments to the shared data storage.
+    '''
+
+    _counters.flush()
+
+def start(loop, interval = FLUSH_INTERVAL):
+
+    '''
+    Schedules the periodic flush on the given event loop.
+
+    @param loop: event loop the bot runs on
+    @param interval: number of seconds between flushes
+    '''
+
+    commons.log(LOG_TAG, "flushing counters every " + str(interval) + "s")
+    return loop.create_task(_counters.run(interval))
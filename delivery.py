@@ -0,0 +1,284 @@
+'''
+This file contains the delivery engine used to fan a message out to many chats,
+e.g. tweets and broadcasts. Sends run concurrently up to a fixed limit while
+token buckets keep the bot within Telegram's global and per-chat rate limits.
+Failures are isolated per recipient: transient errors are retried with
+backoff, 429s pause all sending for the requested retry_after, and anything
+else is counted as failed without affecting the other recipients. Need to call
+init() on the main script before use.
+'''
+
+from telepot import exception
+
+import time
+import random
+import aiohttp
+import asyncio
+import commons
+import telepot.api
+import telepot.aio.api
+
+GLOBAL_RATE = 30 # messages per second across all chats
+PRIVATE_CHAT_RATE = 1 # messages per second to the same private chat
+GROUP_CHAT_RATE = 20 / 60 # messages per second to the same group chat
+CONCURRENCY = 20
+MAX_ATTEMPTS = 4
+BACKOFF_BASE = 0.5 # seconds, doubled on every retry
+MAX_CHAT_BUCKETS = 10000
+LOG_TAG = "delivery"
+
+# errors which will not go away by retrying the same recipient
+PERMANENT_ERRORS = (
+    exception.BotWasBlockedError,
+    exception.BotWasKickedError,
+    exception.MigratedToSupergroupChatError,
+    exception.NotEnoughRightsError,
+    exception.UnauthorizedError
+)
+
+deliverer = None
+
+def use_api_server(base_url):
+
+    '''
+    Points telepot at a different Bot API server, such as a local fake server
+    used for testing. Requests go to <base_url>/bot<token>/<method>.
+
+    @param base_url: base url of the server, e.g. http://127.0.0.1:8081
+    '''
+
+    base_url = base_url.rstrip("/")
+    methodurl = lambda req, **user_kw: "%s/bot%s/%s" % (base_url, req[0], req[1])
+    telepot.api._methodurl = methodurl
+    telepot.aio.api._methodurl = methodurl
+    commons.log(LOG_TAG, "using bot api server at " + base_url)
+
+class TokenBucket():
+
+    def __init__(self, rate, capacity = None):
+
+        '''
+        Sets up a token bucket which refills at a fixed rate.
+
+        @param rate: tokens added per second
+        @param capacity: maximum number of tokens that can be saved up;
+            defaults to one second worth of tokens
+        '''
+
+        self.rate = rate
+        self.capacity = max(1, capacity if capacity else rate)
+        self.tokens = self.capacity
+        self.updated = time.monotonic()
+        self.paused_until = 0
+
+    def _refill(self, now):
+        self.tokens = min(self.capacity, self.tokens + (now - self.updated) * self.rate)
+        self.updated = now
+
+    def is_full(self):
+
+        '''
+        Returns True if the bucket has not been drawn from recently.
+        '''
+
+        self._refill(time.monotonic())
+        return self.tokens >= self.capacity
+
+    def pause(self, seconds):
+
+        '''
+        Stops handing out tokens for the given number of seconds.
+
+        @param seconds: how long to pause for
+        '''
+
+        self.paused_until = max(self.paused_until, time.monotonic() + seconds)
+        self.tokens = 0
+
+    async def acquire(self):
+
+        '''
+        Async method which waits until a token is available and takes it.
+        '''
+
+        while True:
+            now = time.monotonic()
+            if now < self.paused_until:
+                await asyncio.sleep(self.paused_until - now)
+                continue
+            self._refill(now)
+            if self.tokens >= 1:
+                self.tokens -= 1
+                return
+            await asyncio.sleep((1 - self.tokens) / self.rate)
+
+class DeliveryReport():
+
+    def __init__(self, name):
+
+        '''
+        Keeps track of the progress of a single fan-out.
+
+        @param name: short description of what is being delivered
+        '''
+
+        self.name = name
+        self.sent = 0
+        self.failed = 0
+        self.retries = 0
+        self.started = time.monotonic()
+        self.finished = None
+
+    @property
+    def elapsed(self):
+        return (self.finished if self.finished else time.monotonic()) - self.started
+
+    @property
+    def throughput(self):
+        return self.sent / self.elapsed if self.elapsed else 0.0
+
+    def __str__(self):
+        return "%s: %d sent, %d failed, %d retries in %.1fs (%.1f msg/s)" % (
+            self.name, self.sent, self.failed, self.retries, self.elapsed, self.throughput
+        )
+
+class Deliverer():
+
+    def __init__(self, bot, concurrency = CONCURRENCY, global_rate = GLOBAL_RATE):
+
+        '''
+        Sets up a delivery engine sending through the given bot. All fan-outs
+        share the same rate limits.
+
+        @param bot: telepot.aio.Bot instance used to send messages
+        @param concurrency: maximum number of sends in flight per fan-out
+        @param global_rate: maximum number of messages per second overall
+        '''
+
+        self.bot = bot
+        self.concurrency = concurrency
+        self.global_bucket = TokenBucket(global_rate)
+        self.chat_buckets = {}
+
+    def _chat_bucket(self, chat_id):
+
+        '''
+        Returns the per-chat bucket of a recipient, creating it if needed. Group
+        chats (negative ids) are limited more strictly than private chats.
+        '''
+
+        bucket = self.chat_buckets.get(chat_id)
+        if bucket is None:
+            if len(self.chat_buckets) >= MAX_CHAT_BUCKETS:
+                # forget chats that have not been sent to recently
+                self.chat_buckets = {key: value for key, value in self.chat_buckets.items() if not value.is_full()}
+            bucket = TokenBucket(GROUP_CHAT_RATE if chat_id < 0 else PRIVATE_CHAT_RATE, capacity = 1)
+            self.chat_buckets[chat_id] = bucket
+        return bucket
+
+    async def _send(self, chat_id, send, report):
+
+        '''
+        Async method which sends to a single recipient, retrying transient
+        errors. Being rate limited counts as an attempt too, so a chat which
+        keeps getting 429s is given up on. Returns True if the message was
+        delivered.
+        '''
+
+        attempt = 0
+        while True:
+            await self._chat_bucket(chat_id).acquire()
+            await self.global_bucket.acquire()
+            rate_limited = False
+            try:
+                await send(chat_id)
+                report.sent += 1
+                return True
+            except exception.TooManyRequestsError as e:
+                # telegram tells us exactly how long to back off for
+                retry_after = e.json.get("parameters", {}).get("retry_after", 1)
+                self.global_bucket.pause(retry_after)
+                commons.log(LOG_TAG, "rate limited, pausing for " + str(retry_after) + "s")
+                rate_limited = True
+            except PERMANENT_ERRORS as e:
+                report.failed += 1
+                commons.log(LOG_TAG, "dropping " + str(chat_id) + ": " + str(e))
+                return False
+            except exception.TelegramError as e:
+                if e.error_code < 500:
+                    report.failed += 1
+                    commons.log(LOG_TAG, "dropping " + str(chat_id) + ": " + str(e))
+                    return False
+            except (aiohttp.ClientError, asyncio.TimeoutError, exception.BadHTTPResponse):
+                pass
+            except Exception as e:
+                report.failed += 1
+                commons.log(LOG_TAG, "dropping " + str(chat_id) + ": " + repr(e))
+                return False
+
+            attempt += 1
+            if attempt >= MAX_ATTEMPTS:
+                report.failed += 1
+                commons.log(LOG_TAG, "giving up on " + str(chat_id) + " after " + str(attempt) + " attempts")
+                return False
+            if rate_limited: continue # the paused bucket is the backoff
+            report.retries += 1
+            await asyncio.sleep(BACKOFF_BASE * (2 ** (attempt - 1)) * (1 + random.random()))
+
+    async def deliver(self, recipients, send, name = "delivery", on_result = None):
+
+        '''
+        Async method which calls send for every recipient, concurrently and
+        within the rate limits. Returns a DeliveryReport once every recipient
+        has either received the message or failed.
+
+        @param recipients: iterable of chat ids; consumed lazily so it can be a
+            generator streaming ids from storage
+        @param send: coroutine function taking a chat id which does the actual
+            sending
+        @param name: short description used when logging the report
+        @param on_result: optional function called with (chat_id, delivered)
+            after each recipient is done
+        '''
+
+        report = DeliveryReport(name)
+        recipients = iter(recipients)
+
+        async def worker():
+            for chat_id in recipients:
+                delivered = await self._send(chat_id, send, report)
+                if on_result: on_result(chat_id, delivered)
+
+        await asyncio.gather(*[worker() for _ in range(self.concurrency)])
+        report.finished = time.monotonic()
+        commons.log(LOG_TAG, str(report))
+        return report
+
+    async def send_message(self, recipients, text, name = "message", on_result = None, **kwargs):
+
+        '''
+        Async method which sends the same text message to every recipient.
+
+        @param recipients: iterable of chat ids
+        @param text: the message to send
+        @param name: short description used when logging the report
+        @param on_result: optional function called with (chat_id, delivered)
+        @param kwargs: extra parameters passed on to sendMessage
+        '''
+
+        send = lambda chat_id: self.bot.sendMessage(chat_id, text, **kwargs)
+        return await self.deliver(recipients, send, name, on_result)
+
+def init(bot, concurrency = CONCURRENCY, global_rate = GLOBAL_RATE):
+
+    '''
+    Creates the shared delivery engine for the given bot.
+
+    @param bot: telepot.aio.Bot instance used to send messages
+    @param concurrency: maximum number of sends in flight per fan-out
+    @param global_rate: maximum number of messages per second overall
+    '''
+
+    global deliverer
+    deliverer = Deliverer(bot, concurrency, global_rate)
+    return deliverer
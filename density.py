@@ -0,0 +1,237 @@
+'''
+This file contains the crowd density classifier. Each location's profiles are
+stacked into a single (profile, height, width, channel) tensor so that a frame
+is scored against all of them with one broadcast subtraction, and the scoring
+runs in a pool of worker processes so that the event loop never blocks on image
+decoding or math. Profiles come from the memory-mapped bundle compiled by
+profiles.py and are only mapped in the first time a location is classified.
+NumPy and SciPy are imported lazily, so loading this module costs nothing until
+the workers (or warm_up) need them.
+
+The label returned is the profile with the lowest mean squared error, which is
+what the bot has always used. Ties go to the profile listed first in
+PROFILE_NAMES, matching the old behaviour where "average" was the default and
+only replaced by a strictly better match.
+'''
+
+from concurrent.futures import ProcessPoolExecutor
+from io import BytesIO
+
+import time
+import asyncio
+import commons
+import metrics
+import profiles
+
+np = commons.lazy_import("numpy")
+
+PROFILE_NAMES = profiles.PROFILE_NAMES
+WORKERS = 1
+LOG_TAG = "density"
+
+class DensityClassifier():
+
+    def __init__(self, bundle = None):
+
+        '''
+        Sets up a classifier without any location profiles.
+
+        @param bundle: optional profiles.ProfileBundle to take the profiles of a
+            location from the first time it is classified
+        '''
+
+        self.bundle = bundle
+        self._profiles = {}
+        self._workspace = np.empty(0, dtype = np.int32)
+
+    def add_location(self, location, profiles):
+
+        '''
+        Stacks the profiles of a location into one tensor.
+
+        @param location: camera name as found in bot.LOCATIONS
+        @param profiles: either a dictionary of profile name to image array, or
+            an already stacked array ordered as PROFILE_NAMES
+        '''
+
+        if isinstance(profiles, dict):
+            first = profiles[PROFILE_NAMES[0]]
+            stack = np.empty((len(PROFILE_NAMES),) + first.shape, dtype = np.uint8)
+            for index, name in enumerate(PROFILE_NAMES):
+                stack[index] = profiles[name]
+        else:
+            stack = profiles
+
+        self._profiles[location] = stack
+        if stack.size > self._workspace.size:
+            self._workspace = np.empty(stack.size, dtype = np.int32)
+
+    def has_location(self, location):
+
+        '''
+        Returns True if profiles have been added for the location.
+
+        @param location: camera name as found in bot.LOCATIONS
+        '''
+
+        return location in self._profiles or (self.bundle is not None and location in self.bundle.locations)
+
+    def score(self, location, frame):
+
+        '''
+        Returns the mean squared error between the frame and every profile of
+        the location, ordered as PROFILE_NAMES. The differences are computed in
+        integers into a preallocated buffer, so the result is exact.
+
+        @param location: camera name as found in bot.LOCATIONS
+        @param frame: image array of the current screenshot
+        '''
+
+        if location not in self._profiles and self.bundle is not None:
+            self.add_location(location, self.bundle.get(location))
+
+        stack = self._profiles[location]
+        if frame.shape != stack.shape[1:]:
+            raise ValueError("frame shape %s does not match profiles of %s %s" % (frame.shape, location, stack.shape[1:]))
+
+        workspace = self._workspace[:stack.size].reshape(stack.shape)
+        np.subtract(stack, frame, out = workspace, dtype = np.int32)
+        np.square(workspace, out = workspace)
+        return workspace.reshape(len(stack), -1).sum(axis = 1, dtype = np.int64) / frame.size
+
+    def classify(self, location, frame):
+
+        '''
+        Returns the label of the profile that most resembles the frame, along
+        with the scores of all profiles.
+
+        @param location: camera name as found in bot.LOCATIONS
+        @param frame: image array of the current screenshot
+        '''
+
+        scores = self.score(location, frame)
+        return PROFILE_NAMES[int(np.argmin(scores))], scores
+
+# classifier owned by each worker process, set up by _init_worker
+_classifier = None
+
+def _init_worker(profile_dir):
+    global _classifier
+    _classifier = DensityClassifier(profiles.ProfileBundle(profile_dir))
+
+def _warm_up_worker():
+
+    '''
+    Runs inside a worker process. Imports the image decoder ahead of the first
+    frame.
+    '''
+
+    from scipy import misc
+    commons.load_now("numpy")
+
+def _classify_frames(frames):
+
+    '''
+    Runs inside a worker process. Decodes and classifies a batch of frames,
+    returning (label, scores) for each one, None for locations without
+    profiles, or (None, error) for a frame which could not be decoded or
+    classified, along with the (phase, seconds) each decode and
+    classification took. A bad frame only fails its own result.
+    '''
+
+    from scipy import misc
+
+    results = []
+    timings = []
+    for location, image_data in frames:
+        if not _classifier.has_location(location):
+            results.append(None)
+            continue
+        try:
+            started = time.perf_counter()
+            frame = misc.imread(BytesIO(image_data))
+            decoded = time.perf_counter()
+            label, scores = _classifier.classify(location, frame)
+        except Exception as e:
+            results.append((None, repr(e)))
+            continue
+        timings += [("decode", decoded - started), ("mse", time.perf_counter() - decoded)]
+        results.append((label, scores.tolist()))
+    return results, timings
+
+class DensityPool():
+
+    def __init__(self, profile_dir, locations, workers = WORKERS):
+
+        '''
+        Compiles the profile bundle if it is out of date and starts the worker
+        processes, each of which maps the bundle in.
+
+        @param profile_dir: directory containing the profile images
+        @param locations: iterable of camera names
+        @param workers: number of worker processes
+        '''
+
+        index = profiles.ensure_bundle(profile_dir)
+        self.workers = workers
+        self.locations = set(locations) & set(index["locations"])
+        self.executor = ProcessPoolExecutor(
+            max_workers = workers, initializer = _init_worker, initargs = (profile_dir,)
+        )
+        commons.log(LOG_TAG, "profiled locations: " + ", ".join(sorted(self.locations)))
+
+    async def classify_batch(self, frames):
+
+        '''
+        Async method which classifies frames from one or more locations in a
+        single round trip to a worker process. Returns a result per frame:
+        (label, scores), None for a location without a profile, or
+        (None, error) for a frame which could not be classified.
+
+        @param frames: list of (location, image bytes) pairs
+        '''
+
+        results, timings = await asyncio.get_event_loop().run_in_executor(self.executor, _classify_frames, list(frames))
+        for phase, seconds in timings:
+            metrics.observe("phase_seconds", seconds, phase = phase)
+        return results
+
+    async def classify(self, location, image_data):
+
+        '''
+        Async method which classifies a single frame. Returns (label, scores),
+        or None if the location has no profile or the frame could not be
+        classified, so the snapshot is still shown without a density.
+
+        @param location: camera name as found in bot.LOCATIONS
+        @param image_data: bytes of the current screenshot of the location
+        '''
+
+        if location not in self.locations: return None
+        result = (await self.classify_batch([(location, image_data)]))[0]
+        if result is not None and result[0] is None:
+            commons.log(LOG_TAG, "failed to classify " + location + ": " + result[1], commons.WARNING)
+            return None
+        return result
+
+    async def warm_up(self):
+
+        '''
+        Async method which starts the worker processes and has each of them do
+        its imports, so that the first classification does not pay for them.
+        '''
+
+        loop = asyncio.get_event_loop()
+        await asyncio.gather(*[loop.run_in_executor(self.executor, _warm_up_worker) for _ in range(self.workers)])
+
+    def shutdown(self, wait = False):
+
+        '''
+        Stops the worker processes.
+
+        @param wait: whether to wait for them to exit; needed when this process
+            is itself a multiprocessing child, which would otherwise hang on
+            exit waiting for them
+        '''
+
+        self.executor.shutdown(wait = wait)
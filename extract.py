@@ -0,0 +1,304 @@
+'''
+This file contains the HTML extraction used for scraping NTU pages. Instead of
+building a full BeautifulSoup tree of a whole SharePoint page, each extractor is
+an incremental parser that only keeps track of the few elements it needs and
+stops reading as soon as it has them. Results are returned as plain records.
+'''
+
+from collections import namedtuple
+from html.parser import HTMLParser
+
+CHUNK_SIZE = 16 * 1024 # characters fed to a parser at a time
+VOID_ELEMENTS = {
+    "area", "base", "br", "col", "embed", "hr", "img", "input", "link", "meta", "param", "source", "track", "wbr"
+}
+
+NewsItem = namedtuple("NewsItem", ["date", "title", "link"])
+ShuttleRoute = namedtuple("ShuttleRoute", ["name", "stops"]) # name is None for services without sub routes
+ShuttleService = namedtuple("ShuttleService", ["name", "info_link", "routes"])
+
+def _classes(attrs):
+
+    '''
+    Returns the set of classes of a tag given its attribute list.
+    '''
+
+    for name, value in attrs:
+        if name == "class" and value: return set(value.split())
+    return set()
+
+class _ExtractParser(HTMLParser):
+
+    '''
+    Base for the extractors. Keeps a stack of open tags (tolerating unclosed
+    and void elements) and stops doing any work once done is set.
+    '''
+
+    def __init__(self):
+        super(_ExtractParser, self).__init__(convert_charrefs = True)
+        self.stack = []
+        self.done = False
+
+    def handle_starttag(self, tag, attrs):
+        if self.done: return
+        depth = len(self.stack)
+        if tag not in VOID_ELEMENTS: self.stack.append(tag)
+        self.start(tag, attrs, depth)
+
+    def handle_startendtag(self, tag, attrs):
+        self.handle_starttag(tag, attrs)
+        if tag not in VOID_ELEMENTS: self.handle_endtag(tag)
+
+    def handle_endtag(self, tag):
+        if self.done or tag not in self.stack: return
+        # implicitly close anything left open inside this element
+        while self.stack:
+            open_tag = self.stack.pop()
+            self.end(open_tag, len(self.stack))
+            if open_tag == tag: return
+
+    def handle_data(self, data):
+        if not self.done: self.text(data)
+
+    def start(self, tag, attrs, depth):
+        pass
+
+    def end(self, tag, depth):
+        pass
+
+    def text(self, data):
+        pass
+
+    def run(self, page):
+
+        '''
+        Feeds the page in chunks until the extractor is done or the page ends.
+
+        @param page: page source as a string
+        '''
+
+        for offset in range(0, len(page), CHUNK_SIZE):
+            self.feed(page[offset:offset + CHUNK_SIZE])
+            if self.done: return self
+        self.close()
+        return self
+
+class _NewsParser(_ExtractParser):
+
+    '''
+    Extracts news items from the news hub. Each item is a title div holding a
+    link, followed by the element holding its date; the first item's div has
+    class ntu_news_summary_title_first and the others, which are its siblings,
+    have class ntu_news_summary_title.
+    '''
+
+    def __init__(self, count):
+        super(_NewsParser, self).__init__()
+        self.count = count
+        self.items = []
+        self.item_depth = None # depth of the title divs once the first is found
+        self.state = None # "title", "date" or None while looking for the next title
+        self.link = None
+        self.title = []
+        self.date = []
+        self.capture_depth = None
+
+    def start(self, tag, attrs, depth):
+        if self.state is None and tag == "div":
+            classes = _classes(attrs)
+            if (self.item_depth is None and "ntu_news_summary_title_first" in classes) or \
+                    (depth == self.item_depth and "ntu_news_summary_title" in classes):
+                self.item_depth = depth
+                self.state = "title"
+                self.link, self.title, self.date = None, [], []
+        elif self.state == "title" and tag == "a" and self.link is None:
+            self.link = dict(attrs).get("href")
+            self.capture_depth = depth
+        elif self.state == "date" and self.capture_depth is None:
+            # the date is the element right after the title div
+            self.capture_depth = depth
+
+    def end(self, tag, depth):
+        if self.state == "title":
+            if depth == self.capture_depth:
+                self.capture_depth = None
+            elif depth == self.item_depth:
+                self.state = "date"
+        elif self.state == "date" and depth == self.capture_depth:
+            self._finish_item()
+        if depth < (self.item_depth or 0):
+            # left the parent of the news items, there are no more siblings
+            self.done = True
+
+    def text(self, data):
+        if self.state == "title" and self.capture_depth is not None:
+            self.title.append(data)
+        elif self.state == "date":
+            if self.capture_depth is not None:
+                self.date.append(data)
+            elif data.strip():
+                # the date is a bare string right after the title div
+                self.date.append(data)
+                self._finish_item()
+
+    def _finish_item(self):
+        self.items.append(NewsItem(
+            date = "".join(self.date).strip(),
+            title = "".join(self.title).strip().title(),
+            link = self.link
+        ))
+        self.state, self.capture_depth = None, None
+        if len(self.items) >= self.count: self.done = True
+
+def parse_news(page, count):
+
+    '''
+    Returns up to count of the most recent news items on the news hub page, as
+    NewsItem records. Stops parsing once it has count items.
+
+    @param page: page source of the news hub
+    @param count: number of news items to extract
+    '''
+
+    return _NewsParser(count).run(page).items
+
+class _ShuttleParser(_ExtractParser):
+
+    '''
+    Records the handful of elements the shuttle bus page is scraped for (spans,
+    links, strong headers, lists and their items) as a flat list of events,
+    along with the extent of every element holding a route label span.
+    '''
+
+    RECORDED = {"span", "a", "strong", "ul", "li"}
+    CAPTURED = {"span", "strong", "li"}
+
+    def __init__(self):
+        super(_ShuttleParser, self).__init__()
+        self.events = [] # [tag, depth, value, end index]
+        self.openings = [] # event index at the time each open tag was opened
+        self.labels = [] # [label event index, parent start, parent end, parent depth]
+        self.captures = []
+
+    def handle_starttag(self, tag, attrs):
+        self.openings.append(len(self.events))
+        super(_ShuttleParser, self).handle_starttag(tag, attrs)
+        if tag in VOID_ELEMENTS: self.openings.pop()
+
+    def start(self, tag, attrs, depth):
+        if tag not in self.RECORDED: return
+        event = [tag, depth, dict(attrs).get("href") if tag == "a" else None, None]
+        if tag == "span" and "route_label" in _classes(attrs):
+            # the parent is the innermost open element before this span
+            self.labels.append([len(self.events), self.openings[-2] if len(self.openings) > 1 else 0, None, depth - 1])
+        if tag in self.CAPTURED:
+            event[2] = []
+            self.captures.append(event)
+        self.events.append(event)
+
+    def end(self, tag, depth):
+        start = self.openings.pop()
+        for label in self.labels:
+            if label[2] is None and label[3] == depth and label[1] == start:
+                label[2] = len(self.events)
+        if tag in self.RECORDED:
+            # a recorded element's event is the first one after it was opened
+            event = self.events[start]
+            event[3] = len(self.events)
+            if tag in self.CAPTURED: self.captures.remove(event)
+
+    def text(self, data):
+        for event in self.captures:
+            event[2].append(data)
+
+    def _text(self, index):
+
+        '''
+        Returns the text captured for the event.
+        '''
+
+        return "".join(self.events[index][2])
+
+    def _stops_after(self, index):
+
+        '''
+        Returns the text of every list item of the first list after the event.
+        '''
+
+        for ul_index in range(index + 1, len(self.events)):
+            if self.events[ul_index][0] == "ul":
+                end = self.events[ul_index][3] or len(self.events)
+                return [self._text(i).strip() for i in range(ul_index + 1, end) if self.events[i][0] == "li"]
+        return []
+
+    def services(self):
+
+        '''
+        Assembles the recorded events into ShuttleService records.
+        '''
+
+        services = []
+        for label_index, parent_start, parent_end, parent_depth in self.labels:
+            parent_end = parent_end or len(self.events)
+            if self.events[parent_start][1] == parent_depth:
+                # the parent is itself a recorded element; only its contents count
+                parent_start += 1
+            depth = self.events[label_index][1]
+            siblings = range(label_index + 1, parent_end)
+            within = range(parent_start, parent_end)
+
+            info_link = next((self.events[i][2] for i in siblings if self.events[i][0] == "a" and self.events[i][1] == depth), None)
+            sub_routes = [i for i in within if self.events[i][0] == "strong"]
+
+            # workaround for inconsistent route layouting for campus rider service
+            if len([i for i in within if self.events[i][0] == "span"]) == 2: del sub_routes[-1]
+
+            if sub_routes:
+                routes = [ShuttleRoute(self._text(i), self._stops_after(i)) for i in sub_routes]
+            else:
+                routes = [ShuttleRoute(None, self._stops_after(label_index))]
+            services.append(ShuttleService(self._text(label_index).strip(), info_link, routes))
+        return services
+
+def parse_shuttle_services(page):
+
+    '''
+    Returns the shuttle bus services listed on the shuttle bus page, as
+    ShuttleService records.
+
+    @param page: page source of the shuttle bus page
+    '''
+
+    return _ShuttleParser().run(page).services()
+
+class _ImageCaptionParser(_ExtractParser):
+
+    '''
+    Finds the first image inside a div with class img-caption.
+    '''
+
+    def __init__(self):
+        super(_ImageCaptionParser, self).__init__()
+        self.caption_depth = None
+        self.src = None
+
+    def start(self, tag, attrs, depth):
+        if self.caption_depth is None:
+            if tag == "div" and "img-caption" in _classes(attrs): self.caption_depth = depth
+        elif tag == "img":
+            self.src = dict(attrs).get("src")
+            self.done = True
+
+    def end(self, tag, depth):
+        if depth == self.caption_depth: self.caption_depth = None
+
+def parse_shuttle_image(page):
+
+    '''
+    Returns the url of the route image on a shuttle bus service's info page, or
+    None if there is none.
+
+    @param page: page source of the service's info page
+    '''
+
+    return _ImageCaptionParser().run(page).src
@@ -0,0 +1,208 @@
+'''
+This file contains the crowd density history behind /trend. Density results
+are appended to a fixed-size ring buffer per location, at most one a minute,
+stored as a memory-mapped file of packed (uint32 timestamp, uint8 label)
+records, so memory and disk usage stay constant no matter how long the bot
+runs and the buffer always covers the same span of time. Aggregates are
+computed with NumPy reductions over the whole buffer; NumPy itself is only
+imported once a buffer is first opened. Need to call init() on the main script
+before use.
+
+Only one process writes the buffers. Any other (such as a worker process, see
+workers.py) opens them read-only, and sees new records as they are written.
+'''
+
+import os
+import commons
+
+np = commons.lazy_import("numpy")
+
+HISTORY_DIR = "./history"
+RESOLUTION = 60 # seconds; a location keeps at most one record per minute, the latest
+CAPACITY = 4 * 7 * 24 * 60 # records per location; four weeks at one per minute
+TIMEZONE_OFFSET = 8 * 60 * 60 # aggregates are by Singapore local time
+LABELS = ["empty", "average", "full"] # index is the stored byte, and also the busyness score
+RECORD = [("timestamp", "<u4"), ("label", "u1")] # fields of a record, as a NumPy dtype
+HEADER = [("capacity", "<u4"), ("next", "<u4")]
+DAYS = ["Mon", "Tue", "Wed", "Thu", "Fri", "Sat", "Sun"]
+LOG_TAG = "history"
+
+store = None
+
+class RingBuffer():
+
+    def __init__(self, file_name, capacity = CAPACITY, read_only = False):
+
+        '''
+        Opens (and creates if needed) a ring buffer file. An existing file keeps
+        its original capacity. A new file is sized under a temporary name and
+        then renamed, so a reader never finds it half made.
+
+        @param file_name: path to the buffer file
+        @param capacity: number of records the buffer can hold
+        @param read_only: open an existing file for reading only
+        '''
+
+        header, record = np.dtype(HEADER), np.dtype(RECORD)
+        if not read_only and not os.path.exists(file_name):
+            with open(file_name + ".tmp", 'wb') as buffer_file:
+                np.array([(capacity, 0)], dtype = header).tofile(buffer_file)
+                buffer_file.truncate(header.itemsize + capacity * record.itemsize)
+            os.replace(file_name + ".tmp", file_name)
+
+        mode = 'r' if read_only else 'r+'
+        self.header = np.memmap(file_name, dtype = header, mode = mode, shape = (1,))
+        self.capacity = int(self.header["capacity"][0])
+        self.records = np.memmap(file_name, dtype = record, mode = mode, offset = header.itemsize, shape = (self.capacity,))
+
+    def append(self, timestamp, label):
+
+        '''
+        Writes a record over the oldest slot, or over the newest one if that
+        is from the same minute, so polls and user requests together never
+        keep more than one record per RESOLUTION seconds.
+
+        @param timestamp: unix time of the record
+        @param label: index of the label in LABELS
+        '''
+
+        timestamp = int(timestamp)
+        position = int(self.header["next"][0])
+        newest = (position - 1) % self.capacity
+        newest_timestamp = int(self.records["timestamp"][newest])
+        if newest_timestamp and newest_timestamp // RESOLUTION == timestamp // RESOLUTION:
+            self.records[newest] = (timestamp, label)
+            return
+        self.records[position] = (timestamp, label)
+        self.header["next"] = (position + 1) % self.capacity
+
+    def valid(self):
+
+        '''
+        Returns the timestamps and labels of all slots which have been written
+        to, in storage order.
+        '''
+
+        mask = self.records["timestamp"] != 0
+        return self.records["timestamp"][mask], self.records["label"][mask]
+
+    def flush(self):
+        self.header.flush()
+        self.records.flush()
+
+class History():
+
+    def __init__(self, directory = HISTORY_DIR, capacity = CAPACITY, read_only = False):
+
+        '''
+        Sets up the history store, with one ring buffer file per location
+        opened on first use.
+
+        @param directory: directory holding the buffer files
+        @param capacity: number of records kept per location
+        @param read_only: only read the buffers written by another process
+        '''
+
+        self.directory = directory
+        self.capacity = capacity
+        self.read_only = read_only
+        self._buffers = {}
+        if not read_only:
+            os.makedirs(directory, exist_ok = True)
+
+    def _buffer(self, location):
+
+        '''
+        Returns the ring buffer of a location, opening it on first use. When
+        read-only, returns None while the writer has not made the file yet.
+        '''
+
+        if location not in self._buffers:
+            file_name = os.path.join(self.directory, location + ".bin")
+            if self.read_only and not os.path.exists(file_name): return None
+            self._buffers[location] = RingBuffer(file_name, self.capacity, self.read_only)
+        return self._buffers[location]
+
+    def record(self, location, label, timestamp):
+
+        '''
+        Appends a density result to the history of a location.
+
+        @param location: camera name as found in bot.LOCATIONS
+        @param label: density label, one of LABELS
+        @param timestamp: unix time the image was taken
+        '''
+
+        self._buffer(location).append(timestamp, LABELS.index(label))
+
+    def aggregate(self, location):
+
+        '''
+        Returns the average busyness of a location by hour of day and by day of
+        week, as arrays of 24 and 7 values between 0 (empty) and 1 (full), with
+        NaN where there is no data, along with the number of records used.
+
+        @param location: camera name as found in bot.LOCATIONS
+        '''
+
+        buffer = self._buffer(location)
+        if buffer is None:
+            timestamps, labels = np.zeros(0, dtype = "<u4"), np.zeros(0, dtype = "u1")
+        else:
+            timestamps, labels = buffer.valid()
+        local_time = timestamps.astype(np.int64) + TIMEZONE_OFFSET
+        busyness = labels.astype(np.float64) / (len(LABELS) - 1)
+
+        hours = (local_time // 3600) % 24
+        days = (local_time // 86400 + 3) % 7 # 1 Jan 1970 was a Thursday
+
+        return (
+            self._mean_by(hours, busyness, 24),
+            self._mean_by(days, busyness, 7),
+            len(timestamps)
+        )
+
+    def _mean_by(self, groups, values, size):
+
+        '''
+        Returns the mean of values per group, NaN for groups without values.
+        '''
+
+        totals = np.bincount(groups, weights = values, minlength = size)
+        counts = np.bincount(groups, minlength = size)
+        return np.divide(totals, counts, out = np.full(size, np.nan), where = counts > 0)
+
+    def flush(self):
+
+        '''
+        Writes all buffers back to disk.
+        '''
+
+        for buffer in self._buffers.values():
+            buffer.flush()
+
+def record_snapshot(snapshot):
+
+    '''
+    Records a camera snapshot's density, if it has one.
+
+    @param snapshot: camera.Snapshot that was just published
+    '''
+
+    if store is not None and snapshot.density:
+        store.record(snapshot.location, snapshot.density, snapshot.timestamp)
+
+def init(directory = HISTORY_DIR, capacity = CAPACITY, read_only = False):
+
+    '''
+    Creates the shared history store.
+
+    @param directory: directory holding the buffer files
+    @param capacity: number of records kept per location
+    @param read_only: only read the buffers, e.g. in a worker process
+    '''
+
+    global store
+    store = History(directory, capacity, read_only)
+    commons.log(LOG_TAG, ("reading" if read_only else "recording") + " density history in " + directory)
+    return store
@@ -0,0 +1,140 @@
+'''
+This file contains the HTTP client every outbound request of the bot goes
+through (except the Telegram API, which telepot handles itself). Each upstream
+host gets one long-lived session, created on first use, whose connector keeps
+connections alive, limits how many are open to the host, and caches DNS lookups.
+Every request has connect and read timeouts, and bodies larger than a set size
+are refused instead of being read into memory. Call close() on shutdown.
+'''
+
+from collections import namedtuple
+from urllib.parse import urlsplit
+
+import aiohttp
+import commons
+
+LIMIT_PER_HOST = 8 # concurrent connections to one host
+CONNECT_TIMEOUT = 10 # seconds to establish a connection
+READ_TIMEOUT = 30 # seconds between two reads of a response
+DNS_CACHE_TTL = 10 * 60 # seconds a resolved address is reused
+KEEPALIVE_TIMEOUT = 60 # seconds an idle connection is kept open
+MAX_RESPONSE_SIZE = 8 * 1024 * 1024 # bytes
+CHUNK_SIZE = 64 * 1024
+LOG_TAG = "http"
+
+class ResponseTooLargeError(aiohttp.ClientError):
+    pass
+
+class Response(namedtuple("Response", ["url", "status", "headers", "body", "charset"])):
+
+    def text(self):
+
+        '''
+        Returns the body decoded with the charset the server declared, or
+        UTF-8, replacing anything that cannot be decoded.
+        '''
+
+        return self.body.decode(self.charset or "utf-8", errors = "replace")
+
+class HttpClient():
+
+    def __init__(self, limit_per_host = LIMIT_PER_HOST, max_size = MAX_RESPONSE_SIZE):
+
+        '''
+        Sets up a client without any sessions; they are created on first use
+        so that they are bound to the running loop.
+
+        @param limit_per_host: number of connections kept open per host
+        @param max_size: default maximum size of a response body in bytes
+        '''
+
+        self.limit_per_host = limit_per_host
+        self.max_size = max_size
+        self._sessions = {}
+
+    def _session(self, url):
+
+        '''
+        Returns the session for the host of a url.
+        '''
+
+        parts = urlsplit(url)
+        origin = parts.scheme + "://" + parts.netloc
+        session = self._sessions.get(origin)
+        if session is None or session.closed:
+            connector = aiohttp.TCPConnector(
+                limit_per_host = self.limit_per_host,
+                ttl_dns_cache = DNS_CACHE_TTL,
+                keepalive_timeout = KEEPALIVE_TIMEOUT
+            )
+            session = aiohttp.ClientSession(
+                connector = connector,
+                timeout = aiohttp.ClientTimeout(connect = CONNECT_TIMEOUT, sock_read = READ_TIMEOUT)
+            )
+            self._sessions[origin] = session
+            commons.log(LOG_TAG, "opened session for " + origin)
+        return session
+
+    async def get(self, url, headers = None, timeout = None, max_size = None, raise_for_status = True):
+
+        '''
+        Async method which downloads a url. Returns a Response.
+
+        @param url: url to download
+        @param headers: optional dictionary of request headers
+        @param timeout: optional limit in seconds on the whole request, on top
+            of the connect and read timeouts
+        @param max_size: optional maximum size of the body in bytes
+        @param raise_for_status: whether to raise for 4xx and 5xx responses
+        '''
+
+        max_size = max_size or self.max_size
+        options = {"timeout": aiohttp.ClientTimeout(total = timeout, connect = CONNECT_TIMEOUT, sock_read = READ_TIMEOUT)} if timeout else {}
+
+        async with self._session(url).get(url, headers = headers, **options) as response:
+            if raise_for_status: response.raise_for_status()
+            if (response.content_length or 0) > max_size:
+                raise ResponseTooLargeError("%s is %d bytes, over the limit of %d" % (url, response.content_length, max_size))
+
+            body = bytearray()
+            async for chunk in response.content.iter_chunked(CHUNK_SIZE):
+                body.extend(chunk)
+                if len(body) > max_size:
+                    raise ResponseTooLargeError("%s is over the limit of %d bytes" % (url, max_size))
+
+            return Response(url, response.status, response.headers, bytes(body), response.charset)
+
+    async def close(self):
+
+        '''
+        Async method which closes every session.
+        '''
+
+        sessions, self._sessions = list(self._sessions.values()), {}
+        for session in sessions:
+            await session.close()
+
+_client = HttpClient()
+
+async def get(url, headers = None, timeout = None, max_size = None, raise_for_status = True):
+
+    '''
+    Async method which downloads a url through the shared client. Returns a
+    Response; see HttpClient.get.
+
+    @param url: url to download
+    @param headers: optional dictionary of request headers
+    @param timeout: optional limit in seconds on the whole request
+    @param max_size: optional maximum size of the body in bytes
+    @param raise_for_status: whether to raise for 4xx and 5xx responses
+    '''
+
+    return await _client.get(url, headers, timeout, max_size, raise_for_status)
+
+async def close():
+
+    '''
+    Async method which closes every session of the shared client.
+    '''
+
+    await _client.close()
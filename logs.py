@@ -0,0 +1,190 @@
+'''
+This file contains the logging backend behind commons.log. Logging only puts a
+record on a queue: its time, level, tag, message and structured fields such as
+the chat id, event or duration. A background thread writes whatever records
+have piled up with a single write, so a slow stdout (such as Heroku's log
+drain) holds up that thread instead of the event loop.
+
+Records below the level are dropped before anything is put together, and a
+message can be given as a function which is only called on the writer thread
+if the record is written. When the writer falls behind and QUEUE_SIZE records
+are waiting, new records are dropped and counted instead, and the count is
+logged once the writer catches up.
+
+Records are written as "<TAG> message" lines, or as one JSON object per line,
+fields included, for a log drain to parse.
+'''
+
+import os
+import sys
+import json
+import time
+import queue
+import atexit
+import threading
+
+DEBUG = 10
+INFO = 20
+WARNING = 30
+ERROR = 40
+LEVELS = {"debug": DEBUG, "info": INFO, "warning": WARNING, "error": ERROR}
+LEVEL_NAMES = {level: name for name, level in LEVELS.items()}
+FORMATS = ["text", "json"]
+QUEUE_SIZE = 10000 # records waiting to be written before new ones are dropped
+BATCH_SIZE = 500 # records written at once at most
+FLUSH_TIMEOUT = 2 # seconds to wait for the writer to catch up on exit
+LOG_TAG = "logs"
+
+class AsyncLogger():
+
+    def __init__(self, level = INFO, format = "text", capacity = QUEUE_SIZE, stream = None):
+
+        '''
+        Sets up a logger. The writer thread is only started by the first
+        record.
+
+        @param level: records below this level are dropped
+        @param format: "text" or "json"
+        @param capacity: records waiting to be written before new ones are
+            dropped
+        @param stream: file to write to; sys.stdout at the time of writing if
+            not given
+        '''
+
+        self.level = level
+        self.format = format
+        self.capacity = capacity
+        self.stream = stream
+        self.dropped = 0 # records dropped since the writer last caught up
+        self._reset()
+        os.register_at_fork(after_in_child = self._reset) # the writer thread is not forked along
+
+    def _reset(self):
+        self._queue = queue.SimpleQueue()
+        self._thread = None
+        self._lock = threading.Lock()
+
+    def log(self, level, tag, message, fields):
+
+        '''
+        Queues a record to be written, unless it is below the level or too
+        many records are already waiting.
+
+        @param level: level of the record, e.g. INFO
+        @param tag: tag which describes the scope of where the log is called
+        @param message: the message, or a function returning it
+        @param fields: dictionary of structured fields of the record
+        '''
+
+        if level < self.level: return
+        if self._queue.qsize() >= self.capacity:
+            self.dropped += 1 # may miss a few under contention, which is fine for a count of losses
+            return
+        self._queue.put((time.time(), level, tag, message, fields))
+        if self._thread is None: self._start()
+
+    def _start(self):
+        with self._lock:
+            if self._thread is None:
+                self._thread = threading.Thread(target = self._run, name = "log-writer", daemon = True)
+                self._thread.start()
+
+    def _run(self):
+
+        '''
+        Runs on the writer thread. Takes every record waiting, up to
+        BATCH_SIZE, and writes them together.
+        '''
+
+        while True:
+            batch = [self._queue.get()]
+            while len(batch) < BATCH_SIZE:
+                try:
+                    batch.append(self._queue.get_nowait())
+                except queue.Empty:
+                    break
+            self._write(batch)
+
+    def _format(self, timestamp, level, tag, message, fields):
+        if callable(message): message = message()
+        if self.format == "json":
+            record = {"time": round(timestamp, 3), "level": LEVEL_NAMES[level], "tag": tag, "message": str(message)}
+            record.update((key, value) for key, value in fields.items() if value is not None)
+            return json.dumps(record, default = str)
+        return "<" + tag.upper() + "> " + str(message)
+
+    def _write(self, batch):
+
+        '''
+        Writes a batch of records, and the number of records dropped since the
+        last batch if any, then wakes everyone waiting in flush() on it.
+        '''
+
+        lines = []
+        flushed = []
+        for record in batch:
+            if isinstance(record, threading.Event):
+                flushed.append(record)
+                continue
+            try:
+                lines.append(self._format(*record))
+            except Exception as e:
+                lines.append(self._format(time.time(), ERROR, LOG_TAG, "failed to format a " + record[2] + " record (" + repr(e) + ")", {}))
+
+        if self.dropped:
+            dropped, self.dropped = self.dropped, 0
+            lines.append(self._format(time.time(), WARNING, LOG_TAG, "dropped " + str(dropped) + " records while falling behind", {"dropped": dropped}))
+
+        if lines:
+            stream = self.stream or sys.stdout
+            try:
+                stream.write("\n".join(lines) + "\n")
+                stream.flush()
+            except (OSError, ValueError):
+                pass # nowhere left to report it
+        for event in flushed:
+            event.set()
+
+    def flush(self, timeout = FLUSH_TIMEOUT):
+
+        '''
+        Waits until every record queued so far is written, or timeout seconds
+        have passed.
+
+        @param timeout: seconds to wait at most
+        '''
+
+        if self._thread is None: return
+        written = threading.Event()
+        self._queue.put(written)
+        written.wait(timeout)
+
+_logger = AsyncLogger()
+atexit.register(_logger.flush)
+
+def log(level, tag, message, fields):
+
+    '''
+    Queues a record to be written in the background; see AsyncLogger.log.
+    '''
+
+    _logger.log(level, tag, message, fields)
+
+def configure(level = "info", format = "text"):
+
+    '''
+    Sets which records are written, and how. Raises ValueError for an unknown
+    level or format.
+
+    @param level: name of the lowest level written, e.g. "debug" or "warning"
+    @param format: "text" for "<TAG> message" lines, "json" for one JSON
+        object per record
+    '''
+
+    if level.lower() not in LEVELS: raise ValueError("unknown log level " + level)
+    if format.lower() not in FORMATS: raise ValueError("unknown log format " + format)
+    _logger.level = LEVELS[level.lower()]
+    _logger.format = format.lower()
+
+def flush(timeout = FLUSH_TIMEOUT):
+    _logger.flush(timeout)
@@ -4,44 +4,90 @@ loading the tokens from environment variables, to running the actual bot. Also
 includes the callback handler for tweet events.
 '''
 
-from telepot.aio.delegate import per_chat_id, create_open, pave_event_space, include_callback_query_chat_id
+import startup
+startup.begin() # time everything imported from here on
+
 from twitter import TwitterStream
-from bot import NTUCampusBot
 
 import os
-import telepot
+import signal
 import asyncio
+import camera
 import commons
+import counters
+import delivery
+import history
+import http_client
+import logs
+import metrics
+import news
+import outbox
+import poller
+import profiler
+import subscribers
+import webhook
+import workers
 import bot
 
+MAX_MESSAGE_LENGTH = 4096 # characters telegram allows in one message
+SERVER_SETTINGS = [ # environment variables pointing the bot at other servers, and the bot constant each replaces
+    ("CAMERA_URL", "CAM_BASE_IMAGE_URL"),
+    ("NTU_WEBSITE_URL", "NTU_WEBSITE"),
+    ("NEWS_URL", "NEWS_HUB_URL")
+]
 LOG_TAG = "main"
 
-async def on_tweet(data):
+async def on_tweets(account, tweets):
 
     '''
-    Function to be called when a new tweet is sent.
+    Function to be called when new tweets are sent. Tweets that arrive together
+    are sent to the account's subscribers as a single message, split only if
+    too long.
 
-    @param data: a dictionary containing information about the tweet; see
-        https://dev.twitter.com/overview/api/tweets for more information
+    @param account: username of the twitter account as given in
+        bot.TWITTER_ACCOUNTS
+    @param tweets: list of dictionaries containing information about each
+        tweet; see https://dev.twitter.com/overview/api/tweets for more
+        information
     '''
 
     # increment tweet stat count
-    stats = commons.get_data("stats")
-    stats["tweets"] = (0 if "tweets" not in stats else int(stats["tweets"])) + 1
-    commons.set_data("stats", stats)
+    counters.increment("tweets", len(tweets))
+
+    # send tweets to all subscribers
+    messages = [""]
+    for data in tweets:
+        tweet_message = "<b>" + data['user']['screen_name'] + "</b>: " + data['text']
+        if messages[-1] and len(messages[-1]) + len(tweet_message) + 2 > MAX_MESSAGE_LENGTH:
+            messages.append("")
+        messages[-1] += ("\n\n" if messages[-1] else "") + tweet_message
+
+    commons.log(LOG_TAG, "sending " + str(len(tweets)) + " tweets to " + str(subscribers.repository.count(account)) + " subscribers of " + account)
+    for message in messages:
+        await outbox.send(message, name = "tweet", account = account, parse_mode = 'HTML')
+
+async def warm_up():
+
+    '''
+    Async method run once the loop has started serving updates. Loads the
+    deferred dependencies and logs the startup report.
+    '''
 
-    # send tweet to all subscribers
-    tweet_message = "<b>" + data['user']['screen_name'] + "</b>: " + data['text']
-    subscribers = commons.get_data("subscribers")
-    commons.log(LOG_TAG, "sending tweet to " + str(len(subscribers)) + " subscribers")
-    for subscriber_id in subscribers.keys():
-        await bot_delegator.sendMessage(int(subscriber_id), tweet_message, parse_mode = 'HTML')
+    startup.mark("event loop running")
+    await bot.warm_up()
+    startup.mark("warm-up")
+    startup.finish()
 
 if __name__ == '__main__':
 
+    startup.mark("imports")
+
+    # optionally write fewer records, or json records for a log drain to parse
+    log_settings = {"level": os.environ.get('LOG_LEVEL', 'info'), "format": os.environ.get('LOG_FORMAT', 'text')}
+    logs.configure(**log_settings)
+
     # fetch tokens from environment variables
     telegram_token = os.environ['BOT_TOKEN']
-    twitter_feed_account = "NTUsg"
     twitter_tokens = {
         "consumer_key": os.environ['TWITTER_CONSUMER_KEY'],
         "consumer_secret": os.environ['TWITTER_CONSUMER_SECRET'],
@@ -54,25 +100,117 @@ if __name__ == '__main__':
     commons.set_data("admins", [int(admin_id) for admin_id in administrators])
     commons.log(LOG_TAG, "initialized administrators: " + ", ".join(administrators))
 
+    # optionally follow a different set of twitter accounts; the first is the default for /subscribe
+    if 'TWITTER_ACCOUNTS' in os.environ:
+        bot.TWITTER_ACCOUNTS = os.environ['TWITTER_ACCOUNTS'].split(",")
+
+    # optionally scrape and fetch from different servers, e.g. local fake ones
+    servers = {name: os.environ[setting] for setting, name in SERVER_SETTINGS if setting in os.environ}
+    for name, url in servers.items():
+        setattr(bot, name, url)
+
+    # open subscriber storage, migrating subscribers from save_data.json if needed
+    subscribers.init(bot.TWITTER_ACCOUNTS[0])
+
     # initialize keyboards and location profiles
     bot.init()
     commons.log(LOG_TAG, "initialized bot")
+    startup.mark("bot.init")
+
+    # optionally talk to a different bot api server, e.g. a local fake one
+    if 'BOT_API_URL' in os.environ:
+        delivery.use_api_server(os.environ['BOT_API_URL'])
 
     # start bot delegator
     global bot_delegator
-    bot_delegator = telepot.aio.DelegatorBot(telegram_token, [
-        include_callback_query_chat_id(pave_event_space()) (
-            per_chat_id(), create_open, NTUCampusBot, timeout = 10
-        )
-    ])
+    bot_delegator = bot.create_delegator(telegram_token)
+    delivery.init(bot_delegator)
+
+    # seconds a callback may hold the event loop up before the watchdog records where
+    watchdog_threshold = float(os.environ.get('WATCHDOG_THRESHOLD', profiler.WATCHDOG_THRESHOLD))
+
+    # seconds between background polls of the cameras, if they are polled at all
+    poll_interval = float(os.environ['CAMERA_POLL_INTERVAL']) if 'CAMERA_POLL_INTERVAL' in os.environ else None
+
+    # optionally hand chats and fan-outs to worker processes; this process keeps the updates and the shared state
+    if int(os.environ.get('WORKERS', 0)) > 0:
+        ingress = workers.Ingress(telegram_token, int(os.environ['WORKERS']), {
+            "accounts": bot.TWITTER_ACCOUNTS,
+            "subscribers_db": subscribers.repository.db_name,
+            "api_url": os.environ.get('BOT_API_URL'),
+            "servers": servers,
+            "watchdog_threshold": watchdog_threshold,
+            "logs": log_settings,
+            "poll_interval": poll_interval
+        })
+        delivery.deliverer = ingress.deliverer
+        route = ingress.route
+    else:
+        ingress = None
+        route = None
+
+    # open the outbox log; fan-outs cut short by the last shutdown resume once the loop runs
+    outbox.init()
 
     # start twitter listener
-    stream = TwitterStream(twitter_tokens, twitter_feed_account, on_tweet)
+    stream = TwitterStream(
+        twitter_tokens, bot.TWITTER_ACCOUNTS, on_tweets, os.environ.get('TWITTER_API_HOST'), os.environ.get('TWITTER_STREAM_HOST')
+    )
     commons.log(LOG_TAG, "initialized twitter listener")
+    startup.mark("twitter listener")
 
     # begin async loop and run forever
     bot_loop = asyncio.get_event_loop()
-    bot_loop.create_task(bot_delegator.message_loop())
+    if ingress is not None:
+        ingress.start(bot_loop, bot_delegator)
+    if 'WEBHOOK_URL' in os.environ:
+        # receive updates through telegram POSTs instead of long polling
+        updates_server = webhook.start(
+            bot_loop, bot_delegator, os.environ['WEBHOOK_URL'], os.environ.get('WEBHOOK_SECRET'), int(os.environ.get('PORT', webhook.PORT)), route
+        )
+    else:
+        updates_server = None
+        bot_loop.create_task(webhook.poll(bot_delegator, route))
+    outbox.resume(bot_loop)
+    stream.start(bot_loop)
+    counters.start(bot_loop)
+    metrics.start(bot_loop)
+    news.start(bot_loop)
+    bot_loop.create_task(ingress.refresh_bus_services() if ingress else bot.refresh_bus_services())
+
+    # optionally serve the metrics to prometheus on a local port
+    if 'METRICS_PORT' in os.environ:
+        metrics_server = metrics.serve(bot_loop, int(os.environ['METRICS_PORT']))
+    else:
+        metrics_server = None
+
+    # optionally precompute crowd density for all locations in the background
+    if poll_interval is not None:
+        poller.start(bot_loop, camera.fetcher, bot.DENSITY_POOL, bot.LOCATIONS.values(), poll_interval)
     commons.log(LOG_TAG, "NTU_CampusBot ready!")
     commons.set_data("status", "running")
-    bot_loop.run_forever()
+    bot_loop.create_task(warm_up())
+
+    # record where the loop is stuck whenever a callback holds it up
+    profiler.start_watchdog(bot_loop, watchdog_threshold)
+
+    # heroku stops dynos with SIGTERM; stop the loop so pending state is flushed
+    bot_loop.add_signal_handler(signal.SIGTERM, bot_loop.stop)
+    try:
+        bot_loop.run_forever()
+    finally:
+        profiler.stop_watchdog()
+        stream.stop()
+        if ingress is not None:
+            ingress.stop()
+        if updates_server is not None:
+            bot_loop.run_until_complete(updates_server.stop())
+        if metrics_server is not None:
+            bot_loop.run_until_complete(metrics_server.stop())
+        bot_loop.run_until_complete(http_client.close())
+        bot.DENSITY_POOL.shutdown()
+        outbox.flush()
+        history.store.flush()
+        counters.flush()
+        commons.flush_data()
+        commons.log(LOG_TAG, "saved state, shutting down")
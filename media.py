@@ -0,0 +1,140 @@
+'''
+This file contains the cache of Telegram file ids for photos sent by url. The
+first time a url is sent, Telegram downloads it and returns a file id for the
+uploaded photo; every later send of the same url reuses that file id, so
+Telegram neither fetches the url again nor makes the user wait for it. File ids
+are saved inside save_data.json so they survive restarts.
+
+A process which does not write save_data.json (such as a worker process, see
+workers.py) forwards every file id it learns or drops through on_change to the
+process which does, where it is applied with apply().
+'''
+
+from telepot import exception
+
+import commons
+
+MEDIA_KEY = "media" # key of the url to file id mapping inside save_data.json
+LOG_TAG = "media"
+
+cache = None
+
+class MediaCache():
+
+    def __init__(self):
+
+        '''
+        Sets up the cache with the file ids saved by previous runs.
+        '''
+
+        self._file_ids = dict(commons.get_data().get(MEDIA_KEY, {}))
+        self.on_change = None # function called with the url and new file id (None if dropped) of every change learned here
+
+    def _changed(self, url, file_id):
+        commons.set_data(MEDIA_KEY, dict(self._file_ids))
+        if self.on_change: self.on_change(url, file_id)
+
+    def get(self, url):
+
+        '''
+        Returns the file id of the photo sent for the url, or None.
+
+        @param url: url of the photo
+        '''
+
+        return self._file_ids.get(url)
+
+    def remember(self, url, file_id):
+
+        '''
+        Records the file id Telegram assigned to the photo sent for the url.
+
+        @param url: url of the photo
+        @param file_id: file id of the uploaded photo
+        '''
+
+        if self._file_ids.get(url) != file_id:
+            self._file_ids[url] = file_id
+            self._changed(url, file_id)
+
+    def forget(self, url):
+
+        '''
+        Drops the file id of a url, e.g. when Telegram no longer accepts it.
+
+        @param url: url of the photo
+        '''
+
+        if self._file_ids.pop(url, None) is not None:
+            self._changed(url, None)
+
+    def apply(self, url, file_id):
+
+        '''
+        Records a file id learned or dropped by another process, without
+        forwarding it through on_change.
+
+        @param url: url of the photo
+        @param file_id: file id of the uploaded photo, or None if dropped
+        '''
+
+        if file_id is None:
+            if self._file_ids.pop(url, None) is None: return
+        elif self._file_ids.get(url) != file_id:
+            self._file_ids[url] = file_id
+        else:
+            return
+        commons.set_data(MEDIA_KEY, dict(self._file_ids))
+
+    def retain(self, urls):
+
+        '''
+        Drops the file ids of every url not in urls, so photos which were
+        replaced are uploaded again from their new url.
+
+        @param urls: iterable of urls that are still in use
+        '''
+
+        urls = set(urls)
+        stale = [url for url in self._file_ids if url not in urls]
+        for url in stale:
+            del self._file_ids[url]
+        if stale:
+            commons.set_data(MEDIA_KEY, dict(self._file_ids))
+            commons.log(LOG_TAG, "dropped " + str(len(stale)) + " outdated file ids")
+
+    async def send_photo(self, sender, url, **kwargs):
+
+        '''
+        Async method which sends the photo at url, by file id if it has been
+        sent before, and records the file id otherwise.
+
+        @param sender: telepot sender or bot with a sendPhoto method, e.g.
+            ChatHandler.sender
+        @param url: url of the photo
+        '''
+
+        file_id = self.get(url)
+        if file_id is not None:
+            try:
+                return await sender.sendPhoto(file_id, **kwargs)
+            except exception.TelegramError as e:
+                if e.error_code != 400: raise
+                commons.log(LOG_TAG, "file id of " + url + " rejected (" + e.description + "), sending url")
+                self.forget(url)
+
+        sent = await sender.sendPhoto(url, **kwargs)
+        if sent.get('photo'):
+            # sizes are in increasing order; the last one is the original
+            self.remember(url, sent['photo'][-1]['file_id'])
+        return sent
+
+def init():
+
+    '''
+    Creates the shared media cache.
+    '''
+
+    global cache
+    cache = MediaCache()
+    return cache
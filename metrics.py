@@ -0,0 +1,385 @@
+'''
+This file contains the latency metrics behind /metrics. Every timed operation
+is counted into a fixed-bucket histogram, so recording a duration costs a
+bisect and a few additions however long the bot runs, and percentiles are
+estimated from the bucket counts. Histograms are kept per name and labels:
+
+    command_seconds{command}     handling of a whole command or keyboard click
+    phase_seconds{phase}         one part of it, e.g. a camera fetch or decoding
+    bot_api_seconds{method}      Bot API calls, e.g. getChat or sendMessage
+    loop_lag_seconds{process}    how late the event loop wakes up from a sleep
+
+Observing is safe from any thread. Worker processes send what they observed to
+the main process every few seconds, where it is merged in. The histograms can
+also be served in the Prometheus text format on a local port.
+'''
+
+from aiohttp import web
+from bisect import bisect_left
+
+import time
+import asyncio
+import threading
+import commons
+import counters
+
+BUCKETS = [0.001, 0.0025, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10, 30] # upper bounds in seconds
+SECTIONS = [
+    ("command_seconds", "Commands"), ("phase_seconds", "Phases"), ("bot_api_seconds", "Bot API"), ("loop_lag_seconds", "Event loop lag")
+]
+LAG_INTERVAL = 0.5 # seconds between event loop lag samples
+FORWARD_INTERVAL = 5 # seconds between a worker's sends of its histograms
+PREFIX = "campusbot_" # of every metric name served to Prometheus
+HOST = "127.0.0.1"
+LOG_TAG = "metrics"
+
+class Histogram():
+
+    def __init__(self, buckets = BUCKETS):
+
+        '''
+        Sets up an empty histogram.
+
+        @param buckets: ascending upper bounds of the buckets in seconds
+        '''
+
+        self.buckets = buckets
+        self.counts = [0] * (len(buckets) + 1) # the last one counts everything above the largest bound
+        self.sum = 0.0
+        self.count = 0
+
+    def observe(self, seconds):
+        self.counts[bisect_left(self.buckets, seconds)] += 1
+        self.sum += seconds
+        self.count += 1
+
+    def merge(self, counts, total):
+        for index, count in enumerate(counts):
+            self.counts[index] += count
+        self.sum += total
+        self.count += sum(counts)
+
+    def quantile(self, fraction):
+
+        '''
+        Returns the upper bound of the bucket the given fraction of
+        observations falls in, or None if it is above the largest bound.
+
+        @param fraction: e.g. 0.99 for the 99th percentile
+        '''
+
+        rank = fraction * self.count
+        seen = 0
+        for bound, count in zip(self.buckets, self.counts):
+            seen += count
+            if seen >= rank: return bound
+        return None
+
+class Metrics():
+
+    def __init__(self, buckets = BUCKETS):
+
+        '''
+        Sets up an empty set of histograms.
+
+        @param buckets: ascending upper bounds of the buckets in seconds
+        '''
+
+        self.buckets = buckets
+        self.histograms = {} # (name, tuple of sorted label pairs) to Histogram
+        self._lock = threading.Lock()
+
+    def _histogram(self, name, labels):
+        histogram = self.histograms.get((name, labels))
+        if histogram is None:
+            histogram = self.histograms[(name, labels)] = Histogram(self.buckets)
+        return histogram
+
+    def observe(self, name, seconds, labels = ()):
+
+        '''
+        Counts a duration into the histogram of name and labels.
+
+        @param name: name of the histogram, e.g. "command_seconds"
+        @param seconds: the duration
+        @param labels: tuple of sorted (label, value) pairs
+        '''
+
+        with self._lock:
+            self._histogram(name, labels).observe(seconds)
+
+    def drain(self):
+
+        '''
+        Returns every histogram as a list of (name, labels, counts, sum) and
+        starts over, e.g. to merge them into another process.
+        '''
+
+        with self._lock:
+            histograms, self.histograms = self.histograms, {}
+        return [(name, labels, histogram.counts, histogram.sum) for (name, labels), histogram in histograms.items()]
+
+    def merge(self, histograms):
+
+        '''
+        Adds histograms returned by drain() onto these.
+
+        @param histograms: list of (name, labels, counts, sum)
+        '''
+
+        with self._lock:
+            for name, labels, counts, total in histograms:
+                self._histogram(name, tuple(tuple(label) for label in labels)).merge(counts, total)
+
+    def sorted(self):
+
+        '''
+        Returns a copy of every histogram as a sorted list of
+        ((name, labels), Histogram).
+        '''
+
+        with self._lock:
+            copies = []
+            for key, histogram in self.histograms.items():
+                copy = Histogram(self.buckets)
+                copy.merge(histogram.counts, histogram.sum)
+                copies.append((key, copy))
+        return sorted(copies, key = lambda item: item[0])
+
+class Timer():
+
+    def __init__(self, name, labels):
+
+        '''
+        Context manager which observes the time spent inside it, including any
+        time spent awaiting.
+
+        @param name: name of the histogram
+        @param labels: tuple of sorted (label, value) pairs
+        '''
+
+        self.name = name
+        self.labels = labels
+
+    def __enter__(self):
+        self.started = time.perf_counter()
+        return self
+
+    def __exit__(self, *exc_info):
+        self.seconds = time.perf_counter() - self.started
+        _metrics.observe(self.name, self.seconds, self.labels)
+
+class MetricsServer():
+
+    def __init__(self, path = "/metrics"):
+
+        '''
+        Sets up the server which serves the metrics on path.
+
+        @param path: path Prometheus scrapes
+        '''
+
+        self.path = path
+        self._runner = None
+
+    async def handle(self, request):
+        return web.Response(body = prometheus().encode("utf-8"), headers = {"Content-Type": "text/plain; version=0.0.4; charset=utf-8"})
+
+    async def start(self, port, host = HOST):
+
+        '''
+        Async method which starts listening.
+
+        @param port: port to listen on
+        @param host: interface to listen on
+        '''
+
+        app = web.Application()
+        app.router.add_get(self.path, self.handle)
+        self._runner = web.AppRunner(app)
+        await self._runner.setup()
+        await web.TCPSite(self._runner, host, port).start()
+        commons.log(LOG_TAG, "serving metrics on " + host + ":" + str(port) + self.path)
+
+    async def stop(self):
+
+        '''
+        Async method which stops listening.
+        '''
+
+        if self._runner is not None:
+            await self._runner.cleanup()
+            self._runner = None
+
+_metrics = Metrics()
+
+def _labels(**labels):
+    return tuple(sorted((key, str(value)) for key, value in labels.items()))
+
+def observe(name, seconds, **labels):
+
+    '''
+    Counts a duration into a histogram.
+
+    @param name: name of the histogram, e.g. "phase_seconds"
+    @param seconds: the duration
+    @param labels: label values of the histogram, e.g. phase = "decode"
+    '''
+
+    _metrics.observe(name, seconds, _labels(**labels))
+
+def timer(name, **labels):
+
+    '''
+    Returns a context manager which counts the time spent inside it into a
+    histogram, e.g. with metrics.timer("phase_seconds", phase = "decode").
+
+    @param name: name of the histogram
+    @param labels: label values of the histogram
+    '''
+
+    return Timer(name, _labels(**labels))
+
+def merge(histograms):
+
+    '''
+    Adds histograms observed by another process.
+
+    @param histograms: list of (name, labels, counts, sum) as sent by forward()
+    '''
+
+    _metrics.merge(histograms)
+
+def _format(seconds):
+    return str(int(round(seconds * 1000))) + "ms" if seconds < 1 else str(round(seconds, 1)) + "s"
+
+def _format_bound(bound):
+    return ">" + _format(BUCKETS[-1]) if bound is None else "<" + _format(bound)
+
+def summary():
+
+    '''
+    Returns the metrics as text for /metrics: the number of observations, the
+    mean and the estimated 50th and 99th percentiles of every histogram.
+    '''
+
+    histograms = _metrics.sorted()
+    sections = []
+    for name, title in SECTIONS:
+        lines = [
+            (" ".join(value for _, value in labels) or name) + ": " + str(histogram.count) + ", " + _format(histogram.sum / histogram.count)
+            + ", " + _format_bound(histogram.quantile(0.5)) + ", " + _format_bound(histogram.quantile(0.99))
+            for (histogram_name, labels), histogram in histograms if histogram_name == name and histogram.count
+        ]
+        if lines:
+            sections.append(title + ":\n" + "\n".join(lines))
+    return "\n\n".join(sections)
+
+def _prometheus_labels(labels):
+    if not labels: return ""
+    escape = lambda value: value.replace("\\", "\\\\").replace("\"", "\\\"").replace("\n", "\\n")
+    return "{" + ",".join(label + "=\"" + escape(value) + "\"" for label, value in labels) + "}"
+
+def prometheus():
+
+    '''
+    Returns every histogram, along with the command and tweet totals behind
+    /stats, in the Prometheus text exposition format.
+    '''
+
+    lines = []
+    histograms = _metrics.sorted()
+    for name in sorted(set(name for (name, _), _ in histograms)):
+        lines.append("# TYPE " + PREFIX + name + " histogram")
+        for (histogram_name, labels), histogram in histograms:
+            if histogram_name != name: continue
+            cumulative = 0
+            for bound, count in zip(BUCKETS + [None], histogram.counts):
+                cumulative += count
+                bucket_labels = labels + (("le", "+Inf" if bound is None else "%g" % bound),)
+                lines.append(PREFIX + name + "_bucket" + _prometheus_labels(bucket_labels) + " " + str(cumulative))
+            lines.append(PREFIX + name + "_sum" + _prometheus_labels(labels) + " " + repr(histogram.sum))
+            lines.append(PREFIX + name + "_count" + _prometheus_labels(labels) + " " + str(histogram.count))
+
+    lines.append("# TYPE " + PREFIX + "calls_total counter")
+    for name, count in sorted(counters.totals().items()):
+        lines.append(PREFIX + "calls_total" + _prometheus_labels((("name", name),)) + " " + str(count))
+    return "\n".join(lines) + "\n"
+
+async def _watch_lag(process, interval):
+
+    '''
+    Async method which keeps measuring how much later than asked the loop
+    wakes up from a sleep, which is how long callbacks held it up.
+    '''
+
+    loop = asyncio.get_event_loop()
+    while True:
+        started = loop.time()
+        await asyncio.sleep(interval)
+        observe("loop_lag_seconds", max(0.0, loop.time() - started - interval), process = process)
+
+async def _forward(send, interval):
+    while True:
+        await asyncio.sleep(interval)
+        histograms = _metrics.drain()
+        if histograms: send(histograms)
+
+def instrument_bot_api():
+
+    '''
+    Times every Bot API call made through telepot, by method. Only wraps
+    telepot once, however often it is called.
+    '''
+
+    import telepot.aio.api
+
+    request = telepot.aio.api.request
+    if getattr(request, "timed", False): return
+
+    async def timed_request(req, **user_kw):
+        with timer("bot_api_seconds", method = req[1]):
+            return await request(req, **user_kw)
+
+    timed_request.timed = True
+    telepot.aio.api.request = timed_request
+
+def start(loop, process = "main", interval = LAG_INTERVAL):
+
+    '''
+    Starts measuring the event loop lag of this process.
+
+    @param loop: event loop the bot runs on
+    @param process: name of this process in the loop_lag_seconds histogram
+    @param interval: number of seconds between lag samples
+    '''
+
+    return loop.create_task(_watch_lag(process, interval))
+
+def forward(loop, send, interval = FORWARD_INTERVAL):
+
+    '''
+    Hands everything observed in this process to send every interval
+    seconds, e.g. to merge it into the process answering /metrics.
+
+    @param loop: event loop the bot runs on
+    @param send: function taking the list of (name, labels, counts, sum)
+    @param interval: number of seconds between sends
+    '''
+
+    return loop.create_task(_forward(send, interval))
+
+def serve(loop, port, host = HOST):
+
+    '''
+    Starts serving the metrics for Prometheus on the given event loop.
+    Returns the server.
+
+    @param loop: event loop the bot runs on
+    @param port: port to listen on
+    @param host: interface to listen on; only the local machine by default
+    '''
+
+    server = MetricsServer()
+    loop.run_until_complete(server.start(port, host))
+    return server
@@ -0,0 +1,150 @@
+'''
+This file contains the news cache behind /news. The latest items from NTU News
+Hub are parsed once and kept in memory so that /news can be answered right
+away. Items older than a set age are still served, but trigger a refresh in the
+background (stale-while-revalidate); refreshes use conditional requests so an
+unchanged page is not downloaded and parsed again, and concurrent refreshes
+share one request. Need to call init() before use.
+'''
+
+import time
+import asyncio
+import commons
+import extract
+import metrics
+import http_client
+
+MAX_AGE = 5 * 60 # seconds before cached news is considered stale
+FETCH_TIMEOUT = 60 # seconds; the news hub is slow
+LOG_TAG = "news"
+
+cache = None
+
+class NewsCache():
+
+    def __init__(self, url, count, max_age = MAX_AGE):
+
+        '''
+        Sets up an empty news cache.
+
+        @param url: url of the news hub page
+        @param count: number of news items to keep
+        @param max_age: number of seconds before cached news is refreshed
+        '''
+
+        self.url = url
+        self.count = count
+        self.max_age = max_age
+        self.items = None
+        self.fetched = 0
+        self._etag = None
+        self._last_modified = None
+        self._refreshing = None
+
+    def is_warm(self):
+
+        '''
+        Returns True if there are news items to serve right away.
+        '''
+
+        return self.items is not None
+
+    async def _fetch(self):
+
+        '''
+        Async method which downloads and parses the news hub page, unless it has
+        not changed since the last download.
+        '''
+
+        headers = {}
+        if self._etag: headers["If-None-Match"] = self._etag
+        if self._last_modified: headers["If-Modified-Since"] = self._last_modified
+
+        with metrics.timer("phase_seconds", phase = "news_fetch"):
+            response = await http_client.get(self.url, headers = headers, timeout = FETCH_TIMEOUT)
+        if response.status == 304 and self.items is not None:
+            self.fetched = time.time()
+            return self.items
+
+        # parsing still takes a while on a big page, keep it off the event loop
+        with metrics.timer("phase_seconds", phase = "news_parse"):
+            items = await asyncio.get_event_loop().run_in_executor(None, extract.parse_news, response.text(), self.count)
+        self.items, self.fetched = items, time.time()
+        self._etag, self._last_modified = response.headers.get("ETag"), response.headers.get("Last-Modified")
+        commons.log(LOG_TAG, "refreshed " + str(len(items)) + " news items")
+        return items
+
+    def refresh(self):
+
+        '''
+        Starts a refresh unless one is already in progress, and returns the
+        future of the refresh in progress.
+        '''
+
+        if self._refreshing is None or self._refreshing.done():
+            self._refreshing = asyncio.ensure_future(self._fetch())
+            self._refreshing.add_done_callback(self._log_failure)
+        return self._refreshing
+
+    def _log_failure(self, future):
+
+        '''
+        Logs a refresh that failed, so background refreshes do not fail silently.
+        '''
+
+        if not future.cancelled() and future.exception():
+            commons.log(LOG_TAG, "failed to refresh news: " + repr(future.exception()))
+
+    async def get(self):
+
+        '''
+        Async method which returns the cached news items. Only waits for the
+        news hub if nothing has been cached yet; stale items are returned right
+        away while a refresh happens in the background.
+        '''
+
+        if self.items is None:
+            return await asyncio.shield(self.refresh())
+        if time.time() - self.fetched > self.max_age:
+            self.refresh()
+        return self.items
+
+    async def run(self):
+
+        '''
+        Async method which keeps the cache warm by refreshing it every max_age
+        seconds until cancelled.
+        '''
+
+        while True:
+            try:
+                await asyncio.shield(self.refresh())
+            except asyncio.CancelledError:
+                raise
+            except Exception:
+                pass # already logged
+            await asyncio.sleep(self.max_age)
+
+def init(url, count, max_age = MAX_AGE):
+
+    '''
+    Creates the shared news cache.
+
+    @param url: url of the news hub page
+    @param count: number of news items to keep
+    @param max_age: number of seconds before cached news is refreshed
+    '''
+
+    global cache
+    cache = NewsCache(url, count, max_age)
+    return cache
+
+def start(loop):
+
+    '''
+    Warms the news cache now and keeps it warm on the given event loop.
+
+    @param loop: event loop the bot runs on
+    '''
+
+    return loop.create_task(cache.run())
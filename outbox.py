@@ -0,0 +1,342 @@
+'''
+This file contains the durable outbox that tweet and broadcast fan-outs go
+through. Before anything is sent, a job (the message and who it goes to) is
+appended to a local log. As recipients are done, the job's progress is appended
+as well: a cursor below which every recipient is done, plus the recipients
+above it that are already done, which together act as the idempotency keys of
+the job. On boot, unfinished jobs are resumed from their last progress, skipping
+everyone who already got the message. The log is rewritten with only the
+unfinished jobs whenever a job finishes. Need to call init() on the main script
+before use.
+
+The log is only written by a single writer thread, so the event loop never
+waits on the disk and records still reach the log in the order they were
+made. A job is only sent once its record is on disk, and is only done once
+the log has been rewritten without it; progress is written in the background.
+'''
+
+from collections import OrderedDict, deque
+from concurrent.futures import ThreadPoolExecutor
+
+import os
+import json
+import time
+import uuid
+import asyncio
+import commons
+import metrics
+import delivery
+import tempfile
+import subscribers
+
+OUTBOX_FILE_NAME = "outbox.log"
+CHECKPOINT_INTERVAL = 1 # seconds between progress records of a running job
+LOG_TAG = "outbox"
+
+class Job():
+
+    def __init__(self, id, name, text, account = None, kwargs = None, total = 0):
+
+        '''
+        Describes one fan-out of a message to the subscribers.
+
+        @param id: unique id of the job
+        @param name: short description, e.g. "tweet" or "broadcast"
+        @param text: the message to send
+        @param account: optional twitter username whose subscribers receive the
+            message; every subscriber if not given
+        @param kwargs: extra parameters passed on to sendMessage
+        @param total: number of recipients when the job was created
+        '''
+
+        self.id = id
+        self.name = name
+        self.text = text
+        self.account = account
+        self.kwargs = kwargs or {}
+        self.total = total
+        self.cursor = None # every recipient up to and including this chat id is done
+        self.done = set() # chat ids above the cursor which are done
+        self.delivered = 0
+        self.failed = 0
+        self.checkpointed = 0
+
+    def record(self):
+        return {"op": "job", "id": self.id, "name": self.name, "text": self.text, "account": self.account, "kwargs": self.kwargs, "total": self.total}
+
+    def progress(self):
+        return {"op": "progress", "id": self.id, "cursor": self.cursor, "done": sorted(self.done), "delivered": self.delivered, "failed": self.failed}
+
+    def restore(self, progress):
+
+        '''
+        Picks up from a progress record read back from the log.
+        '''
+
+        self.cursor = progress["cursor"]
+        self.done = set(progress["done"])
+        self.delivered = progress["delivered"]
+        self.failed = progress["failed"]
+
+    def __str__(self):
+        return "%s%s [%s]: %d/%d delivered, %d failed" % (
+            self.name, " from " + self.account if self.account else "", self.id, self.delivered, self.total, self.failed
+        )
+
+class Outbox():
+
+    def __init__(self, file_name = OUTBOX_FILE_NAME):
+
+        '''
+        Opens the outbox log, loading every job which has not finished.
+
+        @param file_name: path to the outbox log
+        '''
+
+        self.file_name = file_name
+        self.jobs = OrderedDict()
+        self._writer = ThreadPoolExecutor(max_workers = 1, thread_name_prefix = "outbox-writer")
+        self._load()
+        self.compact()
+
+    def _load(self):
+
+        '''
+        Replays the log. A partially written last line, left by a crash, is
+        ignored.
+        '''
+
+        if not os.path.exists(self.file_name): return
+        with open(self.file_name, 'r') as log_file:
+            for line in log_file:
+                try:
+                    record = json.loads(line)
+                except ValueError:
+                    continue
+                if record["op"] == "job":
+                    self.jobs[record["id"]] = Job(
+                        record["id"], record["name"], record["text"], record["account"], record["kwargs"], record["total"]
+                    )
+                elif record["id"] in self.jobs:
+                    if record["op"] == "progress":
+                        self.jobs[record["id"]].restore(record)
+                    elif record["op"] == "done":
+                        del self.jobs[record["id"]]
+
+    def _write(self, function, *args):
+
+        '''
+        Hands a write to the writer thread, which runs it after every write
+        handed over before. Returns its concurrent.futures.Future; a failure is
+        logged.
+        '''
+
+        future = self._writer.submit(function, *args)
+        future.add_done_callback(self._check_write)
+        return future
+
+    def _check_write(self, future):
+        if future.exception() is not None:
+            commons.log(LOG_TAG, "failed to write " + self.file_name + " (" + repr(future.exception()) + ")", commons.ERROR)
+
+    def _append(self, record):
+
+        '''
+        Runs on the writer thread. Appends a record to the log and makes sure
+        it is on disk.
+        '''
+
+        with metrics.timer("phase_seconds", phase = "outbox_write"), open(self.file_name, 'a') as log_file:
+            log_file.write(json.dumps(record) + "\n")
+            log_file.flush()
+            os.fsync(log_file.fileno())
+
+    def _rewrite(self, records):
+
+        '''
+        Runs on the writer thread. Atomically replaces the log with the given
+        records.
+        '''
+
+        directory = os.path.dirname(os.path.abspath(self.file_name))
+        with metrics.timer("phase_seconds", phase = "outbox_write"):
+            file_descriptor, temp_name = tempfile.mkstemp(dir = directory, prefix = ".outbox.", suffix = ".tmp")
+            with os.fdopen(file_descriptor, 'w') as temp_file:
+                for record in records:
+                    temp_file.write(json.dumps(record) + "\n")
+                temp_file.flush()
+                os.fsync(temp_file.fileno())
+            os.replace(temp_name, self.file_name)
+
+    def _unfinished(self):
+
+        '''
+        Returns the records of every unfinished job and its latest progress, as
+        they are now.
+        '''
+
+        records = []
+        for job in self.jobs.values():
+            records += [job.record(), job.progress()]
+        return records
+
+    def compact(self):
+
+        '''
+        Atomically rewrites the log with only the unfinished jobs and their
+        latest progress, and waits until it is done.
+        '''
+
+        self._write(self._rewrite, self._unfinished()).result()
+
+    def checkpoint(self, job):
+
+        '''
+        Appends the current progress of a job in the background. Returns the
+        concurrent.futures.Future of the write.
+        '''
+
+        job.done = {chat_id for chat_id in job.done if job.cursor is None or chat_id > job.cursor}
+        job.checkpointed = time.monotonic()
+        return self._write(self._append, job.progress())
+
+    def flush(self):
+
+        '''
+        Checkpoints every unfinished job, e.g. before shutting down, and waits
+        until everything written so far is on disk.
+        '''
+
+        for job in self.jobs.values():
+            self.checkpoint(job)
+        self._write(lambda: None).result() # the writer goes in order, so this comes after every write before it
+
+    async def send(self, text, name = "message", account = None, **kwargs):
+
+        '''
+        Async method which records a new job and then delivers it. Returns the
+        delivery.DeliveryReport.
+
+        @param text: the message to send
+        @param name: short description used when logging the report
+        @param account: optional twitter username whose subscribers receive the
+            message; every subscriber if not given
+        @param kwargs: extra parameters passed on to sendMessage
+        '''
+
+        loop = asyncio.get_event_loop()
+        total = await loop.run_in_executor(None, subscribers.repository.count, account)
+        job = Job(uuid.uuid4().hex[:12], name, text, account, kwargs, total)
+        self.jobs[job.id] = job
+        await asyncio.wrap_future(self._write(self._append, job.record()))
+        return await self._run(job)
+
+    async def _run(self, job):
+
+        '''
+        Async method which delivers a job to every recipient after its cursor
+        who is not done yet, checkpointing along the way.
+        '''
+
+        handed_out = deque() # recipients in the ascending order they were handed to the deliverer
+        skipped = set(job.done)
+
+        def recipients():
+            for chat_id in subscribers.repository.iter_ids(after = job.cursor, account = job.account):
+                if chat_id in skipped: continue # already got it before a restart
+                handed_out.append(chat_id)
+                yield chat_id
+
+        def on_result(chat_id, delivered):
+            job.done.add(chat_id)
+            if delivered:
+                job.delivered += 1
+            else:
+                job.failed += 1
+            # move the cursor past every recipient handed out before the oldest one still in flight
+            while handed_out and handed_out[0] in job.done:
+                job.cursor = handed_out.popleft()
+            if time.monotonic() - job.checkpointed >= CHECKPOINT_INTERVAL:
+                self.checkpoint(job)
+
+        report = await delivery.deliverer.send_message(recipients(), job.text, job.name, on_result, **job.kwargs)
+        self._write(self._append, {"op": "done", "id": job.id})
+        del self.jobs[job.id]
+        await asyncio.wrap_future(self._write(self._rewrite, self._unfinished()))
+        return report
+
+    def resume(self, loop):
+
+        '''
+        Resumes every unfinished job loaded from the log on the given loop.
+
+        @param loop: event loop the bot runs on
+        '''
+
+        for job in list(self.jobs.values()):
+            commons.log(LOG_TAG, "resuming " + str(job))
+            loop.create_task(self._run(job))
+
+    def status(self):
+
+        '''
+        Returns a description of the progress of every unfinished job.
+        '''
+
+        return [str(job) for job in self.jobs.values()]
+
+_outbox = None
+
+def init(file_name = OUTBOX_FILE_NAME):
+
+    '''
+    Opens the outbox log.
+
+    @param file_name: path to the outbox log
+    '''
+
+    global _outbox
+    _outbox = Outbox(file_name)
+    commons.log(LOG_TAG, str(len(_outbox.jobs)) + " unfinished jobs")
+    return _outbox
+
+async def send(text, name = "message", account = None, **kwargs):
+
+    '''
+    Async method which durably fans a message out to subscribers. Returns the
+    delivery.DeliveryReport.
+
+    @param text: the message to send
+    @param name: short description used when logging the report
+    @param account: optional twitter username whose subscribers receive the
+        message; every subscriber if not given
+    @param kwargs: extra parameters passed on to sendMessage
+    '''
+
+    return await _outbox.send(text, name, account, **kwargs)
+
+def resume(loop):
+
+    '''
+    Resumes the jobs left unfinished by the previous run.
+
+    @param loop: event loop the bot runs on
+    '''
+
+    _outbox.resume(loop)
+
+def status():
+
+    '''
+    Returns a description of the progress of every unfinished job.
+    '''
+
+    return _outbox.status() if _outbox else []
+
+def flush():
+
+    '''
+    Checkpoints every unfinished job.
+    '''
+
+    if _outbox: _outbox.flush()
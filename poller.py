@@ -0,0 +1,134 @@
+'''
+This file contains the optional background camera poller. Every profiled
+location is fetched on a fixed cadence and classified off the event loop, and
+the result is published as that location's latest snapshot, so /peek only has
+to look it up instead of waiting on the camera and the classifier. A camera
+whose frame cannot be downloaded or classified is retried with exponential
+backoff, while the others are published as usual. Locations without a profile
+opt out, since there is no density to precompute for them; they are still
+fetched on demand.
+'''
+
+import time
+import asyncio
+import commons
+
+POLL_INTERVAL = 30 # seconds; matches the refresh rate of the NTU webcams
+MAX_BACKOFF = 10 * 60 # seconds
+LOG_TAG = "poller"
+
+class CameraPoller():
+
+    def __init__(self, fetcher, pool, locations, interval = POLL_INTERVAL):
+
+        '''
+        Sets up a poller for the given locations.
+
+        @param fetcher: camera.CameraFetcher to download with and publish to
+        @param pool: density.DensityPool used to classify the frames
+        @param locations: iterable of camera names; those without a profile
+            in the pool are skipped
+        @param interval: number of seconds between polls of the same camera
+        '''
+
+        self.fetcher = fetcher
+        self.pool = pool
+        self.interval = interval
+        self.locations = [location for location in locations if location in pool.locations]
+        self._next_poll = {location: 0 for location in self.locations}
+        self._failures = {location: 0 for location in self.locations}
+
+    def _back_off(self, location, action, error):
+
+        '''
+        Puts off the next poll of a location which failed, for twice as long
+        as the last time.
+        '''
+
+        self._failures[location] += 1
+        delay = min(self.interval * (2 ** self._failures[location]), MAX_BACKOFF)
+        self._next_poll[location] = time.time() + delay
+        commons.log(LOG_TAG, "failed to " + action + " " + location + " (" + error + "), retrying in " + str(round(delay, 1)) + "s")
+
+    async def _download(self, location):
+
+        '''
+        Async method which downloads a frame. Returns None if the download
+        failed.
+        '''
+
+        try:
+            return await self.fetcher.download(location)
+        except Exception as e:
+            self._back_off(location, "fetch", repr(e))
+            return None
+
+    async def poll(self):
+
+        '''
+        Async method which polls every location that is due, classifying all of
+        the downloaded frames in a single batch. A location whose frame could
+        not be downloaded or classified backs off without holding up the rest.
+        '''
+
+        now = time.time()
+        due = [location for location in self.locations if self._next_poll[location] <= now]
+        images = await asyncio.gather(*[self._download(location) for location in due])
+        frames = [(location, image) for location, image in zip(due, images) if image is not None]
+        if not frames: return
+
+        try:
+            results = await self.pool.classify_batch(frames)
+        except Exception as e:
+            results = [(None, repr(e))] * len(frames)
+        for (location, image), result in zip(frames, results):
+            if result is not None and result[0] is None:
+                self._back_off(location, "classify", result[1])
+                continue
+            self._failures[location] = 0
+            self._next_poll[location] = now + self.interval
+            self.fetcher.publish(location, image, result, now)
+
+    async def run(self):
+
+        '''
+        Async method which keeps polling until cancelled.
+        '''
+
+        commons.log(LOG_TAG, "polling " + ", ".join(self.locations) + " every " + str(self.interval) + "s")
+        while True:
+            try:
+                await self.poll()
+            except asyncio.CancelledError:
+                raise
+            except Exception as e:
+                commons.log(LOG_TAG, "poll failed: " + repr(e))
+            await asyncio.sleep(max(0, min(self._next_poll.values(), default = time.time() + self.interval) - time.time()))
+
+def start(loop, fetcher, pool, locations, interval = POLL_INTERVAL):
+
+    '''
+    Starts polling on the given event loop. Cached snapshots are kept for at
+    least one poll interval so that lookups are served by the poller.
+
+    @param loop: event loop the bot runs on
+    @param fetcher: camera.CameraFetcher to download with and publish to
+    @param pool: density.DensityPool used to classify the frames
+    @param locations: iterable of camera names
+    @param interval: number of seconds between polls of the same camera
+    '''
+
+    keep_snapshots(fetcher, interval)
+    return loop.create_task(CameraPoller(fetcher, pool, locations, interval).run())
+
+def keep_snapshots(fetcher, interval = POLL_INTERVAL):
+
+    '''
+    Keeps the cached snapshots of a fetcher for at least one poll interval, so
+    that lookups are served by the poller, which may be in another process.
+
+    @param fetcher: camera.CameraFetcher the snapshots are published to
+    @param interval: number of seconds between polls of the same camera
+    '''
+
+    fetcher.ttl = max(fetcher.ttl, interval * 2)
@@ -0,0 +1,211 @@
+'''
+This file contains the tools for finding out where the time goes in the running
+bot, for stalls which only show up under real load. The sampling profiler behind
+/profile takes the stack of every thread a hundred times a second from a side
+thread, so the event loop does no extra work, and counts them as collapsed
+stacks: one "thread;outermost;...;innermost count" line per distinct stack,
+which flamegraph.pl or speedscope turn into a flame graph.
+
+The watchdog notices when a callback holds the event loop up for longer than a
+threshold, and records the stack of the loop thread while it is still stuck.
+'''
+
+from collections import Counter, deque
+
+import os
+import sys
+import time
+import asyncio
+import threading
+import traceback
+import commons
+
+SAMPLE_INTERVAL = 0.01 # seconds between stack samples
+DEFAULT_SECONDS = 10
+MAX_SECONDS = 60
+WATCHDOG_INTERVAL = 0.1 # seconds between heartbeats of the event loop
+WATCHDOG_THRESHOLD = 0.5 # seconds the event loop may be held up before its stack is recorded
+STALLS = 20 # recent stalls kept
+LOG_TAG = "profiler"
+
+def _frame_name(frame):
+    code = frame.f_code
+    return code.co_name + " (" + os.path.basename(code.co_filename) + ":" + str(code.co_firstlineno) + ")"
+
+def _collapse(frame):
+
+    '''
+    Returns the stack ending in frame as ;-separated frame names, outermost
+    first.
+    '''
+
+    names = []
+    while frame is not None:
+        names.append(_frame_name(frame))
+        frame = frame.f_back
+    return ";".join(reversed(names))
+
+class SamplingProfiler():
+
+    def __init__(self, interval = SAMPLE_INTERVAL):
+
+        '''
+        Sets up a profiler which samples every thread of this process once
+        started.
+
+        @param interval: seconds between samples
+        '''
+
+        self.interval = interval
+        self.samples = 0
+        self.stacks = Counter()
+        self._stopping = threading.Event()
+        self._thread = None
+
+    def _run(self):
+
+        '''
+        Runs on the sampler thread. Counts the current stack of every other
+        thread until stopped.
+        '''
+
+        own = threading.get_ident()
+        while not self._stopping.wait(self.interval):
+            names = {thread.ident: thread.name for thread in threading.enumerate()}
+            for ident, frame in sys._current_frames().items():
+                if ident == own: continue
+                self.stacks[names.get(ident, str(ident)) + ";" + _collapse(frame)] += 1
+            self.samples += 1
+
+    def start(self):
+        self._thread = threading.Thread(target = self._run, name = "profiler", daemon = True)
+        self._thread.start()
+
+    def stop(self):
+        self._stopping.set()
+        self._thread.join()
+
+    def collapsed(self):
+
+        '''
+        Returns the sampled stacks in the collapsed format, most frequent
+        first.
+        '''
+
+        return "".join(stack + " " + str(count) + "\n" for stack, count in self.stacks.most_common())
+
+class Watchdog():
+
+    def __init__(self, loop, threshold = WATCHDOG_THRESHOLD, interval = WATCHDOG_INTERVAL):
+
+        '''
+        Sets up a watchdog over an event loop. Nothing is watched until
+        start().
+
+        @param loop: event loop to watch
+        @param threshold: seconds the loop may be held up before its stack is
+            recorded
+        @param interval: seconds between heartbeats of the loop, and between
+            checks of the watchdog
+        '''
+
+        self.loop = loop
+        self.threshold = threshold
+        self.interval = interval
+        self.stalls = deque(maxlen = STALLS) # (time, seconds held up so far, stack) of recent stalls
+        self._beat = None
+        self._loop_thread = None
+        self._stopping = threading.Event()
+
+    def _heartbeat(self):
+        self._loop_thread = threading.get_ident()
+        self._beat = time.monotonic()
+        self.loop.call_later(self.interval, self._heartbeat)
+
+    def _watch(self):
+
+        '''
+        Runs on the watchdog thread. Records the stack of the loop thread once
+        per stall, as soon as the loop has missed its heartbeats for longer
+        than the threshold.
+        '''
+
+        reported = None
+        while not self._stopping.wait(self.interval):
+            beat = self._beat
+            if beat is None or beat == reported: continue
+            blocked = time.monotonic() - beat
+            if blocked < self.threshold: continue
+
+            frame = sys._current_frames().get(self._loop_thread)
+            if frame is None: continue
+            reported = beat
+            stack = "".join(traceback.format_stack(frame))
+            self.stalls.append((time.time(), blocked, stack))
+            commons.log(LOG_TAG, "event loop held up for over " + str(round(blocked, 2)) + "s at:\n" + stack.rstrip())
+
+    def start(self):
+
+        '''
+        Starts the heartbeats on the loop and the watchdog thread. The loop is
+        only watched once it is running.
+        '''
+
+        self.loop.call_soon_threadsafe(self._heartbeat)
+        threading.Thread(target = self._watch, name = "loop-watchdog", daemon = True).start()
+
+    def stop(self):
+        self._stopping.set()
+
+_watchdog = None
+_profiling = False
+
+async def profile(seconds = DEFAULT_SECONDS):
+
+    '''
+    Async method which samples every thread of this process for the given
+    number of seconds, up to MAX_SECONDS. Returns the SamplingProfiler. Raises
+    RuntimeError if a profile is already being taken.
+
+    @param seconds: how long to sample for
+    '''
+
+    global _profiling
+    if _profiling: raise RuntimeError("already profiling")
+    _profiling = True
+    profiler = SamplingProfiler()
+    profiler.start()
+    try:
+        await asyncio.sleep(min(seconds, MAX_SECONDS))
+    finally:
+        profiler.stop()
+        _profiling = False
+    return profiler
+
+def start_watchdog(loop, threshold = WATCHDOG_THRESHOLD):
+
+    '''
+    Starts watching the given event loop for callbacks holding it up.
+
+    @param loop: event loop the bot runs on
+    @param threshold: seconds the loop may be held up before its stack is
+        recorded
+    '''
+
+    global _watchdog
+    _watchdog = Watchdog(loop, threshold)
+    _watchdog.start()
+    commons.log(LOG_TAG, "watching the event loop for stalls over " + str(threshold) + "s")
+    return _watchdog
+
+def stop_watchdog():
+    if _watchdog: _watchdog.stop()
+
+def stalls():
+
+    '''
+    Returns the recent stalls recorded by the watchdog, oldest first, as
+    (time, seconds held up when recorded, stack).
+    '''
+
+    return list(_watchdog.stalls) if _watchdog else []
@@ -0,0 +1,145 @@
+'''
+This file contains the location profile compiler. The full/average/empty JPEGs
+inside /profiles are decoded once into a single flat .npy bundle, next to a small
+JSON index of where each location's profiles are in it. The bundle is only
+rebuilt when a source image changes, and is opened memory-mapped, so starting up
+does no decoding and every process reading it shares the same pages.
+'''
+
+import os
+import re
+import json
+import commons
+
+np = commons.lazy_import("numpy")
+
+PROFILE_NAMES = ["average", "full", "empty"] # order the profiles of a location are stacked in
+PROFILE_FILE_NAME = "%s_%s.jpg" # location, profile name
+BUNDLE_FILE_NAME = "profiles.npy"
+INDEX_FILE_NAME = "profiles.json"
+BUNDLE_VERSION = 1
+SOURCE_PATTERN = re.compile(r"^(.+)_(" + "|".join(PROFILE_NAMES) + r")\.jpg$")
+LOG_TAG = "profiles"
+
+def _sources(profile_dir):
+
+    '''
+    Returns the modification times of every profile image, by file name, and
+    the locations which have an image for every profile.
+
+    @param profile_dir: directory containing the profile images
+    '''
+
+    sources, found = {}, {}
+    for file_name in sorted(os.listdir(profile_dir)):
+        match = SOURCE_PATTERN.match(file_name)
+        if match:
+            sources[file_name] = os.path.getmtime(os.path.join(profile_dir, file_name))
+            found.setdefault(match.group(1), set()).add(match.group(2))
+    return sources, sorted(location for location, names in found.items() if len(names) == len(PROFILE_NAMES))
+
+def _read_index(index_path):
+
+    '''
+    Returns the contents of the bundle index, or None if it cannot be read.
+    '''
+
+    try:
+        with open(index_path, 'r') as index_file:
+            return json.load(index_file)
+    except (OSError, ValueError):
+        return None
+
+def compile_profiles(profile_dir):
+
+    '''
+    Decodes every location's profile images and writes them into the bundle,
+    stacked as (profile, height, width, channel) in PROFILE_NAMES order, and
+    then writes the index. A location with an image that cannot be decoded, or
+    images of different sizes, is logged and left out, so its camera is sent
+    without a density until the images are fixed.
+
+    @param profile_dir: directory containing the profile images
+    '''
+
+    from scipy import misc
+
+    sources, locations = _sources(profile_dir)
+    bundle_path = os.path.join(profile_dir, BUNDLE_FILE_NAME)
+    index = {"version": BUNDLE_VERSION, "sources": sources, "locations": {}, "size": 0}
+
+    stacks = []
+    for location in locations:
+        try:
+            stack = np.stack([misc.imread(os.path.join(profile_dir, PROFILE_FILE_NAME % (location, name))) for name in PROFILE_NAMES])
+        except (OSError, ValueError) as e:
+            commons.log(LOG_TAG, "skipping profiles of " + location + ": " + repr(e), commons.ERROR)
+            continue
+        index["locations"][location] = {"offset": index["size"], "shape": list(stack.shape)}
+        index["size"] += stack.size
+        stacks.append((location, stack))
+
+    temp_path = bundle_path + ".tmp.npy"
+    bundle = np.lib.format.open_memmap(temp_path, mode = 'w+', dtype = np.uint8, shape = (max(index["size"], 1),))
+    for location, stack in stacks:
+        offset = index["locations"][location]["offset"]
+        bundle[offset:offset + stack.size] = stack.ravel()
+    bundle.flush()
+    del bundle
+    os.replace(temp_path, bundle_path)
+
+    # the index goes last; a bundle without a matching index is never used
+    index_path = os.path.join(profile_dir, INDEX_FILE_NAME)
+    with open(index_path + ".tmp", 'w') as index_file:
+        json.dump(index, index_file)
+    os.replace(index_path + ".tmp", index_path)
+
+    commons.log(LOG_TAG, "compiled profiles of " + ", ".join(index["locations"]))
+    return index
+
+def ensure_bundle(profile_dir):
+
+    '''
+    Compiles the bundle if it is missing or any profile image has been added,
+    removed or modified since it was compiled. Returns the index.
+
+    @param profile_dir: directory containing the profile images
+    '''
+
+    sources, _ = _sources(profile_dir)
+    index = _read_index(os.path.join(profile_dir, INDEX_FILE_NAME))
+    if index is None or index.get("version") != BUNDLE_VERSION or index.get("sources") != sources \
+            or not os.path.exists(os.path.join(profile_dir, BUNDLE_FILE_NAME)):
+        index = compile_profiles(profile_dir)
+    return index
+
+class ProfileBundle():
+
+    def __init__(self, profile_dir):
+
+        '''
+        Opens a compiled bundle memory-mapped. Nothing is read from disk until
+        a location's profiles are first requested.
+
+        @param profile_dir: directory containing the compiled bundle
+        '''
+
+        self.index = _read_index(os.path.join(profile_dir, INDEX_FILE_NAME))
+        self.locations = set(self.index["locations"].keys())
+        self._bundle = np.load(os.path.join(profile_dir, BUNDLE_FILE_NAME), mmap_mode = 'r')
+        self._stacks = {}
+
+    def get(self, location):
+
+        '''
+        Returns the read-only (profile, height, width, channel) stack of a
+        location, as a view into the mapped bundle.
+
+        @param location: camera name as found in bot.LOCATIONS
+        '''
+
+        if location not in self._stacks:
+            entry = self.index["locations"][location]
+            size = int(np.prod(entry["shape"]))
+            self._stacks[location] = self._bundle[entry["offset"]:entry["offset"] + size].reshape(entry["shape"])
+        return self._stacks[location]
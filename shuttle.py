@@ -0,0 +1,121 @@
+'''
+This file contains the shuttle bus route scraping behind /shuttle. All of the
+route pages are fetched concurrently, and the parsed services are saved to a
+versioned cache file so that the bot can start with the last known routes right
+away and refresh them in the background once it is serving.
+'''
+
+import os
+import json
+import time
+import asyncio
+import commons
+import extract
+import metrics
+import tempfile
+import http_client
+
+CACHE_FILE_NAME = "shuttle_cache.json"
+CACHE_VERSION = 1 # bump whenever the format of the cached services changes
+FETCH_TIMEOUT = 30 # seconds
+LOG_TAG = "shuttle"
+
+def _format_route(service):
+
+    '''
+    Returns the route information of a service as sent to users.
+
+    @param service: extract.ShuttleService record
+    '''
+
+    # function to get list of bus stops of a route
+    parse_bus_stops = lambda route: "\n".join([str(index + 1) + ". " + bus_stop for index, bus_stop in enumerate(route.stops)])
+
+    # combine all sub routes (as combination of the sub route header with its list) with other sub routes,
+    # or just a list of bus stops if the service has no sub route header
+    shuttle_bus_route = "".join([
+        ("\n<b>" + route.name + "</b>\n" if route.name is not None else "") + parse_bus_stops(route) for route in service.routes
+    ])
+    return "<b>%s</b>\n\n<b>ROUTE</b>\n%s" % (service.name.upper(), shuttle_bus_route)
+
+async def fetch_services(base_url, index_path):
+
+    '''
+    Async method which scrapes the shuttle bus services. The index page is
+    fetched first, then the info pages of all services at the same time.
+    Returns a dictionary of service name to its image url and route info. A
+    service without an info page, or whose info page has no image, has None
+    as its image url.
+
+    @param base_url: base url of the NTU website
+    @param index_path: path of the shuttle bus page relative to base_url
+    '''
+
+    async def load(path):
+        if path is None: return None
+        return (await http_client.get(base_url + path, timeout = FETCH_TIMEOUT)).text()
+
+    services = extract.parse_shuttle_services(await load(index_path))
+    info_pages = await asyncio.gather(*[load(service.info_link) for service in services])
+
+    return {
+        service.name: {
+            # scrape bus service image url
+            "image_url": extract.parse_shuttle_image(info_page) if info_page is not None else None,
+            # bus route information
+            "info": _format_route(service)
+        }
+        for service, info_page in zip(services, info_pages)
+    }
+
+def load_cache(file_name = CACHE_FILE_NAME):
+
+    '''
+    Returns the services saved in the cache file, or None if there is no cache
+    or it was written by an incompatible version.
+
+    @param file_name: path to the cache file
+    '''
+
+    try:
+        with open(file_name, 'r') as cache_file:
+            cache = json.load(cache_file)
+    except (OSError, ValueError):
+        return None
+
+    if cache.get("version") != CACHE_VERSION: return None
+    return cache["services"]
+
+def save_cache(services, file_name = CACHE_FILE_NAME):
+
+    '''
+    Atomically replaces the cache file with the given services.
+
+    @param services: dictionary as returned by fetch_services
+    @param file_name: path to the cache file
+    '''
+
+    directory = os.path.dirname(os.path.abspath(file_name))
+    file_descriptor, temp_name = tempfile.mkstemp(dir = directory, prefix = ".shuttle_cache.", suffix = ".tmp")
+    with os.fdopen(file_descriptor, 'w') as temp_file:
+        json.dump({"version": CACHE_VERSION, "fetched": time.time(), "services": services}, temp_file)
+    os.replace(temp_name, file_name)
+
+async def refresh(base_url, index_path, file_name = CACHE_FILE_NAME):
+
+    '''
+    Async method which scrapes the services and saves them to the cache file.
+    Returns the services.
+
+    @param base_url: base url of the NTU website
+    @param index_path: path of the shuttle bus page relative to base_url
+    @param file_name: path to the cache file
+    '''
+
+    started = time.time()
+    with metrics.timer("phase_seconds", phase = "shuttle_fetch"):
+        services = await fetch_services(base_url, index_path)
+    with metrics.timer("phase_seconds", phase = "shuttle_save"):
+        save_cache(services, file_name)
+    commons.log(LOG_TAG, "refreshed " + str(len(services)) + " services in " + str(round(time.time() - started, 2)) + "s")
+    return services
@@ -0,0 +1,125 @@
+'''
+This file contains the startup timing report. Once begin() is called, every
+module imported on the main thread is timed the way python -X importtime does,
+and the set-up sequence marks each phase it goes through. The report, with the
+phases and the slowest imports, is logged by finish() once the bot is ready.
+'''
+
+import os
+import sys
+import time
+import threading
+import commons
+
+SLOWEST_IMPORTS = 10 # number of imports listed in the report
+LOG_TAG = "startup"
+
+class _TimedLoader():
+
+    '''
+    Wraps the loader of a module being imported so that loading it is timed.
+    Everything else is passed through to the original loader.
+    '''
+
+    def __init__(self, loader, timer):
+        self._loader = loader
+        self._timer = timer
+
+    def __getattr__(self, name):
+        return getattr(self._loader, name)
+
+    def create_module(self, spec):
+        return self._timer.time(spec.name, self._loader.create_module, spec)
+
+    def exec_module(self, module):
+        return self._timer.time(module.__name__, self._loader.exec_module, module)
+
+class _ImportTimer():
+
+    def __init__(self):
+
+        '''
+        Sets up a meta path finder which times imports on the current thread
+        of the current process.
+        '''
+
+        self.imports = {} # top-level import name to seconds, including nested imports
+        self._depth = 0
+        self._thread = threading.get_ident()
+        self._pid = os.getpid()
+
+    def _is_timed(self):
+        return threading.get_ident() == self._thread and os.getpid() == self._pid
+
+    def find_spec(self, name, path = None, target = None):
+        if not self._is_timed(): return None
+        for finder in sys.meta_path:
+            if finder is self or not hasattr(finder, "find_spec"): continue
+            spec = finder.find_spec(name, path, target)
+            if spec is not None:
+                if spec.loader is not None and hasattr(spec.loader, "exec_module"):
+                    spec.loader = _TimedLoader(spec.loader, self)
+                return spec
+        return None
+
+    def time(self, name, function, *args):
+
+        '''
+        Calls function with args, adding its duration to the import name if it
+        was not imported from within another timed import.
+        '''
+
+        if not self._is_timed(): return function(*args)
+        started = time.perf_counter()
+        self._depth += 1
+        try:
+            return function(*args)
+        finally:
+            self._depth -= 1
+            if self._depth == 0:
+                self.imports[name] = self.imports.get(name, 0) + time.perf_counter() - started
+
+_started = time.perf_counter()
+_phases = [] # (name, seconds since previous mark)
+_last_mark = _started
+_timer = None
+
+def begin():
+
+    '''
+    Starts timing imports. Call as early as possible on the main script.
+    '''
+
+    global _timer
+    _timer = _ImportTimer()
+    sys.meta_path.insert(0, _timer)
+
+def mark(phase):
+
+    '''
+    Records that a phase of the set-up sequence has finished.
+
+    @param phase: short description of what was done since the last mark
+    '''
+
+    global _last_mark
+    now = time.perf_counter()
+    _phases.append((phase, now - _last_mark))
+    _last_mark = now
+
+def finish():
+
+    '''
+    Stops timing imports and logs the startup report.
+    '''
+
+    if _timer is not None and _timer in sys.meta_path:
+        sys.meta_path.remove(_timer)
+
+    lines = ["startup took " + str(round(_last_mark - _started, 2)) + "s"]
+    lines += ["  %-24s %6.3fs" % (phase, seconds) for phase, seconds in _phases]
+    if _timer is not None:
+        slowest = sorted(_timer.imports.items(), key = lambda item: item[1], reverse = True)[:SLOWEST_IMPORTS]
+        lines.append("slowest imports:")
+        lines += ["  %-24s %6.3fs" % (name, seconds) for name, seconds in slowest]
+    commons.log(LOG_TAG, "\n".join(lines))
@@ -0,0 +1,318 @@
+'''
+This file contains the subscriber storage used to keep track of the chats that
+receive tweets and broadcasts. Storage is accessed through the repository, any
+object with the public methods of SQLiteSubscriberRepository, so the backend
+can be swapped out without touching the bot; the default backend is an indexed
+SQLite table. Need to call init() on the main script before use.
+
+Subscribers choose which twitter accounts they receive tweets from. Besides the
+subscribers themselves, an inverted index from account to chat ids is kept,
+clustered by account, so the recipients of a tweet are found with one range
+scan over only the chats subscribed to its account.
+'''
+
+import sqlite3
+import threading
+import commons
+
+SUBSCRIBERS_DB_NAME = "subscribers.db"
+SCHEMA_VERSION = 1 # stored as the database's user_version
+PAGE_SIZE = 500
+LOG_TAG = "subscribers"
+
+repository = None
+
+class SQLiteSubscriberRepository():
+
+    '''
+    Subscriber storage backed by SQLite. Subscriber ids are the integer chat
+    ids provided by telegram. Any object with the same public methods can be
+    used as the repository, e.g. workers.RemoteRepository in a worker process.
+    '''
+
+    def __init__(self, db_name = SUBSCRIBERS_DB_NAME, default_account = None, read_only = False):
+
+        '''
+        Opens (and creates if needed) the subscribers database. Chat ids are
+        stored as the table's integer primary key, so lookups, inserts and
+        deletes are all B-tree operations. Subscriptions are pairs of small
+        integer account ids and chat ids in a WITHOUT ROWID table keyed by
+        account first, with a secondary index by chat.
+
+        @param db_name: path to the SQLite database file
+        @param default_account: screen name of the account subscribers from
+            before accounts could be chosen are subscribed to
+        @param read_only: open an existing database for reading only, e.g. in
+            a process which is not the one writing it
+        '''
+
+        self.db_name = db_name
+        self._lock = threading.Lock()
+        self._account_ids = {}
+        if read_only:
+            self._connection = sqlite3.connect("file:" + db_name + "?mode=ro", uri = True, check_same_thread = False)
+            return
+
+        self._connection = sqlite3.connect(db_name, check_same_thread = False)
+        with self._lock, self._connection:
+            self._connection.execute("PRAGMA journal_mode = WAL")
+            self._connection.execute("PRAGMA synchronous = NORMAL")
+            self._connection.execute(
+                "CREATE TABLE IF NOT EXISTS subscribers (chat_id INTEGER PRIMARY KEY, name TEXT NOT NULL)"
+            )
+            self._connection.execute(
+                "CREATE TABLE IF NOT EXISTS accounts (account_id INTEGER PRIMARY KEY, name TEXT NOT NULL UNIQUE COLLATE NOCASE)"
+            )
+            self._connection.execute(
+                "CREATE TABLE IF NOT EXISTS subscriptions (account_id INTEGER NOT NULL, chat_id INTEGER NOT NULL, "
+                "PRIMARY KEY (account_id, chat_id)) WITHOUT ROWID"
+            )
+            self._connection.execute("CREATE INDEX IF NOT EXISTS subscriptions_by_chat ON subscriptions (chat_id)")
+
+            version = self._connection.execute("PRAGMA user_version").fetchone()[0]
+            if version < 1 and default_account is not None:
+                # every existing subscriber was following the default account
+                self._connection.execute(
+                    "INSERT OR IGNORE INTO subscriptions (account_id, chat_id) SELECT ?, chat_id FROM subscribers",
+                    (self._account_id(default_account),)
+                )
+                commons.log(LOG_TAG, "subscribed existing subscribers to " + default_account)
+            if default_account is not None:
+                self._connection.execute("PRAGMA user_version = " + str(SCHEMA_VERSION))
+
+    def _find_account_id(self, account):
+
+        '''
+        Returns the id of an account, or None if nobody ever subscribed to it.
+        Only reads, so is safe on a read-only connection. Must be called while
+        holding the lock.
+        '''
+
+        key = account.lower()
+        if key not in self._account_ids:
+            row = self._connection.execute("SELECT account_id FROM accounts WHERE name = ?", (account,)).fetchone()
+            if row is None: return None
+            self._account_ids[key] = row[0]
+        return self._account_ids[key]
+
+    def _account_id(self, account):
+
+        '''
+        Returns the id of an account, creating it if needed. Only for
+        subscribing and migrating; must be called while holding the lock.
+        '''
+
+        account_id = self._find_account_id(account)
+        if account_id is None:
+            self._connection.execute("INSERT OR IGNORE INTO accounts (name) VALUES (?)", (account,))
+            account_id = self._find_account_id(account)
+        return account_id
+
+    def _query(self, statement, parameters = ()):
+
+        '''
+        Runs a read-only statement and returns all rows.
+        '''
+
+        with self._lock:
+            return self._connection.execute(statement, parameters).fetchall()
+
+    def subscribe(self, id, name, account):
+
+        '''
+        Subscribes a chat to the tweets of an account, registering it as a
+        subscriber if needed. Returns False if it was already subscribed to the
+        account.
+
+        @param id: unique chat id as provided by telegram
+        @param name: string to identify the user
+        @param account: screen name of the twitter account
+        '''
+
+        with self._lock, self._connection:
+            self._connection.execute("INSERT OR IGNORE INTO subscribers (chat_id, name) VALUES (?, ?)", (int(id), name))
+            return self._connection.execute(
+                "INSERT OR IGNORE INTO subscriptions (account_id, chat_id) VALUES (?, ?)", (self._account_id(account), int(id))
+            ).rowcount > 0
+
+    def subscribe_many(self, subscribers, account):
+
+        '''
+        Subscribes multiple chats to an account at once.
+
+        @param subscribers: iterable of (id, name) pairs
+        @param account: screen name of the twitter account
+        '''
+
+        subscribers = [(int(id), name) for id, name in subscribers]
+        with self._lock, self._connection:
+            account_id = self._account_id(account)
+            self._connection.executemany("INSERT OR IGNORE INTO subscribers (chat_id, name) VALUES (?, ?)", subscribers)
+            self._connection.executemany(
+                "INSERT OR IGNORE INTO subscriptions (account_id, chat_id) VALUES (?, ?)",
+                ((account_id, id) for id, _ in subscribers)
+            )
+
+    def unsubscribe(self, id, account = None):
+
+        '''
+        Unsubscribes a chat from an account, or from every account if none is
+        given. A chat left without subscriptions is no longer a subscriber.
+        Returns False if the chat was not subscribed.
+
+        @param id: unique chat id as provided by telegram
+        @param account: optional screen name of the twitter account
+        '''
+
+        with self._lock, self._connection:
+            if account is None:
+                removed = self._connection.execute("DELETE FROM subscriptions WHERE chat_id = ?", (int(id),)).rowcount
+            else:
+                removed = self._connection.execute(
+                    "DELETE FROM subscriptions WHERE account_id = ? AND chat_id = ?", (self._find_account_id(account), int(id))
+                ).rowcount
+            self._connection.execute(
+                "DELETE FROM subscribers WHERE chat_id = ? AND NOT EXISTS (SELECT 1 FROM subscriptions WHERE chat_id = ?)",
+                (int(id), int(id))
+            )
+            return removed > 0
+
+    def get_name(self, id):
+
+        '''
+        Returns the name stored for a subscriber, or None if not subscribed.
+
+        @param id: unique chat id as provided by telegram
+        '''
+
+        rows = self._query("SELECT name FROM subscribers WHERE chat_id = ?", (int(id),))
+        return rows[0][0] if rows else None
+
+    def count(self, account = None):
+
+        '''
+        Returns the total number of subscribers, or the number subscribed to
+        an account.
+
+        @param account: optional screen name of the twitter account
+        '''
+
+        if account is None:
+            return self._query("SELECT COUNT(*) FROM subscribers")[0][0]
+        return self._query(
+            "SELECT COUNT(*) FROM subscriptions JOIN accounts USING (account_id) WHERE accounts.name = ?", (account,)
+        )[0][0]
+
+    def _iter_rows(self, column, after, page_size):
+
+        '''
+        Keyset pagination over the primary key. Each page is a fresh indexed
+        range scan, so no read transaction is held open while the caller is
+        busy with the rows, and subscribes/unsubscribes in between are safe.
+        '''
+
+        while True:
+            if after is None:
+                rows = self._query("SELECT chat_id, " + column + " FROM subscribers ORDER BY chat_id LIMIT ?", (page_size,))
+            else:
+                rows = self._query("SELECT chat_id, " + column + " FROM subscribers WHERE chat_id > ? ORDER BY chat_id LIMIT ?", (int(after), page_size))
+            for row in rows:
+                yield row
+            if len(rows) < page_size: return
+            after = rows[-1][0]
+
+    def _iter_subscribed(self, account, after, page_size):
+
+        '''
+        Keyset pagination over the subscriptions of one account, which is a
+        range of the subscriptions primary key.
+        '''
+
+        with self._lock:
+            account_id = self._find_account_id(account)
+        if account_id is None: return
+        after = -1 << 63 if after is None else int(after)
+        while True:
+            rows = self._query(
+                "SELECT chat_id FROM subscriptions WHERE account_id = ? AND chat_id > ? ORDER BY chat_id LIMIT ?",
+                (account_id, after, page_size)
+            )
+            for row in rows:
+                yield row[0]
+            if len(rows) < page_size: return
+            after = rows[-1][0]
+
+    def iter_ids(self, after = None, page_size = PAGE_SIZE, account = None):
+
+        '''
+        Yields subscriber ids in ascending order, one page at a time, so callers
+        can stream recipients without loading all of them at once.
+
+        @param after: optional id to resume from (exclusive)
+        @param page_size: number of ids fetched from storage per page
+        @param account: optional screen name of the twitter account whose
+            subscribers to yield; all subscribers if not given
+        '''
+
+        if account is not None:
+            yield from self._iter_subscribed(account, after, page_size)
+            return
+        for chat_id, _ in self._iter_rows("chat_id", after, page_size):
+            yield chat_id
+
+    def iter_names(self, page_size = PAGE_SIZE):
+
+        '''
+        Yields subscriber names in ascending order of their ids.
+
+        @param page_size: number of names fetched from storage per page
+        '''
+
+        for _, name in self._iter_rows("name", None, page_size):
+            yield name
+
+    def close(self):
+
+        '''
+        Releases any resources held by the backend.
+        '''
+
+        with self._lock:
+            self._connection.close()
+
+def migrate_from_json(target, account):
+
+    '''
+    One-shot migration of subscribers kept in the legacy "subscribers" dict of
+    the save file into the given repository. The legacy dict is emptied once
+    its contents are stored, so running this again is a no-op.
+
+    @param target: repository to move subscribers into
+    @param account: screen name of the account the legacy subscribers follow
+    '''
+
+    legacy_subscribers = commons.get_data().get("subscribers")
+    if not legacy_subscribers: return 0
+
+    target.subscribe_many(legacy_subscribers.items(), account)
+    commons.set_data("subscribers", {})
+    commons.flush_data()
+    commons.log(LOG_TAG, "migrated " + str(len(legacy_subscribers)) + " subscribers from " + commons.SAVE_FILE_NAME)
+    return len(legacy_subscribers)
+
+def init(default_account, db_name = SUBSCRIBERS_DB_NAME):
+
+    '''
+    Opens the subscriber repository and migrates any subscribers still stored
+    in the save file.
+
+    @param default_account: screen name of the account that subscribers from
+        before accounts could be chosen follow
+    @param db_name: path to the SQLite database file
+    '''
+
+    global repository
+    repository = SQLiteSubscriberRepository(db_name, default_account)
+    migrate_from_json(repository, default_account)
+    commons.log(LOG_TAG, "subscribers ready: " + str(repository.count()))
+    return repository
@@ -0,0 +1,46 @@
+'''
+Shared fixtures for the tests. The modules of the bot live at the top of the
+repository, so it is put on the import path first.
+'''
+
+import os
+import sys
+import json
+import pytest
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), ".."))
+
+import commons
+
+@pytest.fixture
+def save_file(tmp_path):
+
+    '''
+    Path of a save file holding an empty document.
+    '''
+
+    file_name = str(tmp_path / "save_data.json")
+    with open(file_name, 'w') as save_file:
+        json.dump({}, save_file)
+    return file_name
+
+@pytest.fixture
+def store(save_file):
+
+    '''
+    A StateStore on a scratch save file which never flushes on its own.
+    '''
+
+    store = commons.StateStore(save_file, flush_interval = 3600)
+    yield store
+    store._stopping.set()
+
+@pytest.fixture
+def shared_store(store, monkeypatch):
+
+    '''
+    Swaps the store behind commons.get_data/set_data for a scratch one.
+    '''
+
+    monkeypatch.setattr(commons, "_store", store)
+    return store
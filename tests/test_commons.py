@@ -0,0 +1,76 @@
+import os
+import json
+import commons
+
+def read(file_name):
+    with open(file_name, 'r') as save_file:
+        return json.load(save_file)
+
+def test_set_is_served_from_memory_until_flushed(store, save_file):
+    store.set("status", "running")
+    assert store.get("status") == "running"
+    assert read(save_file) == {}
+
+    store.flush()
+    assert read(save_file) == {"status": "running"}
+    assert not store._dirty
+
+def test_flush_without_changes_does_not_rewrite(store, save_file):
+    store.set("status", "running")
+    store.flush()
+    with open(save_file, 'w') as save_file_handle:
+        save_file_handle.write('{"changed": "elsewhere"}')
+
+    store.flush()
+    assert read(save_file) == {"changed": "elsewhere"}
+
+def test_failed_replace_keeps_old_file_and_dirty_keys(store, save_file, monkeypatch):
+    store.set("status", "running")
+    store.flush()
+    store.set("status", "maintenance")
+
+    def failing_replace(source, target):
+        raise OSError("disk full")
+    monkeypatch.setattr(commons.os, "replace", failing_replace)
+    store.flush()
+
+    assert read(save_file) == {"status": "running"}
+    assert store._dirty == {"status"}
+    assert [name for name in os.listdir(os.path.dirname(save_file)) if name.endswith(".tmp")] == []
+
+    monkeypatch.undo()
+    store.flush()
+    assert read(save_file) == {"status": "maintenance"}
+
+def test_unserializable_value_keeps_dirty_keys(store, save_file):
+    store.set("status", "running")
+    store.set("broken", object())
+    store.flush()
+    assert store._dirty == {"status", "broken"}
+    assert read(save_file) == {}
+
+    store.set("broken", "fixed")
+    store.flush()
+    assert read(save_file) == {"status": "running", "broken": "fixed"}
+
+def test_flusher_survives_a_failing_flush(store, save_file, monkeypatch):
+    store.flush_interval = 0.01
+    flushes = []
+
+    def flaky_flush():
+        flushes.append(None)
+        if len(flushes) == 1: raise RuntimeError("first flush fails")
+    monkeypatch.setattr(store, "flush", flaky_flush)
+    store.set("status", "running")
+
+    store._flusher.join(0.2)
+    assert store._flusher.is_alive()
+    assert len(flushes) > 1
+
+def test_read_only_store_never_writes(store, save_file):
+    store.read_only = True
+    store.set("status", "running")
+    store.flush()
+    assert store.get("status") == "running"
+    assert read(save_file) == {}
+    assert store._flusher is None
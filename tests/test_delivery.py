@@ -0,0 +1,98 @@
+import time
+import asyncio
+import pytest
+import delivery
+
+from telepot import exception
+
+def test_bucket_capacity_defaults_to_one_second_of_tokens():
+    assert delivery.TokenBucket(30).capacity == 30
+    assert delivery.TokenBucket(30, capacity = 5).capacity == 5
+    assert delivery.TokenBucket(0.5).capacity == 1
+
+def test_bucket_hands_out_its_capacity_at_once_then_refills_at_rate():
+
+    async def take(bucket, count):
+        started = time.monotonic()
+        for _ in range(count):
+            await bucket.acquire()
+        return time.monotonic() - started
+
+    bucket = delivery.TokenBucket(50, capacity = 5)
+    assert asyncio.run(take(bucket, 5)) < 0.02
+    assert not bucket.is_full()
+    assert asyncio.run(take(bucket, 5)) >= 5 / 50 * 0.9
+
+def test_paused_bucket_hands_out_nothing():
+
+    async def take(bucket):
+        started = time.monotonic()
+        await bucket.acquire()
+        return time.monotonic() - started
+
+    bucket = delivery.TokenBucket(1000)
+    bucket.pause(0.1)
+    assert asyncio.run(take(bucket)) >= 0.09
+
+class FakeBot():
+
+    def __init__(self, failures):
+
+        '''
+        Records every message sent, failing each chat with the errors given
+        for it, one per attempt.
+        '''
+
+        self.failures = {chat_id: list(errors) for chat_id, errors in failures.items()}
+        self.sent = []
+
+    async def sendMessage(self, chat_id, text, **kwargs):
+        if self.failures.get(chat_id):
+            raise self.failures[chat_id].pop(0)
+        self.sent.append(chat_id)
+
+@pytest.fixture
+def no_backoff(monkeypatch):
+    monkeypatch.setattr(delivery, "BACKOFF_BASE", 0)
+    monkeypatch.setattr(delivery, "PRIVATE_CHAT_RATE", 1000)
+
+def deliver(bot, recipients):
+    results = {}
+    deliverer = delivery.Deliverer(bot, concurrency = 3, global_rate = 1000)
+    report = asyncio.run(deliverer.send_message(recipients, "hello", on_result = results.__setitem__))
+    return report, results
+
+def test_failures_are_isolated_per_recipient(no_backoff):
+    bot = FakeBot({2: [exception.BotWasBlockedError("Forbidden: bot was blocked by the user", 403, {})]})
+    report, results = deliver(bot, [1, 2, 3])
+    assert sorted(bot.sent) == [1, 3]
+    assert results == {1: True, 2: False, 3: True}
+    assert (report.sent, report.failed) == (2, 1)
+
+def test_transient_errors_are_retried(no_backoff):
+    bot = FakeBot({1: [asyncio.TimeoutError(), exception.TelegramError("Bad Gateway", 502, {})]})
+    report, results = deliver(bot, [1])
+    assert results == {1: True}
+    assert report.retries == 2
+
+def test_retries_give_up_after_max_attempts(no_backoff):
+    bot = FakeBot({1: [asyncio.TimeoutError()] * delivery.MAX_ATTEMPTS})
+    report, results = deliver(bot, [1])
+    assert results == {1: False}
+    assert report.failed == 1
+
+def test_too_many_requests_pauses_for_retry_after(no_backoff):
+    rate_limited = exception.TooManyRequestsError("Too Many Requests: retry after 1", 429, {"parameters": {"retry_after": 0.2}})
+    bot = FakeBot({1: [rate_limited]})
+    started = time.monotonic()
+    report, results = deliver(bot, [1, 2])
+    assert results == {1: True, 2: True}
+    assert time.monotonic() - started >= 0.19
+    assert report.retries == 0
+
+def test_too_many_requests_count_as_attempts(no_backoff):
+    rate_limited = exception.TooManyRequestsError("Too Many Requests: retry after 1", 429, {"parameters": {"retry_after": 0.01}})
+    bot = FakeBot({1: [rate_limited] * delivery.MAX_ATTEMPTS})
+    report, results = deliver(bot, [1, 2])
+    assert results == {1: False, 2: True}
+    assert (report.sent, report.failed) == (1, 1)
@@ -0,0 +1,46 @@
+from io import BytesIO
+
+import numpy as np
+import pytest
+import density
+
+misc = pytest.importorskip("scipy.misc")
+
+SHAPE = (2, 3, 3)
+
+def encode(frame):
+    data = BytesIO()
+    np.save(data, frame)
+    return data.getvalue()
+
+@pytest.fixture
+def classifier(monkeypatch):
+
+    '''
+    Sets up the classifier of a worker process in this one, with flat grey
+    profiles for one location. Frames are "decoded" with np.load, so they can
+    be made without an image encoder.
+    '''
+
+    classifier = density.DensityClassifier()
+    classifier.add_location("canteen", {name: np.full(SHAPE, 80 * index, dtype = np.uint8) for index, name in enumerate(density.PROFILE_NAMES)})
+    monkeypatch.setattr(density, "_classifier", classifier)
+    monkeypatch.setattr(misc, "imread", np.load)
+    return classifier
+
+def test_bad_frames_only_fail_their_own_result(classifier):
+    frames = [
+        ("canteen", encode(np.full(SHAPE, 80 * (len(density.PROFILE_NAMES) - 1), dtype = np.uint8))),
+        ("canteen", b"not an image"),
+        ("canteen", encode(np.zeros((4, 4, 3), dtype = np.uint8))),
+        ("library", encode(np.zeros(SHAPE, dtype = np.uint8))),
+        ("canteen", encode(np.zeros(SHAPE, dtype = np.uint8))),
+    ]
+    results, timings = density._classify_frames(frames)
+
+    assert results[0][0] == density.PROFILE_NAMES[-1]
+    assert results[1][0] is None and isinstance(results[1][1], str)
+    assert results[2][0] is None and "does not match" in results[2][1]
+    assert results[3] is None
+    assert results[4][0] == density.PROFILE_NAMES[0]
+    assert len(timings) == 2 * 2 # a decode and an mse per classified frame
@@ -0,0 +1,63 @@
+import math
+import history
+
+START = 1704070800 # Mon 1 Jan 2024, 09:00 in Singapore
+
+def test_ring_wraps_over_the_oldest_records(tmp_path):
+    file_name = str(tmp_path / "canteen.bin")
+    buffer = history.RingBuffer(file_name, capacity = 3)
+    for minute in range(5):
+        buffer.append(START + minute * 60, minute % len(history.LABELS))
+
+    timestamps, labels = buffer.valid()
+    assert sorted(timestamps.tolist()) == [START + 120, START + 180, START + 240]
+    assert int(buffer.header["next"][0]) == 5 % 3
+    buffer.flush()
+
+    # an existing file keeps its capacity and records
+    reopened = history.RingBuffer(file_name, capacity = 10)
+    assert reopened.capacity == 3
+    assert sorted(reopened.valid()[0].tolist()) == sorted(timestamps.tolist())
+
+def test_aggregate_by_local_hour_and_day(tmp_path):
+    store = history.History(str(tmp_path), capacity = 10)
+    store.record("canteen", "full", START)
+    store.record("canteen", "empty", START + 60)
+    store.record("canteen", "average", START + 86400) # Tuesday
+
+    by_hour, by_day, count = store.aggregate("canteen")
+    assert count == 3
+    assert by_hour[9] == 0.5
+    assert by_day[0] == 0.5 and by_day[1] == 0.5
+    assert math.isnan(by_hour[8]) and math.isnan(by_day[2])
+
+def test_aggregate_only_sees_records_left_after_wrapping(tmp_path):
+    store = history.History(str(tmp_path), capacity = 2)
+    store.record("canteen", "full", START)
+    store.record("canteen", "empty", START + 3600)
+    store.record("canteen", "empty", START + 7200)
+
+    by_hour, _, count = store.aggregate("canteen")
+    assert count == 2
+    assert math.isnan(by_hour[9])
+    assert by_hour[10] == 0 and by_hour[11] == 0
+
+def test_read_only_history_sees_the_writers_records(tmp_path):
+    reader = history.History(str(tmp_path), capacity = 10, read_only = True)
+    assert reader.aggregate("canteen")[2] == 0
+
+    writer = history.History(str(tmp_path), capacity = 10)
+    writer.record("canteen", "full", START)
+    assert reader.aggregate("canteen")[2] == 1
+    writer.record("canteen", "empty", START + 60)
+    assert reader.aggregate("canteen")[2] == 2
+
+def test_records_of_the_same_minute_keep_the_latest(tmp_path):
+    buffer = history.RingBuffer(str(tmp_path / "canteen.bin"), capacity = 3)
+    buffer.append(START, 0)
+    buffer.append(START + 30, 2)
+    buffer.append(START + 60, 1)
+
+    timestamps, labels = buffer.valid()
+    assert timestamps.tolist() == [START + 30, START + 60]
+    assert labels.tolist() == [2, 1]
@@ -0,0 +1,103 @@
+import os
+import asyncio
+import pytest
+import threading
+import delivery
+import outbox
+import subscribers
+
+class Crash(Exception):
+    pass
+
+class FakeDeliverer():
+
+    def __init__(self, finish_order = None, crash_after = None):
+
+        '''
+        Stands in for delivery.deliverer. Takes every recipient, reports them
+        done in finish_order (the order taken if not given), and raises Crash
+        after crash_after results as if the process had died.
+        '''
+
+        self.finish_order = finish_order
+        self.crash_after = crash_after
+        self.sent = []
+
+    async def send_message(self, recipients, text, name = "message", on_result = None, **kwargs):
+        taken = list(recipients)
+        for count, chat_id in enumerate(self.finish_order or taken):
+            if count == self.crash_after: raise Crash()
+            self.sent.append(chat_id)
+            on_result(chat_id, True)
+
+@pytest.fixture
+def log_file(tmp_path, monkeypatch):
+    repository = subscribers.SQLiteSubscriberRepository(str(tmp_path / "subscribers.db"), "NTUsg")
+    repository.subscribe_many([(chat_id, "chat") for chat_id in range(1, 11)], "NTUsg")
+    monkeypatch.setattr(subscribers, "repository", repository)
+    monkeypatch.setattr(outbox, "CHECKPOINT_INTERVAL", 0)
+    return str(tmp_path / "outbox.log")
+
+def send(log_file, deliverer, monkeypatch):
+    monkeypatch.setattr(delivery, "deliverer", deliverer)
+    box = outbox.Outbox(log_file)
+    with pytest.raises(Crash):
+        asyncio.run(box.send("tweet", "tweet", "NTUsg"))
+    box._writer.shutdown(wait = True) # what was handed to the writer before the crash reaches the log
+
+def resume(log_file, monkeypatch):
+    deliverer = FakeDeliverer()
+    monkeypatch.setattr(delivery, "deliverer", deliverer)
+    box = outbox.Outbox(log_file)
+    jobs = list(box.jobs.values())
+    for job in jobs:
+        asyncio.run(box._run(job))
+    return box, jobs, deliverer.sent
+
+def test_resume_skips_recipients_already_done(log_file, monkeypatch):
+    send(log_file, FakeDeliverer(crash_after = 4), monkeypatch)
+
+    box, jobs, sent = resume(log_file, monkeypatch)
+    assert len(jobs) == 1
+    assert sent == [5, 6, 7, 8, 9, 10]
+    assert jobs[0].delivered == 10
+    assert not box.jobs
+
+def test_resume_skips_recipients_done_out_of_order(log_file, monkeypatch):
+    # 3 is still in flight when 4 and 6 finish, so only 1 and 2 are below the cursor
+    send(log_file, FakeDeliverer(finish_order = [1, 2, 4, 6, 3], crash_after = 4), monkeypatch)
+
+    _, jobs, sent = resume(log_file, monkeypatch)
+    assert sent == [3, 5, 7, 8, 9, 10]
+    assert jobs[0].delivered == 10
+
+def test_finished_jobs_are_compacted_away(log_file, monkeypatch):
+    monkeypatch.setattr(delivery, "deliverer", FakeDeliverer())
+    box = outbox.Outbox(log_file)
+    asyncio.run(box.send("tweet", "tweet", "NTUsg"))
+    assert not box.jobs
+
+    with open(log_file, 'r') as log:
+        assert log.read() == ""
+    assert not outbox.Outbox(log_file).jobs
+
+def test_partially_written_last_line_is_ignored(log_file, monkeypatch):
+    send(log_file, FakeDeliverer(crash_after = 2), monkeypatch)
+    with open(log_file, 'a') as log:
+        log.write('{"op": "progress", "id": "trunc')
+
+    _, jobs, sent = resume(log_file, monkeypatch)
+    assert len(jobs) == 1
+    assert sent == [3, 4, 5, 6, 7, 8, 9, 10]
+
+def test_log_is_written_off_the_event_loop(log_file, monkeypatch):
+    threads = set()
+    fsync = os.fsync
+    def recording_fsync(file_descriptor):
+        threads.add(threading.current_thread().name)
+        fsync(file_descriptor)
+    monkeypatch.setattr(outbox.os, "fsync", recording_fsync)
+    monkeypatch.setattr(delivery, "deliverer", FakeDeliverer())
+
+    asyncio.run(outbox.Outbox(log_file).send("tweet", "tweet", "NTUsg"))
+    assert threads and all(name.startswith("outbox-writer") for name in threads)
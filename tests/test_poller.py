@@ -0,0 +1,54 @@
+import asyncio
+import poller
+
+class Cameras():
+
+    def __init__(self, images):
+
+        '''
+        Serves a fixed image per location, raising for locations without one,
+        and keeps what is published.
+        '''
+
+        self.images = images
+        self.published = {}
+
+    async def download(self, location):
+        if location not in self.images: raise OSError("camera down")
+        return self.images[location]
+
+    def publish(self, location, image, result, timestamp = None):
+        self.published[location] = result
+
+class Pool():
+
+    locations = {"canteen", "library", "gym"}
+
+    async def classify_batch(self, frames):
+        return [(None, "corrupt frame") if image == b"bad" else ("average", [0, 1, 2]) for _, image in frames]
+
+def test_bad_frame_backs_off_only_its_own_location():
+    cameras = Cameras({"canteen": b"ok", "library": b"bad"})
+    camera_poller = poller.CameraPoller(cameras, Pool(), ["canteen", "library", "gym"], interval = 30)
+    asyncio.run(camera_poller.poll())
+
+    assert cameras.published == {"canteen": ("average", [0, 1, 2])}
+    assert camera_poller._failures == {"canteen": 0, "library": 1, "gym": 1}
+    asyncio.run(camera_poller.poll()) # nothing is due yet
+    assert camera_poller._failures["library"] == 1
+
+    camera_poller._next_poll["library"] = 0
+    asyncio.run(camera_poller.poll())
+    assert camera_poller._failures["library"] == 2
+    assert "library" not in cameras.published
+
+def test_failed_batch_backs_off_every_location():
+    pool = Pool()
+    async def broken(frames):
+        raise RuntimeError("pool is broken")
+    pool.classify_batch = broken
+    camera_poller = poller.CameraPoller(Cameras({"canteen": b"ok", "gym": b"ok"}), pool, ["canteen", "gym"], interval = 30)
+    asyncio.run(camera_poller.poll())
+
+    assert camera_poller._failures == {"canteen": 1, "gym": 1}
+    assert min(camera_poller._next_poll.values()) > 0
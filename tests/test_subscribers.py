@@ -0,0 +1,84 @@
+import sqlite3
+import pytest
+import commons
+import subscribers
+
+@pytest.fixture
+def db_name(tmp_path):
+    return str(tmp_path / "subscribers.db")
+
+def make_legacy_db(db_name, chat_ids):
+
+    '''
+    Creates a database as it was before subscriptions to accounts existed.
+    '''
+
+    connection = sqlite3.connect(db_name)
+    with connection:
+        connection.execute("CREATE TABLE subscribers (chat_id INTEGER PRIMARY KEY, name TEXT NOT NULL)")
+        connection.executemany("INSERT INTO subscribers VALUES (?, ?)", [(chat_id, "chat " + str(chat_id)) for chat_id in chat_ids])
+    connection.close()
+
+def test_subscribe_and_unsubscribe(db_name):
+    repository = subscribers.SQLiteSubscriberRepository(db_name, "NTUsg")
+    assert repository.subscribe("5", "alice", "NTUsg")
+    assert not repository.subscribe("5", "alice", "ntusg")
+    assert repository.subscribe("5", "alice", "NTULibrary")
+    assert repository.get_name(5) == "alice"
+    assert repository.count("NTUsg") == repository.count("NTULibrary") == 1
+
+    assert repository.unsubscribe(5, "NTUsg")
+    assert repository.get_name(5) == "alice"
+    assert repository.count("NTUsg") == 0
+    assert repository.unsubscribe(5)
+    assert repository.get_name(5) is None
+    assert not repository.unsubscribe(5)
+
+def test_iter_ids_pages_in_order(db_name):
+    repository = subscribers.SQLiteSubscriberRepository(db_name, "NTUsg")
+    repository.subscribe_many([(chat_id, "chat") for chat_id in [9, -3, 4, 1, 7]], "NTUsg")
+    repository.subscribe(2, "chat", "NTULibrary")
+
+    assert list(repository.iter_ids(page_size = 2)) == [-3, 1, 2, 4, 7, 9]
+    assert list(repository.iter_ids(after = 4, page_size = 2)) == [7, 9]
+    assert list(repository.iter_ids(page_size = 2, account = "NTUsg")) == [-3, 1, 4, 7, 9]
+    assert list(repository.iter_ids(after = 1, page_size = 2, account = "NTUsg")) == [4, 7, 9]
+    assert list(repository.iter_ids(account = "Unknown")) == []
+
+def test_legacy_database_is_subscribed_to_default_account(db_name):
+    make_legacy_db(db_name, [3, 1, 2])
+
+    repository = subscribers.SQLiteSubscriberRepository(db_name, "NTUsg")
+    assert list(repository.iter_ids(account = "NTUsg")) == [1, 2, 3]
+    assert repository.count("NTUsg") == 3
+    repository.close()
+
+    # migrating again changes nothing
+    repository = subscribers.SQLiteSubscriberRepository(db_name, "NTUsg")
+    assert repository.count("NTUsg") == 3
+    assert repository._query("PRAGMA user_version")[0][0] == subscribers.SCHEMA_VERSION
+
+def test_read_only_repository_reads_accounts(db_name):
+    writer = subscribers.SQLiteSubscriberRepository(db_name, "NTUsg")
+    writer.subscribe_many([(1, "a"), (2, "b")], "NTUsg")
+
+    reader = subscribers.SQLiteSubscriberRepository(db_name, read_only = True)
+    assert list(reader.iter_ids(account = "NTUsg")) == [1, 2]
+    assert reader.count("NTUsg") == 2
+    assert list(reader.iter_ids(account = "NTULibrary")) == []
+    assert reader.count("NTULibrary") == 0
+    with pytest.raises(sqlite3.OperationalError):
+        reader.subscribe(3, "c", "NTUsg")
+
+def test_migrate_from_json(db_name, shared_store, save_file):
+    shared_store.set("subscribers", {"10": "alice", "-20": "group"})
+    repository = subscribers.SQLiteSubscriberRepository(db_name, "NTUsg")
+
+    assert subscribers.migrate_from_json(repository, "NTUsg") == 2
+    assert list(repository.iter_ids(account = "NTUsg")) == [-20, 10]
+    assert repository.get_name(10) == "alice"
+    assert commons.get_data("subscribers") == {}
+    assert not shared_store._dirty # emptied dict is already on disk
+
+    assert subscribers.migrate_from_json(repository, "NTUsg") == 0
+    assert repository.count() == 2
@@ -0,0 +1,51 @@
+import json
+import asyncio
+import twitter
+
+AUTHORS = {"1": "NTUsg"}
+
+def tweet(id, text = "hello", user_id = "1"):
+    return json.dumps({"id_str": id, "text": text, "user": {"id_str": user_id, "screen_name": "NTUsg"}})
+
+def bridge_tweets(payloads):
+
+    '''
+    Runs a bridge over the given payloads and returns the batches of tweets it
+    passed on, with whether it was still running afterwards.
+    '''
+
+    batches = []
+
+    async def on_tweets(account, tweets):
+        batches.append((account, [tweet["id_str"] for tweet in tweets]))
+
+    async def main():
+        bridge = twitter.TweetBridge(on_tweets, asyncio.get_running_loop(), AUTHORS)
+        task = asyncio.ensure_future(bridge.run())
+        for payload in payloads:
+            bridge.queue.put_nowait(payload)
+        await asyncio.sleep(0.01)
+        alive = not task.done()
+        task.cancel()
+        return alive
+
+    return batches, asyncio.run(main())
+
+def test_tweets_of_followed_accounts_are_passed_on_once():
+    batches, alive = bridge_tweets([tweet("10"), tweet("11", user_id = "2"), tweet("10"), tweet("12")])
+    assert batches == [("NTUsg", ["10", "12"])]
+    assert alive
+
+def test_malformed_payloads_are_dropped_without_stopping_the_bridge():
+    payloads = [
+        "not json",
+        "[1, 2]",
+        "42",
+        json.dumps({"id_str": "20", "text": "no user"}),
+        json.dumps({"id_str": "21", "text": "odd user", "user": "NTUsg"}),
+        json.dumps({"id_str": ["22"], "text": "odd id", "user": {"id_str": "1"}}),
+        tweet("23"),
+    ]
+    batches, alive = bridge_tweets(payloads)
+    assert batches == [("NTUsg", ["23"])]
+    assert alive
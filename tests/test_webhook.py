@@ -0,0 +1,46 @@
+import json
+import asyncio
+import webhook
+
+class FakeRequest():
+
+    def __init__(self, body, secret = None):
+        self.headers = {webhook.SECRET_HEADER: secret} if secret is not None else {}
+        self.body = body
+
+    async def text(self):
+        return self.body
+
+def post(server, body, secret = "secret"):
+    return asyncio.run(server.handle(FakeRequest(body, secret))).status
+
+def update(update_id):
+    return json.dumps({"update_id": update_id, "message": {"message_id": 1, "chat": {"id": 5}, "text": "/news"}})
+
+def test_updates_are_queued_in_order():
+    server = webhook.WebhookServer(asyncio.Queue(), "secret")
+    assert post(server, update(1)) == 200
+    assert post(server, update(2)) == 200
+    assert [server.queue.get_nowait()["update_id"] for _ in range(2)] == [1, 2]
+    assert server.received == 2
+
+def test_wrong_or_missing_secret_is_refused():
+    server = webhook.WebhookServer(asyncio.Queue(), "secret")
+    assert post(server, update(1), "wrong") == 401
+    assert post(server, update(1), None) == 401
+    assert server.queue.empty()
+
+def test_malformed_updates_are_refused():
+    server = webhook.WebhookServer(asyncio.Queue(), "secret")
+    assert post(server, "not json") == 400
+    assert post(server, "[1, 2]") == 400
+    assert post(server, json.dumps({"message": {}})) == 400
+    assert server.queue.empty()
+
+def test_full_queue_asks_telegram_to_retry():
+    server = webhook.WebhookServer(asyncio.Queue(maxsize = 1), "secret")
+    assert post(server, update(1)) == 200
+    response = asyncio.run(server.handle(FakeRequest(update(2), "secret")))
+    assert response.status == 503
+    assert response.headers["Retry-After"] == str(webhook.RETRY_AFTER)
+    assert server.rejected == 1
@@ -0,0 +1,94 @@
+import time
+import asyncio
+import pytest
+import camera
+import workers
+
+def test_chat_id_of_messages_and_callback_queries():
+    assert workers.chat_id_of({"chat": {"id": -5}, "text": "/peek"}) == -5
+    assert workers.chat_id_of({"id": "1", "from": {"id": 7}, "message": {"chat": {"id": 8}}}) == 8
+    assert workers.chat_id_of({"id": "1", "from": {"id": 7}}) == 7
+    assert workers.chat_id_of({"update_id": 1}) is None
+
+def test_chats_go_to_their_shard_and_admins_stay_on_the_ingress(shared_store):
+    shared_store.set("admins", [42])
+    ingress = workers.Ingress("token", 3, {})
+    sent, handled = [], []
+    ingress.send = lambda index, command: sent.append((index, command[1]["chat"]["id"]))
+    ingress.bot = type("Handler", (), {"handle": staticmethod(lambda message: handled.append(message))})
+
+    for chat_id in [7, 8, 9, -10, 42, 7]:
+        ingress.route({"chat": {"id": chat_id}, "text": "/peek"})
+    ingress.route({"update_id": 1})
+
+    assert sent == [(1, 7), (2, 8), (0, 9), (2, -10), (1, 7)]
+    assert [message.get("chat", {}).get("id") for message in handled] == [42, None]
+
+class AnsweringIngress():
+
+    def __init__(self, count, silent = ()):
+
+        '''
+        Hands batches to no process at all; every batch is answered on the next
+        turn of the loop, as if its worker had delivered it, except those of the
+        shards in silent, which never hear back.
+        '''
+
+        self.count = count
+        self.silent = silent
+        self.batches = []
+        self.deliverer = workers.ShardedDeliverer(self)
+
+    def send(self, index, command):
+        _, batch_id, chat_ids, _, _ = command
+        self.batches.append((index, chat_ids))
+        if index in self.silent: return
+        loop = asyncio.get_running_loop()
+        for chat_id in chat_ids:
+            loop.call_soon(self.deliverer.on_result, batch_id, chat_id, chat_id != 13)
+        loop.call_soon(self.deliverer.on_batch, batch_id, 0)
+
+def test_fan_out_is_split_by_shard_into_batches(monkeypatch):
+    monkeypatch.setattr(workers, "BATCH_SIZE", 4)
+    ingress = AnsweringIngress(2)
+    results = {}
+    report = asyncio.run(ingress.deliverer.send_message(range(1, 16), "hello", on_result = results.__setitem__))
+
+    assert all(chat_id % 2 == index for index, chat_ids in ingress.batches for chat_id in chat_ids)
+    assert all(len(chat_ids) <= 4 for _, chat_ids in ingress.batches)
+    assert sorted(chat_id for _, chat_ids in ingress.batches for chat_id in chat_ids) == list(range(1, 16))
+    assert (report.sent, report.failed) == (14, 1)
+    assert results[13] is False and len(results) == 15
+    assert not ingress.deliverer._batches
+
+def test_silent_worker_fails_the_fan_out_once_its_batch_expires():
+    ingress = AnsweringIngress(2, silent = [1])
+    results = {}
+
+    async def fan_out():
+        sending = asyncio.ensure_future(ingress.deliverer.send_message(range(1, 7), "hello", on_result = results.__setitem__))
+        await asyncio.sleep(0.01)
+        assert not sending.done()
+        ingress.deliverer.expire(timeout = 0)
+        return await sending
+
+    with pytest.raises(asyncio.TimeoutError):
+        asyncio.run(fan_out())
+    assert sorted(results) == [2, 4, 6]
+    assert not ingress.deliverer._batches
+
+def test_polled_snapshots_reach_the_workers(monkeypatch):
+    ingress = workers.Ingress("token", 2, {"poll_interval": 30})
+    sent, recorded = [], []
+    ingress.send = lambda index, command: sent.append((index, command))
+    ingress._on_publish = recorded.append
+
+    snapshot = camera.Snapshot("canteen", b"jpeg", "full", [3.0, 1.0, 2.0], time.time())
+    ingress._share_snapshot(snapshot)
+    assert recorded == [snapshot]
+    assert [index for index, _ in sent] == [0, 1]
+
+    monkeypatch.setattr(camera, "fetcher", camera.CameraFetcher("http://cameras/", ttl = 60))
+    worker = workers.Worker(1, 2, None, None)
+    worker._on_command(sent[1][1])
+    assert camera.fetcher.cached("canteen") == snapshot
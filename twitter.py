@@ -1,84 +1,260 @@
 '''
 This file contains a simple script to setup a twitter stream listener and to
-delegate an event callback every time a new tweet is received. Need
-to instantiate TwitterStream on the main script to start the actual listener.
+delegate an event callback every time new tweets are received. All followed
+accounts share one streaming connection. Need to instantiate TwitterStream and
+call start() on the main script to start the actual listener.
+
+Tweepy reads the stream on its own thread, which must never touch the event
+loop directly. The listener only drops frames that are obviously not tweets and
+hands the raw payload over with call_soon_threadsafe; parsing, de-duplication
+and the callback all happen on the loop. Tweets that pile up while a callback is
+still running are passed to the next callback together, so a burst of tweets is
+fanned out as one job. If the stream fails, it reconnects with exponential
+backoff without losing anything already handed over.
 '''
 
 from tweepy.streaming import StreamListener
 from tweepy import OAuthHandler
 from tweepy import Stream
+from collections import OrderedDict
 
 import tweepy
 import json
 import asyncio
+import threading
 import commons
 
+NON_TWEET_PREFIXES = (
+    '{"delete"', '{"limit"', '{"scrub_geo"', '{"status_withheld"', '{"user_withheld"',
+    '{"disconnect"', '{"warning"', '{"event"', '{"friends"', '{"control"'
+)
+API_HOST = "api.twitter.com"
+STREAM_HOST = "stream.twitter.com"
+SEEN_TWEETS = 1000 # number of recent tweet ids remembered for de-duplication
+RECONNECT_DELAY = 5 # seconds before the first reconnection attempt
+MAX_RECONNECT_DELAY = 5 * 60 # seconds
 LOG_TAG = "twitter"
 
 class TweetListener(StreamListener):
 
-    def __init__(self, on_tweet, *args, **kwargs):
+    def __init__(self, bridge, *args, **kwargs):
 
         '''
         Sets up a tweet listener as implemented by Tweepy's StreamListener.
 
-        @param on_tweet: callback method to be executed when a new tweet is sent
+        @param bridge: TweetBridge which receives the raw tweets
         '''
 
         super(TweetListener, self).__init__(*args, **kwargs)
-        self.on_tweet = on_tweet
-        self.loop = asyncio.get_event_loop()
+        self.bridge = bridge
+        self.connected = threading.Event()
+
+    def on_connect(self):
+        self.connected.set()
 
     def on_data(self, data):
 
         '''
-        Called when raw data is received from connection (i.e. new tweets are sent, etc).
+        Called on Tweepy's thread when raw data is received from connection
+        (i.e. new tweets are sent, etc).
 
-        @param data: a dictionary containing information about the tweet. See
+        @param data: JSON string of the tweet or stream message. See
             https://dev.twitter.com/overview/api/tweets for more information
         '''
 
-        tweet = json.loads(data)
-        if not tweet["retweeted"]: # filter out retweets
-            self.loop.create_task(self.on_tweet(tweet)) # execute callback
-            commons.log(LOG_TAG, "new tweet from " + twitter_account + ": " + tweet['text'])
-            return True
+        # stream messages are wrapped in a single key; tweets never start with these
+        if not data.lstrip().startswith(NON_TWEET_PREFIXES):
+            self.bridge.submit(data)
+        return True
 
     def on_error(self, status):
 
         '''
-        Called when a non-200 status code is returned from the listener.
+        Called when a non-200 status code is returned from the listener. Tweepy
+        retries with its own backoff.
 
         @param status: status code of the error received
         '''
 
-        commons.log(LOG_TAG, str(status))
+        commons.log(LOG_TAG, "stream error " + str(status))
+
+class TweetBridge():
+
+    def __init__(self, on_tweets, loop, authors, seen = SEEN_TWEETS):
+
+        '''
+        Sets up the hand-over of raw tweets from the stream thread to the loop.
+
+        @param on_tweets: coroutine function called on the loop with the screen
+            name of a followed account and a list of its new tweets
+        @param loop: event loop the callback runs on
+        @param authors: dictionary of user id string to screen name of the
+            followed accounts; tweets by anyone else are dropped
+        @param seen: number of recent tweet ids remembered
+        '''
+
+        self.on_tweets = on_tweets
+        self.loop = loop
+        self.authors = authors
+        self.queue = asyncio.Queue()
+        self.seen = seen
+        self._seen_ids = OrderedDict()
+
+    def submit(self, data):
+
+        '''
+        Hands a raw tweet over to the loop. Safe to call from any thread.
+
+        @param data: JSON string of the tweet
+        '''
+
+        self.loop.call_soon_threadsafe(self.queue.put_nowait, data)
+
+    def _parse(self, data):
+
+        '''
+        Returns the tweet in data, or None if it is not a tweet to be sent: not
+        valid, not shaped like a tweet, a retweet, not by a followed account,
+        or already seen.
+        '''
+
+        try:
+            tweet = json.loads(data)
+        except ValueError:
+            commons.log(LOG_TAG, "dropped malformed payload")
+            return None
+        if not isinstance(tweet, dict) or not isinstance(tweet.get('user'), dict):
+            commons.log(LOG_TAG, "dropped payload which is not a tweet")
+            return None
+        if 'id_str' not in tweet or 'text' not in tweet or tweet.get('retweeted'): # filter out retweets
+            return None
+        if tweet['user'].get('id_str') not in self.authors: # replies and retweets by others
+            return None
+        if tweet['id_str'] in self._seen_ids:
+            return None
+
+        self._seen_ids[tweet['id_str']] = True
+        while len(self._seen_ids) > self.seen:
+            self._seen_ids.popitem(last = False)
+        return tweet
+
+    async def run(self):
+
+        '''
+        Async method which passes tweets to the callback until cancelled.
+        Everything queued by the time the previous callbacks finish is passed
+        as one batch per account.
+        '''
+
+        while True:
+            batch = [await self.queue.get()]
+            while not self.queue.empty():
+                batch.append(self.queue.get_nowait())
+
+            by_account = OrderedDict()
+            for data in batch:
+                try:
+                    tweet = self._parse(data)
+                except Exception as e:
+                    commons.log(LOG_TAG, "dropped payload which could not be parsed (" + repr(e) + ")")
+                    continue
+                if tweet is None: continue
+                commons.log(LOG_TAG, "new tweet from " + self.authors[tweet['user']['id_str']] + ": " + str(tweet['text']))
+                by_account.setdefault(self.authors[tweet['user']['id_str']], []).append(tweet)
+
+            for account, tweets in by_account.items():
+                try:
+                    await self.on_tweets(account, tweets) # execute callback
+                except Exception as e:
+                    commons.log(LOG_TAG, "failed to handle " + str(len(tweets)) + " tweets from " + account + " (" + repr(e) + ")")
 
 class TwitterStream():
 
-    def __init__(self, tokens, account, on_tweet):
+    def __init__(self, tokens, accounts, on_tweets, api_host = None, stream_host = None):
 
         '''
-        Sets up the Twitter API connection and creates a stream listener.
+        Sets up the Twitter API connection. Nothing is fetched until start().
 
         @param tokens: dictionary containing the app's consumer key + secret,
             and also the associated account's access token + secret
-        @param account: username of twitter account to listen to
-        @param on_tweet: callback method to be executed when a new tweet is sent
+        @param accounts: usernames of the twitter accounts to listen to
+        @param on_tweets: coroutine function to be executed with the username
+            and a list of new tweets when an account sends new tweets
+        @param api_host: optional host (and port) of the REST API, e.g. a local
+            fake server; always spoken to over https
+        @param stream_host: optional host (and port) of the streaming API
         '''
 
         # Twitter API authentication
-        auth = OAuthHandler(tokens['consumer_key'], tokens['consumer_secret'])
-        auth.set_access_token(tokens['access_token'], tokens['access_token_secret'])
-        api = tweepy.API(auth)
-        user_id = str(api.get_user(account).id)
+        self.auth = OAuthHandler(tokens['consumer_key'], tokens['consumer_secret'])
+        self.auth.set_access_token(tokens['access_token'], tokens['access_token_secret'])
+        self.accounts = accounts
+        self.on_tweets = on_tweets
+        self.api_host = api_host or API_HOST
+        self.stream_host = stream_host or STREAM_HOST
+        self.authors = {} # user id string to screen name as given in accounts
+        self.stream = None
+        self._stopping = threading.Event()
+
+    def start(self, loop):
+
+        '''
+        Starts listening on a background thread, delivering tweets to the
+        callback on the given loop.
+
+        @param loop: event loop the bot runs on
+        '''
+
+        bridge = TweetBridge(self.on_tweets, loop, self.authors)
+        self.listener = TweetListener(bridge)
+        loop.create_task(bridge.run())
+        threading.Thread(target = self._run, name = "twitter-stream", daemon = True).start()
+
+    def _lookup_accounts(self):
+
+        '''
+        Resolves the user ids of the followed accounts with a single request.
+        '''
+
+        names = {account.lower(): account for account in self.accounts}
+        for user in tweepy.API(self.auth, host = self.api_host).lookup_users(screen_names = list(self.accounts)):
+            self.authors[user.id_str] = names.get(user.screen_name.lower(), user.screen_name)
+        commons.log(LOG_TAG, "listening for new tweets from " + ", ".join(
+            name + " (" + user_id + ")" for user_id, name in self.authors.items()
+        ))
+
+    def _run(self):
+
+        '''
+        Runs on the stream thread. Keeps the stream connected, waiting longer
+        after every consecutive failure.
+        '''
+
+        delay = RECONNECT_DELAY
+        while not self._stopping.is_set():
+            try:
+                if not self.authors:
+                    self._lookup_accounts()
+
+                self.listener.connected.clear()
+                self.stream = Stream(auth = self.auth, listener = self.listener, host = self.stream_host)
+                self.stream.filter(follow = list(self.authors.keys()))
+                reason = "stream closed"
+            except Exception as e:
+                reason = repr(e)
 
-        global twitter_account
-        twitter_account = account + " (" + user_id + ")"
+            if self._stopping.is_set(): break
+            if self.listener.connected.is_set(): delay = RECONNECT_DELAY # was connected; start over
+            commons.log(LOG_TAG, reason + ", reconnecting in " + str(delay) + "s")
+            self._stopping.wait(delay)
+            delay = min(delay * 2, MAX_RECONNECT_DELAY)
 
-        commons.log(LOG_TAG, "listening for new tweets from " + twitter_account)
+    def stop(self):
+
+        '''
+        Disconnects the stream for good.
+        '''
 
-        # instantiate tweet listener and start listening
-        listener = TweetListener(on_tweet)
-        self.stream = Stream(auth = api.auth, listener = listener)
-        self.stream.filter(follow = [user_id], async = True)
+        self._stopping.set()
+        if self.stream is not None:
+            self.stream.disconnect()
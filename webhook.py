@@ -0,0 +1,154 @@
+'''
+This file contains the two ways the bot can receive updates. By default it long
+polls getUpdates, which only works with a single running instance. In webhook
+mode, Telegram POSTs every update to a small aiohttp server instead; each POST
+is checked against the secret token, acknowledged right away and put on a
+bounded queue that the DelegatorBot reads from, so updates are routed to the
+chat handlers exactly as they are when polling. When the queue is full the POST
+is refused, and Telegram delivers the update again later.
+'''
+
+from urllib.parse import urlsplit
+from aiohttp import web
+
+import hmac
+import json
+import asyncio
+import secrets
+import commons
+
+PORT = 8443
+QUEUE_SIZE = 1000 # updates waiting to be routed before POSTs are refused
+MAX_CONNECTIONS = 40 # concurrent POSTs Telegram may make
+RETRY_AFTER = 5 # seconds Telegram is told to wait when the queue is full
+SECRET_HEADER = "X-Telegram-Bot-Api-Secret-Token"
+LOG_TAG = "webhook"
+
+class WebhookServer():
+
+    def __init__(self, queue, secret, path = "/"):
+
+        '''
+        Sets up the server which puts updates received on path into queue.
+
+        @param queue: asyncio.Queue the bot's message_loop reads from
+        @param secret: secret token Telegram sends along with every update
+        @param path: path Telegram POSTs to
+        '''
+
+        self.queue = queue
+        self.secret = secret
+        self.path = path
+        self.received = 0
+        self.rejected = 0
+        self._runner = None
+
+    async def handle(self, request):
+
+        '''
+        Async method which handles one POST from Telegram.
+
+        @param request: aiohttp request
+        '''
+
+        if not hmac.compare_digest(request.headers.get(SECRET_HEADER, ""), self.secret):
+            return web.Response(status = 401)
+
+        try:
+            update = json.loads(await request.text())
+        except ValueError:
+            return web.Response(status = 400)
+        if not isinstance(update, dict) or 'update_id' not in update:
+            return web.Response(status = 400)
+
+        try:
+            self.queue.put_nowait(update)
+        except asyncio.QueueFull:
+            self.rejected += 1
+            commons.log(LOG_TAG, "update queue full, refused update " + str(update['update_id']))
+            return web.Response(status = 503, headers = {"Retry-After": str(RETRY_AFTER)})
+
+        self.received += 1
+        return web.Response()
+
+    async def start(self, port, host = "0.0.0.0"):
+
+        '''
+        Async method which starts listening.
+
+        @param port: port to listen on
+        @param host: interface to listen on
+        '''
+
+        app = web.Application()
+        app.router.add_post(self.path, self.handle)
+        self._runner = web.AppRunner(app)
+        await self._runner.setup()
+        await web.TCPSite(self._runner, host, port).start()
+        commons.log(LOG_TAG, "listening for updates on port " + str(port) + " at " + self.path)
+
+    async def stop(self):
+
+        '''
+        Async method which stops listening.
+        '''
+
+        if self._runner is not None:
+            await self._runner.cleanup()
+            self._runner = None
+
+async def register(bot, url, secret):
+
+    '''
+    Async method which asks Telegram to send updates to url along with the
+    secret token. Failure is logged, not raised, so that the server can still be
+    tested locally by POSTing updates to it.
+
+    @param bot: telepot.aio bot
+    @param url: public url of the webhook
+    @param secret: secret token Telegram should send
+    '''
+
+    try:
+        # telepot's setWebhook predates secret_token, so call the method directly
+        await bot._api_request('setWebhook', {'url': url, 'secret_token': secret, 'max_connections': MAX_CONNECTIONS})
+        commons.log(LOG_TAG, "registered webhook " + url)
+    except Exception as e:
+        commons.log(LOG_TAG, "failed to register webhook (" + repr(e) + ")")
+
+def start(loop, bot, url, secret = None, port = PORT, handler = None):
+
+    '''
+    Starts receiving updates through the webhook on the given event loop.
+    Returns the server.
+
+    @param loop: event loop the bot runs on
+    @param bot: telepot.aio DelegatorBot to route the updates with
+    @param url: public url of the webhook; its path is the path served
+    @param secret: optional secret token; a random one is used if not given
+    @param port: port to listen on
+    @param handler: optional function called with every message instead of
+        the bot's own routing
+    '''
+
+    queue = asyncio.Queue(maxsize = QUEUE_SIZE)
+    server = WebhookServer(queue, secret or secrets.token_urlsafe(32), urlsplit(url).path or "/")
+    loop.run_until_complete(server.start(port))
+    loop.create_task(bot.message_loop(handler, source = queue))
+    loop.create_task(register(bot, url, server.secret))
+    return server
+
+async def poll(bot, handler = None):
+
+    '''
+    Async method which long polls getUpdates, after removing any webhook left
+    behind by a run in webhook mode, since Telegram refuses getUpdates while
+    one is set.
+
+    @param bot: telepot.aio DelegatorBot to route the updates with
+    @param handler: optional function called with every message instead of
+        the bot's own routing
+    '''
+
+    await bot.deleteWebhook()
+    await bot.message_loop(handler)
@@ -0,0 +1,678 @@
+'''
+This file contains the multi-process topology used when the bot is started with
+one or more workers. The main process is the ingress: it alone receives updates
+(by polling or through the webhook), listens to the Twitter stream, and writes
+the shared state (save_data.json, the subscriber database, the outbox log, the
+counters and the density history). Every chat is handed to worker process
+chat_id % N over a local queue, so a chat always lands on the same worker,
+which runs the usual NTUCampusBot handlers and its own density classifier for
+it. Chats of administrators stay on the ingress, where the admin commands have
+the state at hand.
+
+Workers never write shared state. Subscription changes are applied by the
+ingress and answered right away, without waiting on its event loop; the worker
+waits for the answer off its own loop. Counter increments, density results and
+the file ids of uploaded photos are forwarded to it, and so are the latency
+histograms, every few seconds. save_data.json is read once and never written;
+the keys the ingress changes (maintenance status and administrators) are pushed
+to every worker, as are new shuttle bus services and photo file ids. The
+density history is read straight from the files the ingress writes. When
+cameras are polled, the ingress alone polls them and pushes every snapshot to
+the workers, so their /peek answers from it as well.
+
+Fan-outs are partitioned the same way: the recipients of a fan-out are split
+into batches by chat_id % N, and each worker sends its batches within its share
+of the global rate limit, reporting every result back so that the outbox can
+checkpoint. A worker which dies is restarted, and whatever was left of its
+batches is sent again. A batch which goes BATCH_TIMEOUT seconds without a
+result is given up on, and its fan-out fails with the rest of its recipients
+left unsent, so that the outbox resumes them. Everything goes through multiprocessing queues, so the
+whole topology runs on one box without any outside service.
+'''
+
+import os
+import time
+import queue
+import itertools
+import signal
+import asyncio
+import threading
+import multiprocessing
+import concurrent.futures
+import bot
+import camera
+import commons
+import counters
+import delivery
+import history
+import http_client
+import logs
+import media
+import metrics
+import poller
+import profiler
+import subscribers
+
+BATCH_SIZE = 500 # recipients handed to a worker at a time
+BATCHES_IN_FLIGHT = 2 # batches of the same fan-out a worker may have at once
+CALL_TIMEOUT = 10 # seconds a worker waits for the ingress to apply a change
+MONITOR_INTERVAL = 5 # seconds between checks that the other processes are alive
+BATCH_TIMEOUT = 5 * 60 # seconds a batch may go without a result; longer than any retry_after we expect
+STOP_TIMEOUT = 10 # seconds workers get to shut down
+SHARED_KEYS = ["status", "admins"] # save_data.json keys pushed to the workers
+WRITE_METHODS = ["subscribe", "subscribe_many", "unsubscribe"]
+LOG_TAG = "workers"
+
+def chat_id_of(message):
+
+    '''
+    Returns the id of the chat a message or callback query belongs to, or None.
+
+    @param message: message or callback query dictionary as received
+    '''
+
+    if 'chat' in message:
+        return message['chat']['id']
+    if 'chat' in message.get('message', {}):
+        return message['message']['chat']['id']
+    return message.get('from', {}).get('id')
+
+class Batch():
+
+    def __init__(self, id, shard, chat_ids, text, kwargs, report, on_result, slot):
+
+        '''
+        Keeps track of the recipients of a fan-out handed to one worker.
+
+        @param id: unique id of the batch
+        @param shard: index of the worker the batch belongs to
+        @param chat_ids: list of recipients
+        @param text: the message to send
+        @param kwargs: extra parameters passed on to sendMessage
+        @param report: delivery.DeliveryReport of the whole fan-out
+        @param on_result: optional function called with (chat_id, delivered)
+        @param slot: asyncio.Semaphore limiting the batches the worker has at
+            once, released when the batch is done
+        '''
+
+        self.id = id
+        self.shard = shard
+        self.remaining = set(chat_ids)
+        self.text = text
+        self.kwargs = kwargs
+        self.report = report
+        self.on_result = on_result
+        self.slot = slot
+        self.done = asyncio.Event()
+        self.updated = time.monotonic() # when the worker was last heard from about the batch
+        self.expired = False
+
+    def command(self):
+        return ("send", self.id, sorted(self.remaining), self.text, self.kwargs)
+
+class ShardedDeliverer():
+
+    def __init__(self, ingress):
+
+        '''
+        Sets up a delivery engine which hands fan-outs to the workers. Has the
+        same send_message as delivery.Deliverer, so it can stand in for it.
+
+        @param ingress: Ingress owning the workers
+        '''
+
+        self.ingress = ingress
+        self._batches = {}
+        self._next_id = 0
+
+    async def send_message(self, recipients, text, name = "message", on_result = None, **kwargs):
+
+        '''
+        Async method which sends the same text message to every recipient, each
+        through the worker owning it.
+
+        @param recipients: iterable of chat ids
+        @param text: the message to send
+        @param name: short description used when logging the report
+        @param on_result: optional function called with (chat_id, delivered)
+        @param kwargs: extra parameters passed on to sendMessage
+        '''
+
+        report = delivery.DeliveryReport(name)
+        shards = self.ingress.count
+        slots = [asyncio.Semaphore(BATCHES_IN_FLIGHT) for _ in range(shards)]
+        pending = [[] for _ in range(shards)]
+        batches = []
+
+        def check_expired():
+            expired = [batch for batch in batches if batch.expired]
+            if expired:
+                raise asyncio.TimeoutError(
+                    "worker " + str(expired[0].shard) + " gave no result for " + str(BATCH_TIMEOUT) + "s; "
+                    + str(sum(len(batch.remaining) for batch in expired)) + " recipients left unsent"
+                )
+
+        async def submit(shard):
+            await slots[shard].acquire()
+            check_expired()
+            self._next_id += 1
+            batch = Batch(self._next_id, shard, pending[shard], text, kwargs, report, on_result, slots[shard])
+            pending[shard] = []
+            batches.append(batch)
+            self._batches[batch.id] = batch
+            self.ingress.send(shard, batch.command())
+
+        for chat_id in recipients:
+            shard = chat_id % shards
+            pending[shard].append(chat_id)
+            if len(pending[shard]) >= BATCH_SIZE:
+                await submit(shard)
+        for shard in range(shards):
+            if pending[shard]:
+                await submit(shard)
+
+        await asyncio.gather(*[batch.done.wait() for batch in batches])
+        check_expired()
+        report.finished = time.monotonic()
+        commons.log(LOG_TAG, str(report))
+        return report
+
+    def on_result(self, batch_id, chat_id, delivered):
+
+        '''
+        Records that a worker is done with one recipient.
+        '''
+
+        batch = self._batches.get(batch_id)
+        if batch is None or chat_id not in batch.remaining: return # already counted before a restart
+        batch.remaining.discard(chat_id)
+        batch.updated = time.monotonic()
+        if delivered:
+            batch.report.sent += 1
+        else:
+            batch.report.failed += 1
+        if batch.on_result: batch.on_result(chat_id, delivered)
+
+    def on_batch(self, batch_id, retries):
+
+        '''
+        Records that a worker is done with a whole batch.
+        '''
+
+        batch = self._batches.pop(batch_id, None)
+        if batch is None: return
+        batch.report.retries += retries
+        batch.slot.release()
+        batch.done.set()
+
+    def expire(self, timeout = BATCH_TIMEOUT):
+
+        '''
+        Gives up on every batch which has gone timeout seconds without a
+        result. Its fan-out then fails, leaving the rest of its recipients to
+        be resumed by the outbox.
+
+        @param timeout: seconds a batch may go without a result
+        '''
+
+        now = time.monotonic()
+        for batch in list(self._batches.values()):
+            if now - batch.updated < timeout: continue
+            commons.log(LOG_TAG, "giving up on batch " + str(batch.id) + " of worker " + str(batch.shard) + " with " + str(len(batch.remaining)) + " recipients left", commons.WARNING)
+            del self._batches[batch.id]
+            batch.expired = True
+            batch.slot.release()
+            batch.done.set()
+
+    def resubmit(self, shard):
+
+        '''
+        Hands whatever is left of the batches of a worker which was restarted
+        to its replacement.
+
+        @param shard: index of the worker
+        '''
+
+        for batch in list(self._batches.values()):
+            if batch.shard != shard: continue
+            if batch.remaining:
+                batch.updated = time.monotonic()
+                self.ingress.send(shard, batch.command())
+            else:
+                self.on_batch(batch.id, 0)
+
+class Ingress():
+
+    def __init__(self, token, count, settings):
+
+        '''
+        Sets up the ingress of a topology with the given number of workers.
+        Nothing is started until start().
+
+        @param token: telegram bot token
+        @param count: number of worker processes
+        @param settings: dictionary of settings every worker needs; see
+            Worker.run
+        '''
+
+        self.token = token
+        self.count = count
+        self.settings = settings
+        self.context = multiprocessing.get_context("spawn")
+        self.events = self.context.Queue()
+        self.processes = [None] * count
+        self.inboxes = [None] * count
+        self.replies = [None] * count
+        self.deliverer = ShardedDeliverer(self)
+        self.loop = None
+        self.bot = None
+        self._on_publish = None
+
+    def start(self, loop, delegator):
+
+        '''
+        Starts the workers and the handling of their events on the given loop.
+
+        @param loop: event loop the bot runs on
+        @param delegator: DelegatorBot handling the chats of administrators
+        '''
+
+        self.loop = loop
+        self.bot = delegator
+        for index in range(self.count):
+            self._spawn(index)
+        commons.watch(self._share)
+        if self.settings.get("poll_interval"):
+            self._on_publish = camera.fetcher.on_publish
+            camera.fetcher.on_publish = self._share_snapshot
+        threading.Thread(target = self._read_events, name = "worker-events", daemon = True).start()
+        loop.create_task(self._monitor())
+
+    def _spawn(self, index):
+
+        '''
+        Starts worker process index with fresh queues and brings it up to date
+        with the shared state.
+        '''
+
+        self.inboxes[index] = self.context.Queue()
+        self.replies[index] = self.context.Queue()
+        process = self.context.Process(
+            target = _run_worker, name = "worker-" + str(index),
+            args = (index, self.count, self.token, self.settings, self.inboxes[index], self.events, self.replies[index])
+        )
+        process.start()
+        self.processes[index] = process
+
+        for key in SHARED_KEYS:
+            self.send(index, ("data", key, commons.get_data().get(key)))
+        if bot.BUS_SERVICES:
+            self.send(index, ("bus_services", dict(bot.BUS_SERVICES)))
+        commons.log(LOG_TAG, "started worker " + str(index) + " (pid " + str(process.pid) + ")")
+
+    def send(self, index, command):
+
+        '''
+        Puts a command on the queue of worker index.
+        '''
+
+        self.inboxes[index].put(command)
+
+    def publish(self, command):
+
+        '''
+        Puts a command on the queue of every worker.
+        '''
+
+        for index in range(self.count):
+            self.send(index, command)
+
+    def route(self, message):
+
+        '''
+        Hands a message to the worker owning its chat, or to the ingress's own
+        handlers if it comes from an administrator. Used as the message_loop
+        handler.
+
+        @param message: message or callback query dictionary as received
+        '''
+
+        chat_id = chat_id_of(message)
+        if chat_id is None or chat_id in commons.get_data("admins"):
+            self.bot.handle(message)
+        else:
+            self.send(chat_id % self.count, ("update", message))
+
+    def _share(self, key, value):
+
+        '''
+        Pushes a changed key of save_data.json to the workers if they use it.
+        '''
+
+        if key in SHARED_KEYS:
+            self.publish(("data", key, value))
+
+    def _share_snapshot(self, snapshot):
+
+        '''
+        Pushes a snapshot published on the ingress, e.g. by the poller, to the
+        workers after handling it as usual.
+        '''
+
+        if self._on_publish: self._on_publish(snapshot)
+        self.publish(("snapshot",) + tuple(snapshot))
+
+    async def refresh_bus_services(self):
+
+        '''
+        Async method which refreshes the shuttle bus services and pushes them
+        to the workers.
+        '''
+
+        self.publish(("bus_services", await bot.refresh_bus_services()))
+
+    def _read_events(self):
+
+        '''
+        Runs on the event thread. Applies subscription changes right away, and
+        hands every other event to the loop.
+        '''
+
+        while True:
+            event = self.events.get()
+            if event is None: return
+            if event[0] == "call":
+                self._answer(*event[1:])
+            else:
+                self.loop.call_soon_threadsafe(self._on_event, event)
+
+    def _answer(self, index, call_id, method, args):
+
+        '''
+        Applies a subscription change asked for by a worker and sends back the
+        result. The repository is thread-safe, so this does not need the loop.
+        '''
+
+        try:
+            if method not in WRITE_METHODS: raise ValueError("unknown method " + method)
+            reply = (call_id, True, getattr(subscribers.repository, method)(*args))
+        except Exception as e:
+            reply = (call_id, False, repr(e))
+        self.replies[index].put(reply)
+
+    def _on_event(self, event):
+
+        '''
+        Handles an event from a worker on the loop.
+        '''
+
+        kind = event[0]
+        if kind == "count":
+            counters.increment(event[1], event[2])
+        elif kind == "density":
+            if history.store is not None: history.store.record(event[1], event[2], event[3])
+        elif kind == "result":
+            self.deliverer.on_result(event[1], event[2], event[3])
+        elif kind == "batch":
+            self.deliverer.on_batch(event[1], event[2])
+        elif kind == "metrics":
+            metrics.merge(event[1])
+        elif kind == "media":
+            media.cache.apply(event[1], event[2])
+            self.publish(("media", event[1], event[2]))
+
+    async def _monitor(self):
+
+        '''
+        Async method which restarts workers which have died, and gives up on
+        batches which have stopped making progress.
+        '''
+
+        while True:
+            await asyncio.sleep(MONITOR_INTERVAL)
+            for index, process in enumerate(self.processes):
+                if process.is_alive(): continue
+                commons.log(LOG_TAG, "worker " + str(index) + " exited with code " + str(process.exitcode) + ", restarting")
+                self._spawn(index)
+                self.deliverer.resubmit(index)
+            self.deliverer.expire()
+
+    def stop(self):
+
+        '''
+        Asks every worker to shut down, and kills the ones that do not.
+        '''
+
+        self.publish(("stop",))
+        for index, process in enumerate(self.processes):
+            process.join(STOP_TIMEOUT)
+            if process.is_alive():
+                commons.log(LOG_TAG, "worker " + str(index) + " did not stop, terminating")
+                process.terminate()
+        self.events.put(None)
+
+class RemoteRepository():
+
+    def __init__(self, worker, reader):
+
+        '''
+        Subscriber repository of a worker process. Reads go straight to the
+        database; changes are applied by the ingress.
+
+        @param worker: Worker to send the changes through
+        @param reader: SQLiteSubscriberRepository opened read-only
+        '''
+
+        self.worker = worker
+        self.reader = reader
+
+    def subscribe(self, id, name, account):
+        return self.worker.call("subscribe", id, name, account)
+
+    def subscribe_many(self, subscribers, account):
+        return self.worker.call("subscribe_many", list(subscribers), account)
+
+    def unsubscribe(self, id, account = None):
+        return self.worker.call("unsubscribe", id, account)
+
+    def get_name(self, id):
+        return self.reader.get_name(id)
+
+    def count(self, account = None):
+        return self.reader.count(account)
+
+    def iter_ids(self, after = None, page_size = subscribers.PAGE_SIZE, account = None):
+        return self.reader.iter_ids(after, page_size, account)
+
+    def iter_names(self, page_size = subscribers.PAGE_SIZE):
+        return self.reader.iter_names(page_size)
+
+    def close(self):
+        self.reader.close()
+
+class Worker():
+
+    def __init__(self, index, count, events, replies):
+
+        '''
+        Sets up worker process index of count.
+
+        @param index: index of this worker
+        @param count: number of worker processes
+        @param events: queue of events to the ingress
+        @param replies: queue of answers from the ingress to this worker
+        '''
+
+        self.index = index
+        self.count = count
+        self.events = events
+        self.replies = replies
+        self.loop = None
+        self.bot = None
+        self._calls = {} # call id to the concurrent.futures.Future of every call waiting for an answer
+        self._call_ids = itertools.count(1)
+
+    def call(self, method, *args):
+
+        '''
+        Asks the ingress to apply a subscription change and returns its result.
+        Waits for the round trip, so must not be called on the loop; the bot
+        makes subscription changes in the default executor. Safe to call from
+        several threads at once.
+
+        @param method: name of a method of the subscriber repository
+        @param args: arguments of the method
+        '''
+
+        call_id = next(self._call_ids)
+        future = self._calls[call_id] = concurrent.futures.Future()
+        self.events.put(("call", self.index, call_id, method, args))
+        try:
+            return future.result(CALL_TIMEOUT)
+        except concurrent.futures.TimeoutError:
+            raise TimeoutError("no answer from the ingress to " + method)
+        finally:
+            self._calls.pop(call_id, None)
+
+    def _read_replies(self):
+
+        '''
+        Runs on the replies thread. Hands every answer of the ingress to the
+        call waiting for it.
+        '''
+
+        while True:
+            call_id, succeeded, result = self.replies.get()
+            future = self._calls.get(call_id)
+            if future is None: continue # answer to a call which already timed out
+            if succeeded:
+                future.set_result(result)
+            else:
+                future.set_exception(RuntimeError(result))
+
+    def notify(self, *event):
+
+        '''
+        Sends an event to the ingress without waiting for it.
+        '''
+
+        self.events.put(event)
+
+    def run(self, token, settings, inbox):
+
+        '''
+        Sets the bot up in this process and serves the commands in inbox until
+        told to stop.
+
+        @param token: telegram bot token
+        @param settings: dictionary with the twitter "accounts", the path of
+            the "subscribers_db", and optionally the "api_url" of the bot api
+            and the "servers" replacing bot constants such as NTU_WEBSITE, and
+            the "watchdog_threshold", the "logs" settings passed to
+            logs.configure, and the "poll_interval" of the cameras if the
+            ingress polls them
+        @param inbox: queue of commands from the ingress
+        '''
+
+        logs.configure(**settings.get("logs", {}))
+        commons.set_read_only()
+        bot.TWITTER_ACCOUNTS = settings["accounts"]
+        for name, url in settings.get("servers", {}).items():
+            setattr(bot, name, url)
+        if settings.get("api_url"):
+            delivery.use_api_server(settings["api_url"])
+        subscribers.repository = RemoteRepository(self, subscribers.SQLiteSubscriberRepository(settings["subscribers_db"], read_only = True))
+        counters.forward(lambda name, amount: self.notify("count", name, amount))
+
+        bot.init(read_only = True)
+        camera.fetcher.on_publish = self._publish_density
+        if settings.get("poll_interval"):
+            poller.keep_snapshots(camera.fetcher, settings["poll_interval"])
+        media.cache.on_change = lambda url, file_id: self.notify("media", url, file_id)
+        self.loop = asyncio.get_event_loop()
+        self.bot = bot.create_delegator(token)
+        self.bot.scheduler.on_event(self.bot.handle) # idle timeouts of the chat handlers; normally wired up by message_loop
+        delivery.init(self.bot, global_rate = delivery.GLOBAL_RATE / self.count)
+
+        threading.Thread(target = self._read_inbox, args = (inbox,), name = "worker-inbox", daemon = True).start()
+        threading.Thread(target = self._read_replies, name = "worker-replies", daemon = True).start()
+        self.loop.create_task(bot.warm_up())
+        metrics.start(self.loop, "worker " + str(self.index))
+        metrics.forward(self.loop, lambda histograms: self.notify("metrics", histograms))
+        self.loop.add_signal_handler(signal.SIGTERM, self.loop.stop)
+        profiler.start_watchdog(self.loop, settings.get("watchdog_threshold", profiler.WATCHDOG_THRESHOLD))
+        commons.log(LOG_TAG, "worker " + str(self.index) + " ready")
+        try:
+            self.loop.run_forever()
+        finally:
+            profiler.stop_watchdog()
+            self.loop.run_until_complete(http_client.close())
+            bot.DENSITY_POOL.shutdown(wait = True)
+            commons.log(LOG_TAG, "worker " + str(self.index) + " stopped")
+
+    def _read_inbox(self, inbox):
+
+        '''
+        Runs on the inbox thread. Hands every command to the loop, and stops the
+        worker if the ingress is gone.
+        '''
+
+        parent = os.getppid()
+        while True:
+            try:
+                command = inbox.get(timeout = MONITOR_INTERVAL)
+            except queue.Empty:
+                if os.getppid() == parent: continue
+                command = ("stop",)
+            self.loop.call_soon_threadsafe(self._on_command, command)
+            if command[0] == "stop": return
+
+    def _on_command(self, command):
+
+        '''
+        Handles a command from the ingress on the loop.
+        '''
+
+        kind = command[0]
+        if kind == "update":
+            self.bot.handle(command[1])
+        elif kind == "data":
+            commons.set_data(command[1], command[2])
+        elif kind == "bus_services":
+            bot.set_bus_services(command[1])
+        elif kind == "media":
+            media.cache.apply(command[1], command[2])
+        elif kind == "snapshot":
+            camera.fetcher.adopt(camera.Snapshot(*command[1:]))
+        elif kind == "send":
+            self.loop.create_task(self._send(*command[1:]))
+        elif kind == "stop":
+            self.loop.stop()
+
+    async def _send(self, batch_id, chat_ids, text, kwargs):
+
+        '''
+        Async method which sends a batch of a fan-out, reporting every result.
+        '''
+
+        on_result = lambda chat_id, delivered: self.notify("result", batch_id, chat_id, delivered)
+        report = await delivery.deliverer.send_message(chat_ids, text, "batch " + str(batch_id), on_result, **kwargs)
+        self.notify("batch", batch_id, report.retries)
+
+    def _publish_density(self, snapshot):
+
+        '''
+        Forwards the density of a snapshot fetched by this worker to the
+        history kept by the ingress.
+        '''
+
+        if snapshot.density:
+            self.notify("density", snapshot.location, snapshot.density, snapshot.timestamp)
+
+def _run_worker(index, count, token, settings, inbox, events, replies):
+
+    '''
+    Entry point of a worker process.
+    '''
+
+    Worker(index, count, events, replies).run(token, settings, inbox)